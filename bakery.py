@@ -15,8 +15,10 @@
 #   limitations under the License.
 
 import configparser
+import functools
 import lib.bakerydisplay as bakerydisplay
 import lib.diskdetector as diskdetector
+import lib.jobs as jobs
 import lib.utils as utils
 
 # Look for configuration file and read it
@@ -30,12 +32,28 @@ config.read( config_files )
 # Get image directory
 dirs = config.get('images', 'source')
 
+# Settings for writing images
+write_options = utils.write_options(config)
+
+# Measured speeds of the card readers
+utils.load_throughput(dirs)
+
+# How far any interrupted writes got
+utils.load_journal(dirs)
+
+# Writes run in the background
+writes = jobs.WritePool(functools.partial(utils.write_image, options=write_options))
+
 # Listen for disks
 disks = diskdetector.DiskEventListener()
+
+# Write batches of cards as they are inserted
+scheduler = jobs.Scheduler(jobs.JobQueue(dirs + '/' + jobs.JOBS_FILE), disks,
+                           writes)
 disks.activate()
 
 # Set up the display
-display = bakerydisplay.BakeryDisplay(disks, dirs, utils.write_image)
+display = bakerydisplay.BakeryDisplay(disks, dirs, writes, scheduler)
 
 # Run the main loop
 display.menu()
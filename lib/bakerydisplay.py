@@ -12,8 +12,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 import pifacecad
-import pifacecad.tools
-import multiprocessing
+import pifacecommon.interrupts
 import threading
 import time
 import os.path
@@ -21,9 +20,24 @@ import socket
 import subprocess
 import re
 import lib.utils as utils
+import lib.jobs as jobs
+import lib.lcd as lcd
 import distutils.dir_util
 import shutil
 
+def check_interrupts():
+    """Stop if the interrupts.py from Bakery has not been installed
+
+    The buttons of each view are bound to the one listener with the
+    PinFunctionTable of the replacement, which no released version of
+    pifacecommon has.
+
+    """
+    if ( not hasattr(pifacecommon.interrupts, 'PinFunctionTable')
+         or not hasattr(pifacecommon.interrupts.PortEventListener, 'bind') ):
+        raise SystemExit("Bakery needs its own interrupts.py. Copy pifacecommon/interrupts.py"
+                         " from Bakery over " + pifacecommon.interrupts.__file__)
+
 class BakeryDisplay(list):
 
     # Only use up to two devices
@@ -33,6 +47,12 @@ class BakeryDisplay(list):
     # Number of seconds to require the button is pressed for
     PRESS_TIME = 5
 
+    # Seconds between steps when scrolling, between updates of views that
+    # show writes, and that a message is shown for
+    SCROLL_TIME = 0.3
+    UPDATE_TIME = 1
+    MESSAGE_TIME = 3
+
     # Bitmap IDs
     # First 5 bitmaps for the blocks for the progress bar
     BLOCK = range(5)
@@ -51,10 +71,15 @@ class BakeryDisplay(list):
     BUTTON_SELECT_DISPLAY = 1
     BUTTON_COPY_Y = 1
     BUTTON_COPY_N = 2
+    BUTTON_ALL = 2       # For main view
+    BUTTON_CANCEL = 2    # For batch view
     BUTTON_SCROLL = 3
     BUTTON_WRITE = 4     # For main view
     BUTTON_SCAN = 4      # For load view
     BUTTON_EXECUTE = 4   # For system view
+    BUTTON_BATCH = 4     # For batch view
+    BUTTON_ENTER = 4     # For questions
+    BUTTON_CURSOR = 5    # For questions
     BUTTON_INFO = 5
     BUTTON_PREV = 6
     BUTTON_NEXT = 7
@@ -64,27 +89,39 @@ class BakeryDisplay(list):
     DISPLAY_LOAD = 1
     DISPLAY_DELETE = 2
     DISPLAY_SYSTEM = 3
+    DISPLAY_BATCH = 4
+    DISPLAY_WRITES = 5
     DISPLAY_LOAD_YN = 98
     DISPLAY_WRITING = 99
     DISPLAY_FIRST = DISPLAY_MAIN
-    DISPLAY_LAST = DISPLAY_SYSTEM
-
-    def __init__(self, disks, source_dir, write_function):
-        # Callback function for writing to the device
-        self.write_function = write_function
+    DISPLAY_LAST = DISPLAY_WRITES
+
+    def __init__(self, disks, source_dir, writes, scheduler=None):
+        # Pool of writes running in the background
+        self.writes = writes
+        # Write shown on the writes view
+        self.write_n = 0
+        # Only one write can ask questions at a time
+        self.question_lock = threading.Lock()
         self.source_dir = source_dir
+        # Writes batches of cards in the background
+        self.scheduler = scheduler
 
         self.disks = disks
         self.images = utils.disk_image_list(self.source_dir)
+        # Watches the image directory, started once there is a menu loop to
+        # wake
+        self.image_watcher = utils.ImageStoreWatcher(self.images, self.source_dir,
+                                                     callback = self.wake)
         self.main_lines = [
             {
               #'source': self.images,
-              'info': [ 'name', 'n_post_scripts', 'n_variables' ],
+              'info': [ 'name', 'n_post_scripts', 'n_variables', 'size', 'partitions' ],
               'x': 1,
             },
             {
               'source': disks,
-              'info': [ 'model', 'node_path' ],
+              'info': [ 'model', 'node_path', 'speed' ],
               'x': 2,
             }
           ]
@@ -99,7 +136,7 @@ class BakeryDisplay(list):
 
         self.delete_line = {
             'source': self.images,
-            'info': [ 'name', 'n_post_scripts', 'n_variables' ],
+            'info': [ 'name', 'n_post_scripts', 'n_variables', 'size', 'partitions' ],
             'x': 0
           }
 
@@ -119,19 +156,40 @@ class BakeryDisplay(list):
         self.updates = False
         # Whether button is pressed or not
         self.is_pressed = False
+        # Write to every card that is present instead of the current one
+        self.write_all = False
 
+        check_interrupts()
         self.cad = pifacecad.PiFaceCAD()
         self.listener = pifacecad.SwitchEventListener(chip=self.cad)
+        # Listeners for the buttons of each display
+        self.controls = {}
+        # Prompts that have the buttons, on top of the display
+        self.prompts = []
+        self.prompts_lock = threading.Lock()
 
         self.scroll = False
+        self.next_scroll = 0
+        # When to put back the screen after a message, if one is shown
+        self.restore_at = None
+
+        # Set to make the menu loop look at everything again
+        self.woken = threading.Event()
+        # Set when Y or N is pressed for an image found by scan_device
+        self.copy_chosen = threading.Event()
+        # The answer to the question being asked, and set when it is entered
+        self.asking = None
+        self.answered = threading.Event()
+        for action in ('add_disk', 'remove_disk', 'add_device', 'remove_device'):
+            disks.register(action, self.disk_event)
+        # Keep the list of images up to date with the image directory
+        self.image_watcher.start()
 
         self.display = self.DISPLAY_FIRST
 
-        self.write_queue = multiprocessing.Queue()
-        self.writer = threading.Thread( target = _lcd_writer,
-                                        args = ( self.write_queue, self.cad ) )
-
-        self.writer.start()
+        # Everything written to the LCD goes through the renderer
+        self.write_queue = lcd.LcdRenderer(self.cad)
+        self.write_queue.start()
 
         # Store bitmaps for the partial blocks that make up the progree bar.
         # Each one contains 8 lines of the same number:
@@ -196,13 +254,13 @@ class BakeryDisplay(list):
         pressed for five seconds.
 
         """
-        if self.main_lines[1]['source'].current().present == False:
+        if not self.target_devices():
             self.write_queue.put( { 'action': 'write',
                                     'pos': [0, 0],
                                     'text': 'No disk present ' } )
             self.press_start = -1
-            time.sleep(3)
-            self.refresh()
+            # Leave the buttons free while the message is shown
+            self.restore_at = time.time() + self.MESSAGE_TIME
         else:
             self.press_start = time.time()
             self.is_pressed = True
@@ -212,6 +270,7 @@ class BakeryDisplay(list):
             self.write_queue.put( { 'action': 'write',
                                     'pos': [0, 1],
                                     'text': 'Write in {0} secs '.format(self.PRESS_TIME) } )
+        self.wake()
 
     def released(self, event):
         """Button has been released
@@ -225,48 +284,47 @@ class BakeryDisplay(list):
             return None
         self.is_pressed = False
         if self.press_start > 0 and time.time() > self.press_start + self.PRESS_TIME:
-            self.write_queue.put( { 'action': 'clear' } )
-
-            # Keep track of progress
-            self.progress_pointer=0
-
-            self.updates = False
-
-            start_time = time.time()
-
-            # Turn off listeners while writing
-            self.display == self.DISPLAY_WRITING
+            # The write runs in the background and is shown on the writes
+            # view, leaving the buttons free for anything else
+            self.writes.start( self.target_devices(), self.images.current(), self,
+                               callback = self.write_finished )
+            self.write_n = len(self.writes.recent()) - 1
+            self.display = self.DISPLAY_WRITES
             self.setup_controls()
 
-            if self.write_function( self.main_lines[1]['source'].current().path,
-                                    #self.main_lines[0]['source'].current(), self ):
-                                    self.images.current(), self ):
-                self.write_queue.put( { 'action': 'clear' } )
-                self.write_queue.put( { 'action': 'write',
-                                        'pos': [0,0],
-                                        'text': '    FINISHED    ' } )
-                self.write_queue.put( { 'action': 'write',
-                                        'pos': [0,1],
-                                        'text': '{0} seconds'.format(int(time.time() - start_time)) } )
-                print("Time:", time.time() - start_time)
-            else:
-                self.write_queue.put( { 'action': 'clear' } )
-                self.write_queue.put( { 'action': 'write',
-                                        'pos': [0, 0],
-                                        'text': 'Write failed' } )
-                self.write_queue.put( { 'action': 'write',
-                                        'pos': [0, 1],
-                                        'text': 'Try again' } )
+        self.refresh()
+        self.wake()
 
-            time.sleep(5)
+    def write_finished(self, handle):
+        """Report a write that has finished"""
+        self.wake()
+        print("Time:", handle.seconds())
+        for d in sorted(handle.results):
+            if not handle.results[d]:
+                print("Failed:", d)
 
-            # Turn listeners back on
-            self.display == self.DISPLAY_FIRST
-            self.setup_controls()
+    def target_devices(self):
+        """Paths of the cards to write to
 
-            self.updates = True
+        Either every card that is present or just the current device if it
+        has a card.
 
-        self.refresh()
+        """
+        # Cards that are already being written
+        busy = self.writes.busy_devices()
+        if self.write_all:
+            return [ d.path for d in self.disks
+                     if d.present and d.path not in busy ]
+        elif ( self.disks.current() != None and self.disks.current().present
+               and self.disks.current().path not in busy ):
+            return [ self.disks.current().path ]
+        else:
+            return []
+
+    def toggle_write_all(self, event):
+        """Switch between writing to the current card and to all cards"""
+        self.write_all = not self.write_all
+        self.show_device(self.main_lines[1]['x'], 1)
 
     def delete_pressed(self, event):
         """Button has been pressed
@@ -283,6 +341,7 @@ class BakeryDisplay(list):
                                 'pos': [0, 1],
                                 'blank': 1,
                                 'text': 'in {0} secs '.format(self.PRESS_TIME) } )
+        self.wake()
 
     def delete_released(self, event):
         """Button has been released
@@ -296,9 +355,118 @@ class BakeryDisplay(list):
             return None
         self.is_pressed = False
         if self.press_start > 0 and time.time() > self.press_start + self.PRESS_TIME:
-            shutil.rmtree(self.images.current().directory)
-            self.images = utils.disk_image_list(self.source_dir)
+            directory = self.images.current().directory
+            shutil.rmtree(directory)
+            self.image_watcher.rescan(directory)
+        self.refresh()
+        self.wake()
+
+    def batch_pressed(self, event):
+        """Button has been pressed
+
+        Start a batch
+
+        """
+        if self.images.current() is None:
+            return
+        self.press_start = time.time()
+        self.is_pressed = True
+        self.countdown = self.PRESS_TIME
+        self.counter_pos = [ 3, 1 ]
+        self.write_queue.put( { 'action': 'clear queue' } )
+        self.write_queue.put( { 'action': 'write',
+                                'pos': [0, 0],
+                                'blank': 1,
+                                'text': 'Batch of {0}'.format(jobs.BATCH_SIZE) } )
+        self.write_queue.put( { 'action': 'write',
+                                'pos': [0, 1],
+                                'blank': 1,
+                                'text': 'in {0} secs '.format(self.PRESS_TIME) } )
+        self.wake()
+
+    def batch_released(self, event):
+        """Button has been released
+
+        Only start the batch if the button has been pressed for five
+        seconds. Otherwise, do nothing.
+
+        """
+        if not self.is_pressed:
+            # Got here by cosmic rays, or some such.
+            return None
+        self.is_pressed = False
+        if self.press_start > 0 and time.time() > self.press_start + self.PRESS_TIME:
+            self.scheduler.queue.add(self.images.current())
         self.refresh()
+        self.wake()
+
+    def cancel_batch(self, event):
+        """Cancel the current batch, leaving any cards being written"""
+        job = self.scheduler.queue.current()
+        if job is not None:
+            self.scheduler.queue.remove(job)
+        self.show_batch_status()
+
+    def show_batch_status(self):
+        job = self.scheduler.queue.current()
+        if job is None:
+            text = 'No batch'
+        else:
+            text = 'Batch {0}/{1}'.format(job['done'], job['count'])
+            writing = len(self.scheduler.progress())
+            if writing:
+                text += ' +{0}'.format(writing)
+        self.write_queue.put( { 'action': 'write',
+                                'blank': 1,
+                                'pos': [0,0],
+                                'text': text } )
+
+    def cancel_write(self, event):
+        """Cancel the write shown on the writes view"""
+        handles = self.writes.recent()
+        if self.write_n < len(handles):
+            handles[self.write_n].cancel()
+        self.show_write_status()
+
+    def show_write_status(self):
+        """Show the selected write on the writes view"""
+        handles = self.writes.recent()
+        if not handles:
+            self.write_queue.put( { 'action': 'write',
+                                    'blank': 1,
+                                    'pos': [0,0],
+                                    'text': 'No writes' } )
+            self.write_queue.put( { 'action': 'write',
+                                    'blank': 1,
+                                    'pos': [0,1],
+                                    'text': '' } )
+            return
+        if self.write_n >= len(handles):
+            self.write_n = len(handles) - 1
+        handle = handles[self.write_n]
+        if len(handle.devices) == 1:
+            where = handle.devices[0].replace('/dev/', '')
+        else:
+            where = '{0} cards'.format(len(handle.devices))
+        self.write_queue.put( { 'action': 'write',
+                                'blank': 1,
+                                'pos': [0,0],
+                                'text': '{0} {1}'.format(where, handle.image.name) } )
+        if handle.done() or handle.title is None:
+            status = handle.status
+        elif handle.rate is not None:
+            status = '{0} {1:.0f}% {2:.1f}M/s'.format(handle.title[:1], handle.percent, handle.rate)
+        else:
+            status = '{0} {1:.0f}%'.format(handle.title, handle.percent)
+        if not handle.done() and len(handle.device_percents) > 1:
+            # Each card, which can be scrolled into view
+            status = ' '.join( '{0} {1:.0f}%'.format(device.replace('/dev/', ''),
+                                                     handle.device_percents[device])
+                               for device in sorted(handle.device_percents) )
+        self.write_queue.put( { 'action': 'write',
+                                'blank': 1,
+                                'pos': [0,1],
+                                'text': status } )
 
     def system_pressed(self, event):
         """Button has been pressed
@@ -320,6 +488,7 @@ class BakeryDisplay(list):
                                     'pos': [0, 1],
                                     'blank': 1,
                                     'text': 'in {0} secs '.format(self.PRESS_TIME) } )
+            self.wake()
 
     def system_released(self, event):
         """Button has been released
@@ -339,6 +508,7 @@ class BakeryDisplay(list):
                 subprocess.call(['shutdown', '-r', 'now'])
 
         self.refresh()
+        self.wake()
 
     def switch_pointer(self, event):
         """Switch the pointer between lines"""
@@ -376,150 +546,260 @@ class BakeryDisplay(list):
     def switch_display(self, event):
         """Switch between displays"""
         self.display = self.display + 1
+        if self.display == self.DISPLAY_BATCH and self.scheduler is None:
+            self.display = self.display + 1
         if self.display > self.DISPLAY_LAST:
             self.display = self.DISPLAY_FIRST
         self.setup_controls()
         self.refresh()
 
     def setup_controls(self):
-        """Set up the listeners for the buttons"""
+        """Set up the listeners for the buttons
 
-        # Clear all listeners
-        self.listener.deregister()
+        The buttons of each display are put together the first time it is
+        shown and swapped in whole, in one go, after that.
+
+        """
+        if self.prompts:
+            display = self.prompts[-1]
+        else:
+            display = self.display
+        if display not in self.controls:
+            self.controls[display] = self.make_controls(display)
+        self.listener.bind(self.controls[display])
+
+        # The menu loop does something different for each display
+        self.wake()
+
+    def make_controls(self, display):
+        """The listeners for the buttons of a display"""
+        controls = pifacecommon.interrupts.PinFunctionTable()
+
+        if display == self.DISPLAY_WRITING:
+            # Answer a question about a variable
+            controls.register( self.BUTTON_PREV,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.answer_prev )
+            controls.register( self.BUTTON_NEXT,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.answer_next )
+            controls.register( self.BUTTON_CURSOR,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.answer_move )
+            controls.register( self.BUTTON_ENTER,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.answer_enter )
+            return controls
 
         # Settings for all displays
         # Scroll display
-        self.listener.register( self.BUTTON_SCROLL,
-                                pifacecad.IODIR_FALLING_EDGE,
-                                self.scroll_on )
-        self.listener.register( self.BUTTON_SCROLL,
-                                pifacecad.IODIR_RISING_EDGE,
-                                self.scroll_off )
-
-        if self.display == self.DISPLAY_MAIN:
+        controls.register( self.BUTTON_SCROLL,
+                           pifacecad.IODIR_FALLING_EDGE,
+                           self.scroll_on )
+        controls.register( self.BUTTON_SCROLL,
+                           pifacecad.IODIR_RISING_EDGE,
+                           self.scroll_off )
+
+        if display == self.DISPLAY_MAIN:
             # Previous and next
-            self.listener.register( self.BUTTON_PREV,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.main_prev )
-            self.listener.register( self.BUTTON_NEXT,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.main_next )
+            controls.register( self.BUTTON_PREV,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.main_prev )
+            controls.register( self.BUTTON_NEXT,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.main_next )
             # Write image
-            self.listener.register( self.BUTTON_WRITE,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.pressed )
-            self.listener.register( self.BUTTON_WRITE,
-                                    pifacecad.IODIR_RISING_EDGE,
-                                    self.released )
+            controls.register( self.BUTTON_WRITE,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.pressed )
+            controls.register( self.BUTTON_WRITE,
+                               pifacecad.IODIR_RISING_EDGE,
+                               self.released )
+
+            # Write to all cards
+            controls.register( self.BUTTON_ALL,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.toggle_write_all )
 
             # Move pointer between lines
-            self.listener.register( self.BUTTON_POINTER,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.switch_pointer )
+            controls.register( self.BUTTON_POINTER,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.switch_pointer )
 
             # Show further information
-            self.listener.register( self.BUTTON_INFO,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.show_info )
+            controls.register( self.BUTTON_INFO,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.show_info )
 
             # Switch through displays
-            self.listener.register( self.BUTTON_SELECT_DISPLAY,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.switch_display )
+            controls.register( self.BUTTON_SELECT_DISPLAY,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.switch_display )
 
-        elif self.display == self.DISPLAY_LOAD:
+        elif display == self.DISPLAY_LOAD:
             # Previous and next
-            self.listener.register( self.BUTTON_PREV,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.load_prev )
-            self.listener.register( self.BUTTON_NEXT,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.load_next )
+            controls.register( self.BUTTON_PREV,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.load_prev )
+            controls.register( self.BUTTON_NEXT,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.load_next )
             # Scan partitions
-            self.listener.register( self.BUTTON_SCAN,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.scan_device )
+            controls.register( self.BUTTON_SCAN,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.scan_device )
 
             # Switch through displays
-            self.listener.register( self.BUTTON_SELECT_DISPLAY,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.switch_display )
+            controls.register( self.BUTTON_SELECT_DISPLAY,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.switch_display )
 
-        elif self.display == self.DISPLAY_DELETE:
+        elif display == self.DISPLAY_DELETE:
             # Previous and next
-            self.listener.register( self.BUTTON_PREV,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.delete_prev )
-            self.listener.register( self.BUTTON_NEXT,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.delete_next )
+            controls.register( self.BUTTON_PREV,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.delete_prev )
+            controls.register( self.BUTTON_NEXT,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.delete_next )
 
             # Switch through displays
-            self.listener.register( self.BUTTON_SELECT_DISPLAY,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.switch_display )
+            controls.register( self.BUTTON_SELECT_DISPLAY,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.switch_display )
 
             # Delete image
-            self.listener.register( self.BUTTON_WRITE,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.delete_pressed )
-            self.listener.register( self.BUTTON_WRITE,
-                                    pifacecad.IODIR_RISING_EDGE,
-                                    self.delete_released )
-
-        elif self.display == self.DISPLAY_LOAD_YN:
-            print("Setting listeners")
+            controls.register( self.BUTTON_WRITE,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.delete_pressed )
+            controls.register( self.BUTTON_WRITE,
+                               pifacecad.IODIR_RISING_EDGE,
+                               self.delete_released )
+
+        elif display == self.DISPLAY_LOAD_YN:
             # Copy or pass on an image
-            self.listener.register( self.BUTTON_COPY_Y,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.copy_image )
-            self.listener.register( self.BUTTON_COPY_N,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.pass_image )
-            # Scan partitions
-            self.listener.register( self.BUTTON_SCAN,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.scan_device )
-            print(self.listener.pin_function_maps)
-
-        elif self.display == self.DISPLAY_SYSTEM:
+            controls.register( self.BUTTON_COPY_Y,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.copy_image )
+            controls.register( self.BUTTON_COPY_N,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.pass_image )
+
+        elif display == self.DISPLAY_SYSTEM:
             # Previous and next
-            self.listener.register( self.BUTTON_PREV,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.system_prev )
-            self.listener.register( self.BUTTON_NEXT,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.system_next )
+            controls.register( self.BUTTON_PREV,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.system_prev )
+            controls.register( self.BUTTON_NEXT,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.system_next )
             # System action
-            self.listener.register( self.BUTTON_EXECUTE,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.system_pressed )
-            self.listener.register( self.BUTTON_EXECUTE,
-                                    pifacecad.IODIR_RISING_EDGE,
-                                    self.system_released )
+            controls.register( self.BUTTON_EXECUTE,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.system_pressed )
+            controls.register( self.BUTTON_EXECUTE,
+                               pifacecad.IODIR_RISING_EDGE,
+                               self.system_released )
 
             # Switch through displays
-            self.listener.register( self.BUTTON_SELECT_DISPLAY,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.switch_display )
+            controls.register( self.BUTTON_SELECT_DISPLAY,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.switch_display )
+
+        elif display == self.DISPLAY_BATCH:
+            # Previous and next image
+            controls.register( self.BUTTON_PREV,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.delete_prev )
+            controls.register( self.BUTTON_NEXT,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.delete_next )
+            # Start a batch
+            controls.register( self.BUTTON_BATCH,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.batch_pressed )
+            controls.register( self.BUTTON_BATCH,
+                               pifacecad.IODIR_RISING_EDGE,
+                               self.batch_released )
+            # Cancel a batch
+            controls.register( self.BUTTON_CANCEL,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.cancel_batch )
 
-        elif self.display == self.DISPLAY_WRITING:
-            # No listeners during writing
-            pass
+            # Switch through displays
+            controls.register( self.BUTTON_SELECT_DISPLAY,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.switch_display )
+
+        elif display == self.DISPLAY_WRITES:
+            # Previous and next write
+            controls.register( self.BUTTON_PREV,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.writes_prev )
+            controls.register( self.BUTTON_NEXT,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.writes_next )
+            # Cancel a write
+            controls.register( self.BUTTON_CANCEL,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.cancel_write )
+
+            # Switch through displays
+            controls.register( self.BUTTON_SELECT_DISPLAY,
+                               pifacecad.IODIR_FALLING_EDGE,
+                               self.switch_display )
+
+        return controls
+
+    def push_prompt(self, display):
+        """Give the buttons to a prompt, such as Y/N, until pop_prompt
+
+        Prompts stack on top of the display and of each other, and take
+        over the listener that is already running.
+
+        """
+        with self.prompts_lock:
+            self.prompts.append(display)
+            self.setup_controls()
+
+    def pop_prompt(self, display):
+        """Hand the buttons back from a prompt"""
+        with self.prompts_lock:
+            # Prompts from different threads need not finish in order, so
+            # remove the last one of this sort rather than the top
+            n = len(self.prompts) - 1 - self.prompts[::-1].index(display)
+            del self.prompts[n]
+            self.setup_controls()
+            if not self.prompts:
+                self.refresh()
+
+    def progress_title(self, title='Complete:'):
+        """Display the title for the progress bar
+
+        The title should be no more than 9 characters long, or just 1 if a
+        rate is going to be shown with the progress.
+
+        """
+        # Keep track of progress
+        self.progress_pointer = 0
 
-    def progress_title(self):
-        """Display the title for the progress bar"""
         self.write_queue.put( { 'action': 'clear', } )
         self.write_queue.put( { 'action': 'write',
                                 'pos': [0,0],
-                                'text': 'Complete:      %' } )
+                                'text': '{0:<15}%'.format(title) } )
 
-    def progress(self, percent):
+    def progress(self, percent, rate=None, devices=None):
         """Display the progress
 
-        Write the percentage progress and show a progress bar on the LCD.
+        Write the percentage progress, and the rate in MB/s if given, and
+        show a progress bar on the LCD. The progress of each card, in
+        devices, is shown on the writes view instead.
 
         """
+        if rate is not None:
+            self.write_queue.put( { 'action': 'write',
+                                    'pos': [2,0],
+                                    'text': '{0:4.1f}M/s'.format(rate) } )
         self.write_queue.put( { 'action': 'write',
                                 'pos': [10,0],
                                 'text': '{0:5.2f}'.format(percent) } )
@@ -584,6 +864,17 @@ class BakeryDisplay(list):
                                     'pos': [self.delete_line['x'],1],
                                     'text': self.images.current().name } )
 
+        elif self.display == self.DISPLAY_BATCH:
+            self.show_batch_status()
+            # Image for a new batch
+            self.write_queue.put( { 'action': 'write',
+                                    'blank': 1,
+                                    'pos': [self.delete_line['x'],1],
+                                    'text': self.images.current().name } )
+
+        elif self.display == self.DISPLAY_WRITES:
+            self.show_write_status()
+
     def show_system_data(self, rewrite=False):
         """Write the second line of the screen"""
         self.system_data[self.system_n](rewrite)
@@ -643,44 +934,104 @@ class BakeryDisplay(list):
         # TODO Use this to have an exit button
         self.finish = 0
 
+        self.images.updated = False
         self.refresh()
         self.updates = True
 
         self.setup_controls()
         self.listener.activate()
 
+        # Sleep until something happens or the screen next needs updating.
+        # Anything that changes after the event is cleared is seen by the
+        # next tick.
         while self.finish == 0:
-            if self.is_pressed:
-                if (self.press_start > 0 and
-                    self.countdown > 0 and
-                    int(time.time() - self.press_start) > self.PRESS_TIME - self.countdown):
-                    self.countdown = self.countdown - 1
-                    self.write_queue.put( { 'action': 'write',
-                                            'pos': self.counter_pos,
-                                            'text': str(self.countdown) } )
+            self.woken.clear()
+            self.woken.wait(self.tick())
+
+    def wake(self):
+        """Make the menu loop look at everything again straight away"""
+        self.woken.set()
+
+    def disk_event(self, event):
+        """A card or reader has come or gone"""
+        self.wake()
+
+    def tick(self):
+        """Do whatever the menu loop needs to do now
+
+        Returns the number of seconds until it next needs to do something,
+        or None if nothing will need doing until it is woken.
+
+        """
+        now = time.time()
+        if self.restore_at is not None:
+            if now < self.restore_at:
+                return self.restore_at - now
+            self.restore_at = None
+            self.refresh()
+
+        if self.is_pressed:
+            if self.press_start <= 0:
+                return None
+            # Count down once a second from when the button was pressed
+            while (self.countdown > 0 and
+                   now >= self.press_start + self.PRESS_TIME - self.countdown + 1):
+                self.countdown = self.countdown - 1
+                self.write_queue.put( { 'action': 'write',
+                                        'pos': self.counter_pos,
+                                        'text': str(self.countdown) } )
+            if self.countdown > 0:
+                return self.press_start + self.PRESS_TIME - self.countdown + 1 - now
+            return None
 
-            elif self.scroll:
+        elif self.scroll:
+            if now >= self.next_scroll:
                 self.write_queue.put( { 'action': 'scroll',
                                         'step': 1 } )
-                time.sleep(0.3)
-
-            elif self.updates and (self.display == self.DISPLAY_MAIN or self.display == self.DISPLAY_LOAD):
-                x = 0
-                if self.display == self.DISPLAY_MAIN:
-                    x = self.main_lines[1]['x']
-                else:
-                    x = self.load_line['x']
-
-                # TODO Check for change of devices list
-                if self.disks.updated:
-                    self.disks.updated = False
-                    self.show_device(x,1)
-
-                self.show_device_state(x-1, 1)
-                time.sleep(1)
+                self.next_scroll = now + self.SCROLL_TIME
+            return self.next_scroll - now
+
+        elif self.prompts:
+            # A prompt has the screen
+            return None
+
+        elif self.images.updated:
+            # The image directories have changed, so draw the view again and
+            # then carry on as normal
+            self.images.updated = False
+            self.refresh()
+            return 0
+
+        elif self.updates and (self.display == self.DISPLAY_MAIN or self.display == self.DISPLAY_LOAD):
+            x = 0
+            if self.display == self.DISPLAY_MAIN:
+                x = self.main_lines[1]['x']
             else:
-                # Avoid burning the CPU
-                time.sleep(0.2)
+                x = self.load_line['x']
+
+            if self.disks.updated or self.write_all:
+                self.disks.updated = False
+                self.show_device(x,1)
+
+            self.show_device_state(x-1, 1)
+            # Cards that are free to write change as writes finish
+            if self.writes.active():
+                return self.UPDATE_TIME
+            return None
+
+        elif self.updates and self.display == self.DISPLAY_BATCH:
+            self.show_batch_status()
+            if self.scheduler.queue.current() is not None or self.writes.active():
+                return self.UPDATE_TIME
+            return None
+
+        elif self.updates and self.display == self.DISPLAY_WRITES:
+            self.show_write_status()
+            if self.writes.active():
+                return self.UPDATE_TIME
+            return None
+
+        return None
 
     # Functions for left and right rocker switch
 
@@ -734,6 +1085,19 @@ class BakeryDisplay(list):
                                 'pos': [self.delete_line['x'],1],
                                 'text': img.name } )
 
+    def writes_prev(self, event):
+        if self.write_n == 0:
+            self.write_n = len(self.writes.recent())
+        if self.write_n > 0:
+            self.write_n -= 1
+        self.show_write_status()
+
+    def writes_next(self, event):
+        self.write_n += 1
+        if self.write_n >= len(self.writes.recent()):
+            self.write_n = 0
+        self.show_write_status()
+
     def system_prev(self, event):
         if self.system_n == 0:
             self.system_n = len(self.system_data)
@@ -747,18 +1111,23 @@ class BakeryDisplay(list):
         self.show_system_data()
 
     def scan_device(self, event):
+        """Look for images on the current device
+
+        The scan runs in a thread of its own, as the Y/N buttons that it
+        waits for are handled by the thread that called this.
+
+        """
         if self.disks.current() != None and self.disks.current().present:
-            self.updates = False
-            partitions = utils.get_device_partitions(self.disks.current().path)
+            self.push_prompt(self.DISPLAY_LOAD_YN)
+            scanner = threading.Thread(target = self.scan,
+                                       args = (self.disks.current().path,))
+            scanner.daemon = True
+            scanner.start()
+
+    def scan(self, path):
+        try:
+            partitions = utils.get_device_partitions(path)
             self.copy_dir = None
-            tmp_listener = pifacecad.SwitchEventListener(chip=self.cad)
-            tmp_listener.register( self.BUTTON_COPY_Y,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.copy_image )
-            tmp_listener.register( self.BUTTON_COPY_N,
-                                    pifacecad.IODIR_FALLING_EDGE,
-                                    self.pass_image )
-            tmp_listener.activate()
             for partition in partitions:
                 self.write_queue.put( { 'action': 'write',
                                         'pos': [0, 0],
@@ -781,8 +1150,8 @@ class BakeryDisplay(list):
                                                 'blank': 1,
                                                 'text': "Y N"} )
                         self.do_copy = None
-                        while self.do_copy == None:
-                            pass
+                        self.copy_chosen.clear()
+                        self.copy_chosen.wait()
                         if self.do_copy == 1:
                             self.write_queue.put( { 'action': 'write',
                                                     'pos': [0, 1],
@@ -795,21 +1164,30 @@ class BakeryDisplay(list):
                             new_dir = self.source_dir + "/{0:06d}".format(i)
                             os.mkdir(new_dir)
                             distutils.dir_util.copy_tree( dir, new_dir )
-                            #self.main_lines[0]['source'] = utils.disk_image_list(self.source_dir)
-                            self.images = utils.disk_image_list(self.source_dir)
+                            self.write_queue.put( { 'action': 'write',
+                                                    'pos': [0, 1],
+                                                    'blank': 1,
+                                                    'text': "Preparing ..."} )
+                            utils.compress_images(new_dir)
+                            self.image_watcher.rescan(new_dir)
                     utils.umount(mnt)
-            tmp_listener.deactivate()
-            self.refresh()
-            self.updates = True
+        finally:
+            self.pop_prompt(self.DISPLAY_LOAD_YN)
 
     def copy_image(self, event):
         self.do_copy = 1
+        self.copy_chosen.set()
 
     def pass_image(self, event):
         self.do_copy = 0
+        self.copy_chosen.set()
 
     def show_device_state(self, x, y):
-        if self.disks.current() != None and self.disks.current().present:
+        if self.write_all and self.display == self.DISPLAY_MAIN:
+            present = len(self.target_devices()) > 0
+        else:
+            present = self.disks.current() != None and self.disks.current().present
+        if present:
             self.write_queue.put( { 'action': 'bitmap',
                                     'pos': [x, y],
                                     'bitmap': self.SELECTED} )
@@ -819,154 +1197,83 @@ class BakeryDisplay(list):
                                     'bitmap': self.UNSELECTED} )
 
     def show_device(self, x, y):
-        if self.disks.current() == None:
+        if self.write_all and self.display == self.DISPLAY_MAIN:
+            self.write_queue.put( { 'action': 'write',
+                                    'blank': 1,
+                                    'pos': [x, y],
+                                    'text': 'All cards ({0})'.format(len(self.target_devices())) } )
+        elif self.disks.current() == None:
             self.write_queue.put( { 'action': 'write',
                                     'blank': 1,
                                     'pos': [x, y],
                                     'text': '' } )
         else:
+            text = str(self.disks.current())
+            if utils.throughput.is_slow(self.disks.current()):
+                # Flag a port that has been much slower than the others
+                text = '!' + text
             self.write_queue.put( { 'action': 'write',
                                     'blank': 1,
                                     'pos': [x, y],
-                                    'text': self.disks.current() } )
+                                    'text': text } )
         self.show_device_state(x-1, y)
 
     def scroll_on(self, event):
         self.scroll = True
+        self.next_scroll = 0
+        self.wake()
 
     def scroll_off(self, event):
         self.scroll = False
         self.refresh()
+        self.wake()
 
     def question(self, label, fmt):
-        self.write_queue.put( { 'action': 'pause' } )
-
-        self.cad.lcd.clear()
-        self.cad.lcd.set_cursor(0, 0)
-        self.cad.lcd.write(label)
-
-        self.cad.lcd.set_cursor(0, 1)
-        self.cad.lcd.cursor_on()
-        self.cad.lcd.blink_on()
-        if ':' in fmt:
-            (f, args) = fmt.split(':', 1)
-            scanner = pifacecad.tools.LCDScanf(format=f, custom_values=args.split(','), cad=self.cad)
-        else:
-            scanner = pifacecad.tools.LCDScanf(format=fmt, cad=self.cad)
-
-        answer = scanner.scan()
-        self.cad.lcd.cursor_off()
-        self.cad.lcd.blink_off()
-        self.write_queue.put( { 'action': 'resume' } )
-        return answer[0]
+        """Ask for the value of a variable
 
-def _lcd_writer(queue, cad):
-    """Write to the LCD
+        Called from the thread of a write, so the buttons are handed over
+        to a prompt until the answer is entered and then put back.
 
-    This function is run as a background thread with a queue to avoid
-    conflicting display updates.
-
-    Messages passed to the queue are hashes containing:
-
-        'action': 'clear'         - Clear the screen
-
-        'action': 'write'         - Write message
-        'pos': [ <int>, <int> ]   - Position to start text
-        'test': <string>          - Message to write
-        'blank': 0/1              - 1 = Clear to end of line (optional)
-
-        'action': 'store'         - Store bitmap
-        'bitmap': <int>           - Bitmap id
-        'lines': [ <int> * 8 ]    - Array of lines to make up bitmap
-
-        'action': 'bitmap'        - Write a bitmap
-        'pos': [ <int>, <int> ]   - Position to print bitmap
-        'bitmap': <int>           - Bitmap id
-
-        'action': 'scroll'        - Scroll a line
-        'step': <int>             - Places to scroll
-
-        'action': 'finish'        - End
-
-        'action': 'clear queue'   - Remove all items from the standard queue
+        """
+        with self.question_lock:
+            self.asking = lcd.Question(fmt)
+            self.answered.clear()
+            self.push_prompt(self.DISPLAY_WRITING)
+            try:
+                return self.ask(label)
+            finally:
+                self.write_queue.put( { 'action': 'cursor', 'pos': None } )
+                self.pop_prompt(self.DISPLAY_WRITING)
 
-        'action': 'pause'         - Pause writing to the LCD
+    def ask(self, label):
+        self.write_queue.put( { 'action': 'clear queue' } )
+        self.write_queue.put( { 'action': 'clear' } )
+        self.write_queue.put( { 'action': 'write',
+                                'pos': [0, 0],
+                                'text': label } )
+        self.show_answer()
+        self.answered.wait()
+        return self.asking.answer()
 
-        'action': 'resume'        - Resume writing to the LCD
+    def show_answer(self):
+        self.write_queue.put( { 'action': 'write',
+                                'pos': [0, 1],
+                                'blank': 1,
+                                'text': self.asking.text() } )
+        self.write_queue.put( { 'action': 'cursor',
+                                'pos': [self.asking.column(), 1] } )
 
-    """
-    #cad = pifacecad.PiFaceCAD()
-    cad.lcd.backlight_on()
-    cad.lcd.cursor_off()
-    cad.lcd.blink_off()
-    line_length = [0, 0]
+    def answer_prev(self, event):
+        self.asking.change(-1)
+        self.show_answer()
 
-    standard_queue = []
-    background_queue = []
+    def answer_next(self, event):
+        self.asking.change(1)
+        self.show_answer()
 
-    pause = False
+    def answer_move(self, event):
+        self.asking.move()
+        self.show_answer()
 
-    while True:
-        seek = True
-        while seek:
-            try:
-                message = queue.get(False)
-                if message['action'] == 'pause':
-                    pause = True
-                elif message['action'] == 'resume':
-                    pause = False
-                elif message['action'] == 'store':
-                    background_queue.append(message)
-                elif message['action'] == 'clear queue':
-                    standard_queue = []
-                else:
-                    standard_queue.append(message)
-            except:
-                seek = False
-
-        message = None
-        if not pause:
-            if len(standard_queue) > 0:
-                message = standard_queue[0]
-                standard_queue = standard_queue[1:]
-            elif len(background_queue) > 0:
-                message = background_queue[0]
-                background_queue = background_queue[1:]
-
-        if message == None:
-            # Avoid burning the CPU
-            time.sleep(0.2)
-        else:
-            if message['action'] == 'finish':
-                return
-            elif message['action'] == 'write':
-                cad.lcd.set_cursor(message['pos'][0], message['pos'][1])
-                m = ''
-                if m != None:
-                    m = str(message['text'])
-                text_len = len(m)
-                if ( message['pos'][0] + text_len < line_length[message['pos'][1]]
-                     and 'blank' in message and message['blank'] ):
-                    ln = line_length[message['pos'][1]] - message['pos'][0]
-                    line_length[message['pos'][1]] = message['pos'][0] + text_len 
-                else:
-                    ln = text_len 
-                    new_ln = message['pos'][0] + len(m)
-                    if new_ln > line_length[message['pos'][1]]:
-                       line_length[message['pos'][1]] = new_ln
-                cad.lcd.write(('{:<' + str(ln) + '}').format(m))
-            elif message['action'] == 'store':
-                cad.lcd.store_custom_bitmap(message['bitmap'], message['lines'])
-            elif message['action'] == 'bitmap':
-                cad.lcd.set_cursor(message['pos'][0], message['pos'][1])
-                cad.lcd.write_custom_bitmap( message['bitmap'] )
-            elif message['action'] == 'clear':
-                cad.lcd.clear()
-            elif message['action'] == 'scroll':
-                while message['step'] != 0:
-                    if message['step'] > 0:
-                        cad.lcd.move_left()
-                        message['step'] = message['step'] - 1
-                    elif message['step'] < 0:
-                        cad.lcd.move_right()
-                        message['step'] = message['step'] + 1
+    def answer_enter(self, event):
+        self.answered.set()
@@ -0,0 +1,286 @@
+#   Copyright 2014 Joseph Haig
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# Block maps list the parts of an image that actually hold data, together
+# with a checksum for each part. The files use the same format as bmaptool
+# (https://github.com/intel/bmap-tools) so maps made by either can be used.
+import bisect
+import hashlib
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+
+BLOCK_SIZE = 4096
+CHECKSUM_TYPE = 'sha256'
+
+class ChecksumError(Exception):
+    pass
+
+class Bmap:
+    """Block map of an image
+
+    ranges is a list of [first block, last block, checksum] for each run of
+    blocks holding data, in order.
+
+    """
+    def __init__(self, image_size, block_size=BLOCK_SIZE, ranges=None,
+                 checksum_type=CHECKSUM_TYPE):
+        self.image_size = image_size
+        self.block_size = block_size
+        self.ranges = ranges or []
+        self.checksum_type = checksum_type
+        self.starts = [ r[0] * block_size for r in self.ranges ]
+
+    def blocks_count(self):
+        return (self.image_size + self.block_size - 1) // self.block_size
+
+    def mapped_blocks_count(self):
+        return sum(r[1] - r[0] + 1 for r in self.ranges)
+
+    def mapped_size(self):
+        return sum(end - start for start, end, checksum in self.byte_ranges())
+
+    def byte_ranges(self):
+        """The ranges as (start, end, checksum) in bytes"""
+        for first, last, checksum in self.ranges:
+            yield ( first * self.block_size,
+                    min((last + 1) * self.block_size, self.image_size),
+                    checksum )
+
+    def range_at(self, offset):
+        """Index of the range that holds or follows the byte offset"""
+        i = bisect.bisect_right(self.starts, offset) - 1
+        if i >= 0 and offset < (self.ranges[i][1] + 1) * self.block_size:
+            return i
+        return i + 1
+
+    def runs(self, offset, length):
+        """Split part of the image into runs of mapped and unmapped data
+
+        Returns a list of (start, end, unmapped) tuples relative to offset,
+        in the same form as utils.data_runs. Each mapped run is within a
+        single range.
+
+        """
+        runs = []
+        end = offset + length
+        pos = offset
+        i = self.range_at(offset)
+        while pos < end:
+            if i < len(self.ranges):
+                start = self.ranges[i][0] * self.block_size
+                stop = (self.ranges[i][1] + 1) * self.block_size
+            else:
+                start = stop = end
+            if pos < start:
+                gap = min(start, end)
+                runs.append((pos - offset, gap - offset, True))
+                pos = gap
+            else:
+                piece = min(stop, end)
+                runs.append((pos - offset, piece - offset, False))
+                pos = piece
+                i += 1
+        return runs
+
+    def save(self, path):
+        """Write the map to a file in bmaptool's format"""
+        lines = [
+            '<?xml version="1.0" ?>',
+            '<!-- Block map of an image, written by Bakery -->',
+            '<bmap version="2.0">',
+            '    <ImageSize> {0} </ImageSize>'.format(self.image_size),
+            '    <BlockSize> {0} </BlockSize>'.format(self.block_size),
+            '    <BlocksCount> {0} </BlocksCount>'.format(self.blocks_count()),
+            '    <MappedBlocksCount> {0} </MappedBlocksCount>'.format(self.mapped_blocks_count()),
+            '    <ChecksumType> {0} </ChecksumType>'.format(self.checksum_type),
+            '    <BmapFileChecksum> {0} </BmapFileChecksum>',
+            '    <BlockMap>',
+          ]
+        for first, last, checksum in self.ranges:
+            if first == last:
+                blocks = str(first)
+            else:
+                blocks = '{0}-{1}'.format(first, last)
+            lines.append('        <Range chksum="{0}"> {1} </Range>'.format(checksum, blocks))
+        lines.append('    </BlockMap>')
+        lines.append('</bmap>')
+        text = '\n'.join(lines) + '\n'
+
+        # The file checksum is calculated with the checksum itself as zeros
+        size = hashlib.new(self.checksum_type).digest_size * 2
+        checksum = hashlib.new(self.checksum_type,
+                               text.replace('{0}', '0' * size, 1).encode('ascii'))
+        text = text.replace('{0}', checksum.hexdigest(), 1)
+
+        # Write to a temporary file first so that a half written map is
+        # never found next to the image
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fl:
+            fl.write(text)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a map from a file
+
+        Raises ValueError if the file is not a valid block map.
+
+        """
+        with open(path, 'rb') as fl:
+            raw = fl.read()
+        try:
+            root = ElementTree.fromstring(raw)
+        except ElementTree.ParseError as e:
+            raise ValueError("Cannot parse {0}: {1}".format(path, e))
+        if root.tag != 'bmap':
+            raise ValueError("{0} is not a block map".format(path))
+
+        def value(tag, default=None):
+            element = root.find(tag)
+            if element is None or element.text is None:
+                if default is None:
+                    raise ValueError("{0} has no {1}".format(path, tag))
+                return default
+            return element.text.strip()
+
+        version = root.get('version', '1.0')
+        checksum_type = value('ChecksumType', 'sha1').lower()
+        if checksum_type not in hashlib.algorithms_available:
+            raise ValueError("Unknown checksum type {0}".format(checksum_type))
+
+        if version.startswith('2.'):
+            expected = value('BmapFileChecksum')
+            text = raw.decode('ascii')
+            zeroed = re.sub(r"<BmapFileChecksum> *\w+ *</BmapFileChecksum>",
+                            "<BmapFileChecksum> {0} </BmapFileChecksum>".format('0' * len(expected)),
+                            text, count=1)
+            actual = hashlib.new(checksum_type, zeroed.encode('ascii')).hexdigest()
+            if actual != expected:
+                raise ValueError("{0} has been corrupted".format(path))
+
+        try:
+            ranges = []
+            for element in root.iter('Range'):
+                blocks = element.text.strip().split('-')
+                first = int(blocks[0])
+                last = int(blocks[-1])
+                ranges.append([ first, last, element.get('chksum') ])
+            return cls( int(value('ImageSize')), int(value('BlockSize')),
+                        ranges, checksum_type )
+        except (TypeError, ValueError) as e:
+            raise ValueError("Bad block map {0}: {1}".format(path, e))
+
+class BmapVerifier:
+    """Check the data of a stream against the checksums of a block map
+
+    Data has to be passed to update in order, along with the runs from
+    Bmap.runs for it.
+
+    """
+    def __init__(self, bmap):
+        self.bmap = bmap
+        self.index = None
+        self.checksum = None
+
+    def update(self, offset, data, runs):
+        for start, end, unmapped in runs:
+            if unmapped:
+                continue
+            i = self.bmap.range_at(offset + start)
+            if i != self.index:
+                self.index = i
+                self.checksum = hashlib.new(self.bmap.checksum_type)
+            self.checksum.update(data[start:end])
+            range_end = min((self.bmap.ranges[i][1] + 1) * self.bmap.block_size,
+                            self.bmap.image_size)
+            if offset + end >= range_end:
+                self.check()
+
+    def check(self):
+        first, last, expected = self.bmap.ranges[self.index]
+        self.index = None
+        if expected is not None and self.checksum.hexdigest() != expected:
+            raise ChecksumError("Checksum mismatch in blocks {0}-{1}".format(first, last))
+
+class BmapBuilder:
+    """Build a block map from a stream of image data
+
+    Buffers of data are passed to update in order. Any block that is not all
+    zeros is mapped.
+
+    """
+    def __init__(self, block_size=BLOCK_SIZE, checksum_type=CHECKSUM_TYPE):
+        self.block_size = block_size
+        self.checksum_type = checksum_type
+        self.zero_block = bytes(block_size)
+        self.size = 0
+        self.ranges = []
+        self.checksum = None
+        # Start of a block that went over the end of the last buffer
+        self.partial = b''
+
+    def update(self, buf, length):
+        """Add the first length bytes of buf, which must have a find method"""
+        pos = 0
+        if self.partial:
+            pos = min(length, self.block_size - len(self.partial))
+            self.partial += bytes(buf[:pos])
+            if len(self.partial) < self.block_size:
+                return
+            block = self.partial
+            self.partial = b''
+            self.add(block, block == self.zero_block)
+        with memoryview(buf) as view:
+            # Runs of blocks with data are added in one go
+            run = pos
+            while pos + self.block_size <= length:
+                end = pos + self.block_size
+                if buf.find(self.zero_block, pos, end) == pos:
+                    if run < pos:
+                        self.add(view[run:pos], False)
+                    self.add(view[pos:end], True)
+                    run = end
+                pos = end
+            if run < pos:
+                self.add(view[run:pos], False)
+        if pos < length:
+            self.partial = bytes(buf[pos:length])
+
+    def add(self, data, zero):
+        """Add whole blocks of data, or a final partial block"""
+        first = self.size // self.block_size
+        self.size += len(data)
+        if zero:
+            self.end_range()
+            return
+        if self.checksum is None:
+            self.checksum = hashlib.new(self.checksum_type)
+            self.ranges.append([ first, first, None ])
+        self.ranges[-1][1] = (self.size - 1) // self.block_size
+        self.checksum.update(data)
+
+    def end_range(self):
+        if self.checksum is not None:
+            self.ranges[-1][2] = self.checksum.hexdigest()
+            self.checksum = None
+
+    def finish(self):
+        """Return the Bmap of all the data seen"""
+        if self.partial:
+            block = self.partial
+            self.partial = b''
+            self.add(block, block == self.zero_block[:len(block)])
+        self.end_range()
+        return Bmap(self.size, self.block_size, self.ranges, self.checksum_type)
@@ -0,0 +1,405 @@
+#   Copyright 2014 Joseph Haig
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# The formats that images can be stored in. Each format is a Codec that
+# knows how to open a stream of the uncompressed image and what it can tell
+# about the image without decompressing it.
+import bz2
+import collections
+import concurrent.futures
+import gzip
+import io
+import lzma
+import os
+import struct
+import zipfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Errors that may be raised while reading a compressed image
+DECOMPRESSION_ERRORS = [ OSError, EOFError, zlib.error, lzma.LZMAError,
+                         zipfile.BadZipFile ]
+if zstandard is not None:
+    DECOMPRESSION_ERRORS.append(zstandard.ZstdError)
+DECOMPRESSION_ERRORS = tuple(DECOMPRESSION_ERRORS)
+
+# Blocked gzip files are made of many gzip members that can be decompressed
+# at the same time. Each member has an extra field, 'BK', with its length so
+# that the next one can be found without decompressing it. This is the same
+# idea as BGZF (as written by bgzip) whose 'BC' field is also understood,
+# but with much bigger members. An empty member with a 'BZ' field holding
+# the total size and CRC32 of the image ends the file.
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+GZIP_HEADER = struct.Struct('<2sBBIBBH')
+GZIP_MEMBER_HEADER_SIZE = GZIP_HEADER.size + 8
+GZIP_END_MEMBER_SIZE = GZIP_HEADER.size + 16 + 2 + 8
+# Empty member at the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# Decompressed members waiting to be read
+GZIP_READ_AHEAD = 2
+
+class Codec:
+    """A format that images can be stored in
+
+    file_format is the end of the file name, such as 'img.gz'. opener takes
+    the path of a file and returns a binary stream of the image. info, if
+    given, takes the path and returns a dictionary with any of:
+
+        'size':   The size of the uncompressed image
+        'exact':  True if the size is exact
+        'modulo': The size is only the real size modulo this
+        'crc32':  CRC32 of the uncompressed image
+
+    """
+    def __init__(self, file_format, opener, info=None):
+        self.file_format = file_format
+        self.opener = opener
+        self.info_function = info
+
+    def __str__(self):
+        return self.file_format
+
+    def open(self, path):
+        return self.opener(path)
+
+    def info(self, path):
+        if self.info_function is None:
+            return {}
+        return self.info_function(path)
+
+# Registered codecs, by file format
+codecs = {}
+
+def register(codec):
+    codecs[codec.file_format] = codec
+
+def get_codec(file_format):
+    """The Codec for a file format, or None if it is not known"""
+    return codecs.get(file_format)
+
+def image_format(filename):
+    """The file format of an image file name, or None if it is not an image
+
+    The longest matching format is used so that 'img.gz' is found rather
+    than some shorter format that it happens to end with.
+
+    """
+    found = None
+    for file_format in codecs:
+        if ( filename.endswith('.' + file_format)
+             and len(filename) > len(file_format) + 1
+             and (found is None or len(file_format) > len(found)) ):
+            found = file_format
+    return found
+
+def open_image(path, file_format):
+    """Open a stream of the uncompressed image, or None if the format is
+    not known"""
+    codec = get_codec(file_format)
+    if codec is None:
+        return None
+    return codec.open(path)
+
+###########################################################################
+
+def raw_info(path):
+    return { 'size': os.path.getsize(path), 'exact': True }
+
+def gzip_info(path):
+    with open(path, 'rb') as fl:
+        fl.seek(0, 2)
+        if fl.tell() >= GZIP_END_MEMBER_SIZE:
+            fl.seek(-GZIP_END_MEMBER_SIZE, 2)
+            end = gzip_extra(fl.read(GZIP_END_MEMBER_SIZE)).get(b'BZ')
+            if end is not None and len(end) == 12:
+                size, crc = struct.unpack('<QI', end)
+                return { 'size': size, 'exact': True, 'crc32': crc }
+        fl.seek(-len(BGZF_EOF), 2)
+        trailer = fl.read(len(BGZF_EOF))
+    if trailer == BGZF_EOF:
+        # The trailer is for the empty last member, not the whole image
+        return {}
+    # The CRC32 and the size modulo 4GiB are in the last 8 bytes
+    crc, size = struct.unpack('<II', trailer[-8:])
+    return { 'size': size, 'exact': False, 'modulo': 2**32, 'crc32': crc }
+
+def gzip_extra(header):
+    """The subfields of the extra field of a gzip member header, by id"""
+    fields = {}
+    if len(header) < GZIP_HEADER.size:
+        return fields
+    magic, method, flags, mtime, xfl, os_type, xlen = GZIP_HEADER.unpack_from(header)
+    if magic != b'\x1f\x8b' or not flags & 0x04:
+        return fields
+    extra = header[GZIP_HEADER.size:GZIP_HEADER.size + xlen]
+    pos = 0
+    while pos + 4 <= len(extra):
+        length, = struct.unpack('<H', extra[pos + 2:pos + 4])
+        fields[extra[pos:pos + 2]] = extra[pos + 4:pos + 4 + length]
+        pos += 4 + length
+    return fields
+
+def gzip_member_length(fl):
+    """Read the header of a blocked gzip member and return its length
+
+    The file is left where it was. Returns 0 at the end of the file and
+    None if the member does not say how long it is.
+
+    """
+    pos = fl.tell()
+    header = fl.read(GZIP_HEADER.size)
+    if len(header) == GZIP_HEADER.size:
+        xlen, = struct.unpack('<H', header[-2:])
+        header += fl.read(xlen)
+    fl.seek(pos)
+    if not header:
+        return 0
+    fields = gzip_extra(header)
+    if b'BK' in fields:
+        return struct.unpack('<I', fields[b'BK'])[0]
+    elif b'BC' in fields:
+        return struct.unpack('<H', fields[b'BC'])[0] + 1
+    elif b'BZ' in fields:
+        return GZIP_END_MEMBER_SIZE
+    return None
+
+def deflate(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_member(data, body, extra):
+    """A gzip member holding data, deflated into body, with an extra field"""
+    return ( GZIP_HEADER.pack(b'\x1f\x8b', 8, 0x04, 0, 0, 255, len(extra))
+             + extra + body
+             + struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff) )
+
+def gzip_block(data):
+    """Compress data into one member of a blocked gzip file"""
+    body = deflate(data)
+    length = GZIP_MEMBER_HEADER_SIZE + len(body) + 8
+    return gzip_member(data, body, b'BK' + struct.pack('<HI', 4, length))
+
+def is_blocked_gzip(path):
+    with open(path, 'rb') as fl:
+        return bool(gzip_member_length(fl))
+
+class ParallelGzipReader(io.RawIOBase):
+    """Decompress a blocked gzip file using all the cores
+
+    Members are read from the file and decompressed by a pool of threads,
+    as zlib does not need the GIL. Up to GZIP_READ_AHEAD members per thread
+    are decompressed ahead of the reader, which keeps the cores busy while
+    the data is being written to the cards without letting it use up all
+    the memory.
+
+    """
+    def __init__(self, fl, threads=None):
+        self.fl = fl
+        threads = threads or os.cpu_count() or 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.depth = threads * GZIP_READ_AHEAD
+        self.pending = collections.deque()
+        self.data = b''
+        self.pos = 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def fill(self):
+        """Queue more members to be decompressed"""
+        while not self.eof and len(self.pending) < self.depth:
+            length = gzip_member_length(self.fl)
+            if length == 0:
+                self.eof = True
+            elif length is None:
+                raise OSError("{0} is not a blocked gzip file".format(self.fl.name))
+            else:
+                member = self.fl.read(length)
+                if len(member) != length:
+                    raise EOFError("{0} ends part way through a member".format(self.fl.name))
+                self.pending.append(self.pool.submit(zlib.decompress, member,
+                                                     16 + zlib.MAX_WBITS))
+
+    def readinto(self, b):
+        with memoryview(b) as view, view.cast('B') as out:
+            n = 0
+            while n < len(out):
+                if self.pos == len(self.data):
+                    self.fill()
+                    if not self.pending:
+                        break
+                    self.data = self.pending.popleft().result()
+                    self.pos = 0
+                    continue
+                length = min(len(out) - n, len(self.data) - self.pos)
+                out[n:n + length] = self.data[self.pos:self.pos + length]
+                n += length
+                self.pos += length
+            return n
+
+    def close(self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.pool.shutdown()
+            self.fl.close()
+        super().close()
+
+def gzip_open(path):
+    fl = open(path, 'rb')
+    if gzip_member_length(fl):
+        return ParallelGzipReader(fl)
+    fl.close()
+    return gzip.open(path, 'rb')
+
+def compress_blocked_gzip(source, path, threads=None):
+    """Compress a stream of image data into a blocked gzip file
+
+    The blocks are compressed at the same time by a pool of threads. The
+    file is written to a temporary file first, which is removed if anything
+    goes wrong.
+
+    """
+    threads = threads or os.cpu_count() or 1
+    size = 0
+    crc = 0
+    tmp = path + '.tmp'
+    pending = collections.deque()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool, \
+             open(tmp, 'wb') as fl:
+            while True:
+                data = source.read(GZIP_BLOCK_SIZE)
+                if data:
+                    size += len(data)
+                    crc = zlib.crc32(data, crc)
+                    pending.append(pool.submit(gzip_block, data))
+                while pending and (not data or len(pending) >= threads * GZIP_READ_AHEAD):
+                    fl.write(pending.popleft().result())
+                if not data:
+                    break
+            fl.write(gzip_member(b'', deflate(b''), b'BZ' + struct.pack('<HQI', 12, size, crc)))
+        os.rename(tmp, path)
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def read_multibyte(data, pos):
+    """Read an xz variable length integer, returning it and the new pos"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+def xz_info(path):
+    """Add up the uncompressed sizes in the indexes of an xz file
+
+    Each stream of the file has its own index, so the streams are followed
+    back from the end of the file, over any padding between them.
+
+    """
+    size = 0
+    with open(path, 'rb') as fl:
+        end = fl.seek(0, 2)
+        while end > 0:
+            fl.seek(end - 4)
+            if fl.read(4) == bytes(4):
+                # Stream padding
+                end -= 4
+                continue
+            if end < 24:
+                return {}
+            fl.seek(end - 12)
+            footer = fl.read(12)
+            if footer[10:12] != b'YZ':
+                return {}
+            backward_size, = struct.unpack('<I', footer[4:8])
+            index_size = (backward_size + 1) * 4
+            if index_size > end - 24:
+                return {}
+            fl.seek(end - 12 - index_size)
+            index = fl.read(index_size)
+            if index[0] != 0:
+                return {}
+            records, pos = read_multibyte(index, 1)
+            blocks = 0
+            for i in range(records):
+                unpadded, pos = read_multibyte(index, pos)
+                uncompressed, pos = read_multibyte(index, pos)
+                size += uncompressed
+                blocks += (unpadded + 3) // 4 * 4
+            # Back over the blocks and header to the end of the stream before
+            end -= 12 + index_size + blocks + 12
+            if end < 0:
+                return {}
+    return { 'size': size, 'exact': True }
+
+def zip_member(zf):
+    """The member of a zip file that holds the image
+
+    This is the first one ending in '.img' or else the biggest.
+
+    """
+    members = [ m for m in zf.infolist() if not m.is_dir() ]
+    if not members:
+        raise zipfile.BadZipFile("No files in " + str(zf.filename))
+    for member in members:
+        if member.filename.lower().endswith('.img'):
+            return member
+    return max(members, key=lambda m: m.file_size)
+
+def zip_open(path):
+    # The member is read straight from the zip file without extracting it.
+    # It keeps the file open after the ZipFile itself is closed.
+    with zipfile.ZipFile(path) as zf:
+        return zf.open(zip_member(zf))
+
+def zip_info(path):
+    with zipfile.ZipFile(path) as zf:
+        member = zip_member(zf)
+        return { 'size': member.file_size, 'exact': True, 'crc32': member.CRC }
+
+def zstd_open(path):
+    fl = open(path, 'rb')
+    return zstandard.ZstdDecompressor().stream_reader(fl, closefd=True)
+
+def zstd_info(path):
+    with open(path, 'rb') as fl:
+        size = zstandard.frame_content_size(fl.read(18))
+    if size < 0:
+        return {}
+    return { 'size': size, 'exact': True }
+
+register(Codec('img', lambda path: open(path, 'rb'), raw_info))
+register(Codec('img.gz', gzip_open, gzip_info))
+register(Codec('img.xz', lambda path: lzma.open(path, 'rb'), xz_info))
+register(Codec('img.bz2', lambda path: bz2.open(path, 'rb')))
+register(Codec('zip', zip_open, zip_info))
+if zstandard is not None:
+    register(Codec('img.zst', zstd_open, zstd_info))
@@ -0,0 +1,252 @@
+#   Copyright 2014 Joseph Haig
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# Changes made to the boot partition of each card as it is written, from the
+# image's .custom file, so that cards can be set up without mounting them
+# after writing. The changes are worked out on an Overlay of the blocks of
+# the image that they affect and written over the image data on its way to
+# the card.
+import os
+import string
+import threading
+import lib.fat as fat
+
+# Size of the blocks of the image kept by ImageBlocks
+CACHE_BLOCK_SIZE = 4096
+
+# Size of the blocks that changes are kept in
+OVERLAY_BLOCK_SIZE = 512
+
+# Partition types that can hold a FAT filesystem
+FAT_TYPES = [ '1', '4', '6', 'b', 'c', 'e',
+              # GPT basic data and EFI system partitions
+              'ebd0a0a2-b9e5-4433-87c0-68b6b72699c7',
+              'c12a7328-f81f-11d2-ba4b-00a0c93ec93b' ]
+
+class CustomiseError(Exception):
+    pass
+
+class ImageBlocks:
+    """Random access to the uncompressed data of an image
+
+    The image is read from the start with open_function, which returns a
+    stream of the data, and only the blocks that are asked for are kept.
+    Reading backwards means starting again, but the changes only need a
+    small part of the start of the image, mostly in order.
+
+    """
+    def __init__(self, open_function):
+        self.open_function = open_function
+        self.lock = threading.Lock()
+        self.blocks = {}
+        self.source = None
+        self.pos = 0
+
+    def read(self, offset, length):
+        with self.lock:
+            first = offset // CACHE_BLOCK_SIZE
+            last = (offset + length - 1) // CACHE_BLOCK_SIZE
+            data = b''.join(self.block(n) for n in range(first, last + 1))
+        start = offset - first * CACHE_BLOCK_SIZE
+        return data[start:start + length]
+
+    def block(self, n):
+        if n not in self.blocks:
+            start = n * CACHE_BLOCK_SIZE
+            if self.source is None or self.pos > start:
+                self.close()
+                self.source = self.open_function()
+                if self.source is None:
+                    raise CustomiseError("Cannot open the image")
+                self.pos = 0
+            while self.pos < start:
+                skipped = self.source.read(min(start - self.pos, 1024 * 1024))
+                if not skipped:
+                    break
+                self.pos += len(skipped)
+            data = b''
+            while len(data) < CACHE_BLOCK_SIZE:
+                more = self.source.read(CACHE_BLOCK_SIZE - len(data))
+                if not more:
+                    break
+                data += more
+            self.pos += len(data)
+            self.blocks[n] = data + bytes(CACHE_BLOCK_SIZE - len(data))
+        return self.blocks[n]
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+class Overlay:
+    """Changes to a disk kept in memory, on top of a base to read from"""
+    def __init__(self, base):
+        self.base = base
+        self.blocks = {}
+
+    def read(self, offset, length):
+        data = bytearray()
+        pos = offset
+        end = offset + length
+        while pos < end:
+            n = pos // OVERLAY_BLOCK_SIZE
+            block_end = min((n + 1) * OVERLAY_BLOCK_SIZE, end)
+            if n in self.blocks:
+                start = pos - n * OVERLAY_BLOCK_SIZE
+                data += self.blocks[n][start:start + block_end - pos]
+            else:
+                # Read as much as possible from the base at once
+                while block_end < end and block_end // OVERLAY_BLOCK_SIZE not in self.blocks:
+                    block_end = min(block_end + OVERLAY_BLOCK_SIZE, end)
+                data += self.base.read(pos, block_end - pos)
+            pos = block_end
+        return bytes(data)
+
+    def write(self, offset, data):
+        pos = 0
+        while pos < len(data):
+            n = (offset + pos) // OVERLAY_BLOCK_SIZE
+            start = offset + pos - n * OVERLAY_BLOCK_SIZE
+            length = min(OVERLAY_BLOCK_SIZE - start, len(data) - pos)
+            if n not in self.blocks:
+                if length == OVERLAY_BLOCK_SIZE:
+                    self.blocks[n] = bytearray(OVERLAY_BLOCK_SIZE)
+                else:
+                    self.blocks[n] = bytearray(self.base.read(n * OVERLAY_BLOCK_SIZE,
+                                                              OVERLAY_BLOCK_SIZE))
+            self.blocks[n][start:start + length] = data[pos:pos + length]
+            pos += length
+
+    def extents(self):
+        """The changed data as a list of (offset, data), in order"""
+        extents = []
+        for n in sorted(self.blocks):
+            offset = n * OVERLAY_BLOCK_SIZE
+            if extents and extents[-1][0] + len(extents[-1][1]) == offset:
+                extents[-1][1].extend(self.blocks[n])
+            else:
+                extents.append((offset, bytearray(self.blocks[n])))
+        return [ (offset, bytes(data)) for offset, data in extents ]
+
+def read_custom(path, environment):
+    """Read the changes listed in a .custom file
+
+    Each line is one of:
+
+        partition <number>          - Partition to change, instead of the
+                                      first FAT partition
+        copy <file> [<name>]        - Copy a file from the image directory
+        write <name> [<text>]       - Make a file holding a line of text
+        set <name> <key>=<value>    - Set a key in a file of key=value lines
+
+    $VARIABLE and ${VARIABLE} are replaced by the values of the variables.
+    Returns the partition number, or None, and a list of the changes as
+    tuples.
+
+    """
+    partition = None
+    changes = []
+    with open(path) as fl:
+        for n, line in enumerate(fl):
+            line = string.Template(line.strip()).safe_substitute(environment)
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 2)
+            command = parts[0]
+            if command == 'partition' and len(parts) == 2 and parts[1].isdigit():
+                partition = int(parts[1])
+            elif command == 'copy' and len(parts) in (2, 3):
+                source = os.path.join(os.path.dirname(path), parts[1])
+                changes.append(('copy', source, parts[-1] if len(parts) == 3
+                                                else os.path.basename(parts[1])))
+            elif command == 'write' and len(parts) >= 2:
+                changes.append(('write', parts[1], parts[2] if len(parts) == 3 else None))
+            elif command == 'set' and len(parts) == 3 and '=' in parts[2]:
+                changes.append(('set', parts[1], parts[2]))
+            else:
+                raise CustomiseError("{0} line {1}: cannot understand '{2}'".format(
+                                                    path, n + 1, line))
+    return partition, changes
+
+def set_key(text, setting):
+    """Set key=value in a file of such lines, adding it if it is not there"""
+    key = setting.split('=', 1)[0].strip()
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        if line.split('=', 1)[0].strip() == key and '=' in line:
+            lines[i] = setting
+            break
+    else:
+        lines.append(setting)
+    return '\n'.join(lines) + '\n'
+
+def boot_partition(table, number=None):
+    """The partition to change from an image's partition table"""
+    if not table:
+        raise CustomiseError("The image has no partition table")
+    for p in table['partitions']:
+        if number is not None and p['number'] == number:
+            return p
+        if number is None and p['type'] in FAT_TYPES:
+            return p
+    if number is None:
+        raise CustomiseError("The image has no FAT partition")
+    raise CustomiseError("The image has no partition {0}".format(number))
+
+def apply_changes(disk, offset, changes):
+    """Make the changes to the FAT filesystem at offset on disk"""
+    filesystem = fat.Fat(disk, offset)
+    for change in changes:
+        if change[0] == 'copy':
+            with open(change[1], 'rb') as fl:
+                filesystem.write_file(change[2], fl.read())
+        elif change[0] == 'write':
+            text = change[2] + '\n' if change[2] is not None else ''
+            filesystem.write_file(change[1], text.encode('utf-8'))
+        elif change[0] == 'set':
+            old = filesystem.read_file(change[1]) or b''
+            text = set_key(old.decode('utf-8', 'replace'), change[2])
+            filesystem.write_file(change[1], text.encode('utf-8'))
+
+# The blocks read from the last image that was customised, so that they do
+# not have to be read again for every card
+cache = { 'key': None, 'blocks': None }
+cache_lock = threading.Lock()
+
+def card_overlay(path, table, environment, open_function, key=None):
+    """Work out the changes to one card
+
+    path is the .custom file and table the partition table of the image,
+    which is read with open_function. The blocks read are kept for the
+    next card if key, which should change when the image does, is the same.
+
+    Returns a list of (offset, data) to write over the image.
+
+    """
+    number, changes = read_custom(path, environment)
+    partition = boot_partition(table, number)
+    with cache_lock:
+        if key is None or cache['key'] != key:
+            cache['key'] = key
+            cache['blocks'] = ImageBlocks(open_function)
+        blocks = cache['blocks']
+        overlay = Overlay(blocks)
+        try:
+            apply_changes(overlay, partition['start'], changes)
+        except (fat.FatError, OSError) as e:
+            raise CustomiseError(str(e))
+        finally:
+            blocks.close()
+    return overlay.extents()
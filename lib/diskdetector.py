@@ -14,126 +14,176 @@
 #
 # Much of this is based on code found in the pifacecad library
 # (Thanks, guys)
-import multiprocessing
 import threading
+import selectors
 import pyudev
-import sys
-import time
-import subprocess
+import os
+import fcntl
+import struct
 import lib.utils as utils
 
-class DiskFunctionMap(object):
-    """Map actions to callback functions"""
-    def __init__(self, action, callback):
-        self.action = action
-        self.callback = callback
+# ioctl to get the size of a block device in bytes, from linux/fs.h
+BLKGETSIZE64 = 0x80081272
 
-    def __str__(self):
-        s = "Action:  {action}\n"
-        return s.format(action=self.action)
+# How often, in milliseconds, the kernel checks a reader for a new card if
+# it has not been set already. It then sends a udev change event when a card
+# is inserted or removed.
+EVENTS_POLL_MSECS = 1000
 
 class DiskEventListener(utils.SelectList):
-    """Listen for disk events"""
+    """Listen for disk events
+
+    A single thread waits on the udev netlink socket, and a pipe used to
+    stop it, and calls the registered functions for each event as it
+    arrives.
 
-    TERMINATE_SIGNAL = 1
+    """
 
     def __init__(self):
         utils.SelectList.__init__(self)
-        self.function_maps = list()
-        self.queue = multiprocessing.Queue()
+        # Callbacks by action, replaced whole when one is registered so
+        # that events are dispatched without a lock
+        self.actions = {}
+        # Drives by device path and by where they are plugged in
+        self.paths = {}
+        self.ids = {}
+
+        # Start listening before the devices are listed so that nothing
+        # that happens in between is missed
+        self.context = pyudev.Context()
+        self.monitor = pyudev.Monitor.from_netlink(self.context)
+        self.monitor.filter_by('block', 'disk')
+        self.monitor.start()
 
         # Get list of mounted devices
-        self.context = pyudev.Context()
         #self.devices = []
         for device in self.context.list_devices(subsystem='block', DEVTYPE='disk'):
-            major = device['MAJOR']
-            if major == '8' or major == '3':
-                self.append(utils.Drive(device.device_node, device['ID_MODEL']))
-
-        self.set_disk_detector()
-        self.device_detector = multiprocessing.Process(
-            target=watch_device_events,
-            args=(self.queue, self.context))
-        self.dispatcher = threading.Thread(
-            target=handle_events,
-            args=(
-                self.queue,
-                event_matches_function_map,
-                self.function_maps,
-                DiskEventListener.TERMINATE_SIGNAL))
+            if is_reader(device):
+                drive = utils.Drive(device.device_node, device.get('ID_MODEL'),
+                                    device.get('ID_PATH'))
+                drive.present = disk_present(device.device_node)
+                enable_media_polling(device)
+                self.append(drive)
+
+        self.selector = selectors.DefaultSelector()
+        self.stop_read, self.stop_write = os.pipe()
+        self.selector.register(self.monitor, selectors.EVENT_READ)
+        self.selector.register(self.stop_read, selectors.EVENT_READ)
+        self.watcher = threading.Thread(target=self.watch)
+        self.watcher.daemon = True
         #self.disks = []
         self.register('add_disk', self.add_disk)
         self.register('remove_disk', self.remove_disk)
         self.register('add_device', self.add_device)
         self.register('remove_device', self.remove_device)
 
-    def set_disk_detector(self):
-        restart = 0
-        try:
-            self.disk_detector.terminate()
-            self.disk_detector.join()
-            restart = 1
-        except AttributeError:
-            pass
-
-        self.disk_detector = multiprocessing.Process(
-            target=watch_disk_events,
-            args=(self.queue, [ d.path for d in self ]))
-            #args=(self.queue, self.devices))
-
-        if restart:
-            self.disk_detector.start()
-
     def register(self, action, callback):
-        self.function_maps.append( DiskFunctionMap (action, callback) )
+        actions = dict(self.actions)
+        actions[action] = actions.get(action, ()) + (callback,)
+        self.actions = actions
 
     def activate(self):
-        self.disk_detector.start()
-        self.device_detector.start()
-        self.dispatcher.start()
+        self.watcher.start()
 
     def deactivate(self):
-        self.queue.put(self.TERMINATE_SIGNAL)
-        self.dispatcher.join()
-        self.disk_detector.terminate()
-        self.disk_detector.terminate()
-        self.disk_detector.join()
-        self.disk_detector.join()
+        os.write(self.stop_write, b'x')
+        self.watcher.join()
+        self.selector.close()
+        os.close(self.stop_read)
+        os.close(self.stop_write)
+
+    def watch(self):
+        """Handle events until deactivated"""
+        while True:
+            for key, mask in self.selector.select():
+                if key.fileobj == self.stop_read:
+                    return
+                # Handle everything that is waiting
+                device = self.monitor.poll(timeout=0)
+                while device is not None:
+                    for event in device_events(device):
+                        self.dispatch(event)
+                    device = self.monitor.poll(timeout=0)
+
+    def dispatch(self, event):
+        if not self.is_change(event):
+            return
+        for callback in self.actions.get(event.action, ()):
+            callback(event)
+
+    def is_change(self, event):
+        """Whether a disk event changes whether there is a card in a drive
+
+        The kernel also sends change events for a card that is still there,
+        for example when a device is closed after being written or its
+        partition table is read again, and these are not insertions. Disks
+        that are not in a known card reader are never cards.
+
+        """
+        if event.action != 'add_disk' and event.action != 'remove_disk':
+            return True
+        d = self.find(event.device, event.id_path)
+        if d is None:
+            return False
+        return d.present != (event.action == 'add_disk')
+
+    def append(self, drive):
+        super().append(drive)
+        self.paths[drive.path] = drive
+        self.ids[drive.id_path] = drive
+
+    def remove(self, drive):
+        super().remove(drive)
+        if self.paths.get(drive.path) is drive:
+            del self.paths[drive.path]
+        if self.ids.get(drive.id_path) is drive:
+            del self.ids[drive.id_path]
 
     def add_disk(self, event):
-        d = self.find(event.device)
+        d = self.find(event.device, event.id_path)
         if d != None:
             d.present = True
 
     def remove_disk(self, event):
-        d = self.find(event.device)
+        d = self.find(event.device, event.id_path)
         if d != None:
             d.present = False
 
     def add_device(self, event):
-        if self.find(event.device):
-            print(event.device + ' is already in the list!')
-            sys.exit(1)
-        else:
-            self.append(utils.Drive(event.device, event.model))
-            self.set_disk_detector()
+        with self.lock:
+            d = self.ids.get(event.id_path or event.device)
+            stale = self.paths.get(event.device)
+            if stale is not None and stale is not d:
+                # The kernel has given the path to another device so the one
+                # that had it must have gone
+                print(event.device + ' has been reused')
+                self.remove(stale)
+            if d is not None:
+                # The same device again, possibly at a new path
+                if self.paths.get(d.path) is d:
+                    del self.paths[d.path]
+                d.path = event.device
+                d.model = event.model
+                self.paths[d.path] = d
+                self.updated = True
+            else:
+                self.append(utils.Drive(event.device, event.model, event.id_path))
 
     def remove_device(self, event):
-        d = self.find(event.device)
-        if d != None:
-            self.remove(d)
-            if self.pointer <= len(self):
-                self.pointer = 0
-            self.set_disk_detector()
-        else:
-            print(event.device + ' is not in the list!')
-            sys.exit(1)
-
-    def find(self, dev):
-        for d in self:
-            if dev == d.path:
-                return d
-        return None
+        with self.lock:
+            d = self.find(event.device, event.id_path)
+            if d != None:
+                self.remove(d)
+                if self.pointer <= len(self):
+                    self.pointer = 0
+            else:
+                print(event.device + ' is not in the list!')
+
+    def find(self, dev, id_path=None):
+        """Find a drive by where it is plugged in or else by its path"""
+        if id_path is not None and id_path in self.ids:
+            return self.ids[id_path]
+        return self.paths.get(dev)
 
     def device_present(self, n):
         if n < len(self):
@@ -143,10 +193,11 @@ class DiskEventListener(utils.SelectList):
 
 class DeviceEvent(object):
     """A device event"""
-    def __init__(self, action, device, model = None):
+    def __init__(self, action, device, model = None, id_path = None):
         self.action = action
         self.device = device
         self.model = model
+        self.id_path = id_path
 
     def __str__(self):
         s = "action: {action}\n" \
@@ -155,62 +206,78 @@ class DeviceEvent(object):
 
 ###########################################################################
 
-def watch_device_events(queue, context):
-    """Watch for new devices
+def device_events(device):
+    """The events for a udev event on a block disk
 
     Detect when a new USB device has been added. In the case of an SD card
     reader, for example, this may appear even when an actual card is not
-    present. The function watch_disk_events will then check existing devices
-    for the actual disk.
+    present. Cards being inserted into or removed from a reader are seen as
+    change events, which the kernel sends when it polls the reader (see
+    enable_media_polling), and disk_present then says which it was.
 
     """
+    events = []
+    if not is_reader(device):
+        return events
+    action = device.action
+    node = device.device_node
+    id_path = device.get('ID_PATH')
+    if action == 'add' or action == 'remove':
+        events.append(DeviceEvent(action + "_device", node, device.get('ID_MODEL'), id_path))
+        if action == 'add':
+            enable_media_polling(device)
+            if disk_present(node):
+                events.append(DeviceEvent('add_disk', node, id_path = id_path))
+    elif action == 'change':
+        if disk_present(node):
+            events.append(DeviceEvent('add_disk', node, id_path = id_path))
+        else:
+            events.append(DeviceEvent('remove_disk', node, id_path = id_path))
+    return events
 
-    monitor = pyudev.Monitor.from_netlink(context)
-    monitor.filter_by('block', 'disk')
-    for action, device in monitor:
-        if action == 'add' or action == 'remove':
-            queue.put(DeviceEvent(action + "_device", device.device_node, device['ID_MODEL']))
-
-def watch_disk_events(queue, devices):
-    """Watch for new disks
+def is_reader(device):
+    """Whether a block disk is a SCSI or IDE disk, as card readers are
 
-    A USB-SD adapter may appear in /dev even if there is no SD present. This
-    function uses fdisk to check if a card has been inserted.
+    Loop, zram, nbd and the Pi's own MMC card are left alone.
 
     """
-    on = [0]*len(devices)
-    actions = [ 'remove_disk', 'add_disk' ]
-    while True:
-        for i in range(len(devices)):
-            probe = subprocess.Popen(['fdisk', '-l', devices[i]], stdout=subprocess.PIPE)
-            count = 0
-            for line in probe.stdout:
-                # Maybe use this output later?
-                count += 1
-            if ( on[i] == 0 and count > 0 ) or ( on[i] == 1 and count == 0 ):
-                on[i] = 1 - on[i]
-                queue.put(DeviceEvent(actions[on[i]], devices[i]))
-        time.sleep(1)
-
-def handle_events(queue, event_matches_function_map,
-                       function_maps, terminate_signal):
-    """Handle events"""
-    while True:
-        event = queue.get()
-
-        if event == terminate_signal:
-            return
+    major = device.get('MAJOR')
+    return major == '8' or major == '3'
 
-        functions = map(
-            lambda fm: fm.callback
-            if event_matches_function_map(event, fm) else None,
-            function_maps)
-        functions = filter(lambda f: f is not None, functions)
+def disk_present(path):
+    """Check whether there is a disk in a device
 
-        for function in functions:
-            function(event)
+    A reader with no card in it has a size of 0, or cannot be opened at all.
+    The size is read with an ioctl, which is much cheaper than reading the
+    partition table.
 
-def event_matches_function_map(event, function_map):
-    action_match = event.action == function_map.action
-    return action_match
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        size = struct.unpack('Q', fcntl.ioctl(fd, BLKGETSIZE64, bytes(8)))[0]
+    except OSError:
+        size = 0
+    finally:
+        os.close(fd)
+    return size > 0
+
+def enable_media_polling(device):
+    """Make the kernel poll a device for media changes if it does not already
+
+    Without this, many USB card readers never send a change event when a
+    card is inserted. Polling is done in the kernel so it costs much less
+    than checking the device from here.
 
+    """
+    poll = os.path.join(device.sys_path, 'events_poll_msecs')
+    try:
+        with open(poll) as fl:
+            msecs = int(fl.read())
+        if msecs <= 0:
+            with open(poll, 'w') as fl:
+                fl.write(str(EVENTS_POLL_MSECS))
+    except (OSError, ValueError):
+        pass
@@ -0,0 +1,364 @@
+#   Copyright 2014 Joseph Haig
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# Just enough of the FAT16 and FAT32 filesystems to read and replace files,
+# such as config.txt in the boot partition of a Raspberry Pi image, without
+# mounting anything. The filesystem is read and written through any object
+# with read(offset, length) and write(offset, data) methods.
+import struct
+import time
+
+ENTRY_SIZE = 32
+
+# Directory entry attributes
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0f
+
+FREE_ENTRY = 0xe5
+END_ENTRY = 0x00
+
+# Characters in a long name entry
+LFN_CHARS = 13
+
+class FatError(Exception):
+    pass
+
+def short_name_checksum(short):
+    total = 0
+    for c in short:
+        total = (((total & 1) << 7) + (total >> 1) + c) & 0xff
+    return total
+
+def dos_time(t):
+    """Date and time in the form used in directory entries"""
+    tm = time.localtime(t)
+    return ( (tm.tm_hour << 11) | (tm.tm_min << 5) | (tm.tm_sec // 2),
+             ((max(tm.tm_year, 1980) - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday )
+
+class Fat:
+    """A FAT16 or FAT32 filesystem starting at offset on a disk
+
+    Changes to the file allocation table are kept until flush is called,
+    which writes the changed sectors of every copy of the table.
+
+    """
+    def __init__(self, disk, offset=0):
+        self.disk = disk
+        boot = disk.read(offset, 512)
+        if len(boot) < 512 or boot[510:512] != b'\x55\xaa':
+            raise FatError("No FAT filesystem at {0}".format(offset))
+        ( self.sector_size, self.cluster_sectors, reserved, self.n_fats,
+          root_entries, total16 ) = struct.unpack_from('<HBHBHH', boot, 11)
+        fat_size16, = struct.unpack_from('<H', boot, 22)
+        total32, fat_size32 = struct.unpack_from('<II', boot, 32)
+        self.root_cluster, = struct.unpack_from('<I', boot, 44)
+        if self.sector_size not in (512, 1024, 2048, 4096) or not self.cluster_sectors:
+            raise FatError("No FAT filesystem at {0}".format(offset))
+        fat_sectors = fat_size16 or fat_size32
+        total = total16 or total32
+        root_sectors = (root_entries * ENTRY_SIZE + self.sector_size - 1) // self.sector_size
+        data_sector = reserved + self.n_fats * fat_sectors + root_sectors
+        self.n_clusters = (total - data_sector) // self.cluster_sectors
+        if self.n_clusters < 4085:
+            raise FatError("FAT12 is not supported")
+        self.fat32 = self.n_clusters >= 65525
+        if not self.fat32:
+            self.root_cluster = None
+        self.cluster_size = self.sector_size * self.cluster_sectors
+        self.fat_offset = offset + reserved * self.sector_size
+        self.fat_bytes = fat_sectors * self.sector_size
+        self.root_offset = offset + (reserved + self.n_fats * fat_sectors) * self.sector_size
+        self.root_entries = root_entries
+        self.data_offset = offset + data_sector * self.sector_size
+        self.fsinfo = None
+        if self.fat32:
+            self.fsinfo = offset + struct.unpack('<H', boot[48:50])[0] * self.sector_size
+        self.entry_bytes = 4 if self.fat32 else 2
+        used = (self.n_clusters + 2) * self.entry_bytes
+        self.fat = bytearray(disk.read(self.fat_offset, used))
+        # Offsets in the table of sectors that have changed
+        self.dirty = set()
+
+    # The file allocation table
+
+    def entry(self, n):
+        if self.fat32:
+            return struct.unpack_from('<I', self.fat, n * 4)[0] & 0x0fffffff
+        return struct.unpack_from('<H', self.fat, n * 2)[0]
+
+    def set_entry(self, n, value):
+        if self.fat32:
+            # The top four bits are reserved
+            old = struct.unpack_from('<I', self.fat, n * 4)[0]
+            struct.pack_into('<I', self.fat, n * 4, (old & 0xf0000000) | value)
+        else:
+            struct.pack_into('<H', self.fat, n * 2, value)
+        self.dirty.add(n * self.entry_bytes // self.sector_size * self.sector_size)
+
+    def end_of_chain(self):
+        return 0x0fffffff if self.fat32 else 0xffff
+
+    def is_end(self, value):
+        return value >= (0x0ffffff8 if self.fat32 else 0xfff8) or value < 2
+
+    def chain(self, first):
+        """The clusters of a file, in order"""
+        clusters = []
+        n = first
+        while not self.is_end(n):
+            if n >= self.n_clusters + 2 or len(clusters) > self.n_clusters:
+                raise FatError("Broken cluster chain at {0}".format(n))
+            clusters.append(n)
+            n = self.entry(n)
+        return clusters
+
+    def allocate(self, count, after=None):
+        """Take count free clusters and link them together
+
+        If given, the new clusters are added to the end of the chain whose
+        last cluster is after. Returns the list of clusters.
+
+        """
+        clusters = []
+        for n in range(2, self.n_clusters + 2):
+            if len(clusters) == count:
+                break
+            if self.entry(n) == 0:
+                clusters.append(n)
+        if len(clusters) < count:
+            raise FatError("Not enough space")
+        for a, b in zip(clusters, clusters[1:]):
+            self.set_entry(a, b)
+        if clusters:
+            self.set_entry(clusters[-1], self.end_of_chain())
+            if after is not None:
+                self.set_entry(after, clusters[0])
+        return clusters
+
+    def free(self, first):
+        for n in self.chain(first):
+            self.set_entry(n, 0)
+
+    def cluster_offset(self, n):
+        return self.data_offset + (n - 2) * self.cluster_size
+
+    def flush(self):
+        """Write the changed parts of the allocation table"""
+        for pos in sorted(self.dirty):
+            sector = bytes(self.fat[pos:pos + self.sector_size])
+            for i in range(self.n_fats):
+                self.disk.write(self.fat_offset + i * self.fat_bytes + pos, sector)
+        self.dirty = set()
+        if self.fsinfo is not None:
+            # The free cluster count is no longer right, so say that it is
+            # not known
+            self.disk.write(self.fsinfo + 488, b'\xff' * 8)
+
+    # Directories, which are either the FAT16 root directory or a chain of
+    # clusters given by its first cluster
+
+    def slots(self, directory):
+        """Offsets of the entries of a directory"""
+        if directory is None and not self.fat32:
+            return [ self.root_offset + i * ENTRY_SIZE for i in range(self.root_entries) ]
+        if directory is None:
+            directory = self.root_cluster
+        per_cluster = self.cluster_size // ENTRY_SIZE
+        return [ self.cluster_offset(n) + i * ENTRY_SIZE
+                 for n in self.chain(directory) for i in range(per_cluster) ]
+
+    def listdir(self, directory=None):
+        """The entries of a directory as dictionaries
+
+        Each has the 'name', the 'short' name as it is stored, 'attr',
+        'cluster', 'size', the 'offset' of its entry and the offsets of all
+        the 'slots' that it uses, including for the long name.
+
+        """
+        entries = []
+        long_name = {}
+        slots = self.slots(directory)
+        for offset in slots:
+            raw = self.disk.read(offset, ENTRY_SIZE)
+            if raw[0] == END_ENTRY:
+                break
+            if raw[0] == FREE_ENTRY:
+                long_name = {}
+                continue
+            if raw[11] == ATTR_LONG_NAME:
+                if raw[0] & 0x40:
+                    long_name = { 'parts': {}, 'checksum': raw[13], 'slots': [] }
+                if long_name:
+                    part = raw[1:11] + raw[14:26] + raw[28:32]
+                    long_name['parts'][raw[0] & 0x1f] = part
+                    long_name['slots'].append(offset)
+                continue
+            short = bytes(raw[0:11])
+            name = self.short_to_name(short, raw[12])
+            used = [ offset ]
+            if long_name and long_name['checksum'] == short_name_checksum(short):
+                data = b''.join(long_name['parts'][i] for i in sorted(long_name['parts']))
+                name = data.decode('utf-16-le', 'replace').split('\0')[0]
+                used = long_name['slots'] + used
+            long_name = {}
+            if raw[11] & 0x08:
+                # Volume label
+                continue
+            hi, lo, size = struct.unpack('<H4xHI', raw[20:32])
+            entries.append( { 'name': name,
+                              'short': short,
+                              'attr': raw[11],
+                              'cluster': (hi << 16) | lo if self.fat32 else lo,
+                              'size': size,
+                              'offset': offset,
+                              'slots': used } )
+        return entries
+
+    def short_to_name(self, short, case):
+        base = short[0:8].decode('ascii', 'replace').rstrip()
+        ext = short[8:11].decode('ascii', 'replace').rstrip()
+        # Windows NT keeps whether the parts are lower case in byte 12
+        if case & 0x08:
+            base = base.lower()
+        if case & 0x10:
+            ext = ext.lower()
+        if ext:
+            return base + '.' + ext
+        return base
+
+    def lookup(self, path):
+        """The entry for a path, or None, and the directory it is in"""
+        parts = [ p for p in path.split('/') if p ]
+        if not parts:
+            raise FatError("No file name in '{0}'".format(path))
+        directory = None
+        for i, part in enumerate(parts):
+            found = None
+            for entry in self.listdir(directory):
+                if entry['name'].lower() == part.lower():
+                    found = entry
+                    break
+            if i == len(parts) - 1:
+                return found, directory
+            if found is None or not found['attr'] & ATTR_DIRECTORY:
+                raise FatError("No directory '{0}'".format('/'.join(parts[:i+1])))
+            directory = found['cluster'] or None
+
+    # Files
+
+    def read_file(self, path):
+        """Contents of a file, or None if there is no such file"""
+        entry, directory = self.lookup(path)
+        if entry is None:
+            return None
+        if entry['attr'] & ATTR_DIRECTORY:
+            raise FatError("'{0}' is a directory".format(path))
+        data = b''.join(self.disk.read(self.cluster_offset(n), self.cluster_size)
+                        for n in self.chain(entry['cluster']))
+        return data[:entry['size']]
+
+    def write_file(self, path, data, now=None):
+        """Replace a file, or make a new one, with data"""
+        entry, directory = self.lookup(path)
+        if entry is not None:
+            if entry['attr'] & ATTR_DIRECTORY:
+                raise FatError("'{0}' is a directory".format(path))
+            if entry['cluster']:
+                self.free(entry['cluster'])
+        else:
+            entry = self.new_entry(directory, path.split('/')[-1])
+        count = (len(data) + self.cluster_size - 1) // self.cluster_size
+        clusters = self.allocate(count)
+        for i, n in enumerate(clusters):
+            part = data[i * self.cluster_size:(i + 1) * self.cluster_size]
+            self.disk.write(self.cluster_offset(n), part + bytes(self.cluster_size - len(part)))
+        first = clusters[0] if clusters else 0
+        raw = bytearray(self.disk.read(entry['offset'], ENTRY_SIZE))
+        tm, dt = dos_time(now if now is not None else time.time())
+        struct.pack_into('<H', raw, 18, dt)
+        struct.pack_into('<HHHHI', raw, 20, first >> 16 if self.fat32 else 0, tm, dt,
+                         first & 0xffff, len(data))
+        self.disk.write(entry['offset'], bytes(raw))
+        self.flush()
+
+    def new_entry(self, directory, name):
+        """Make the directory entries for a new file"""
+        short = self.short_name(directory, name)
+        if self.short_to_name(short, 0) == name:
+            names = []
+        else:
+            # A long name is needed to keep the case or length of the name
+            encoded = name.encode('utf-16-le') + b'\0\0'
+            encoded += b'\xff' * (-len(encoded) % (LFN_CHARS * 2))
+            names = [ encoded[i:i + LFN_CHARS * 2]
+                      for i in range(0, len(encoded), LFN_CHARS * 2) ]
+        slots = self.free_slots(directory, len(names) + 1)
+        checksum = short_name_checksum(short)
+        for i in range(len(names)):
+            # The long name entries come last part first
+            sequence = len(names) - i
+            part = names[sequence - 1]
+            if i == 0:
+                sequence |= 0x40
+            raw = ( bytes([ sequence ]) + part[0:10] + bytes([ ATTR_LONG_NAME, 0, checksum ])
+                    + part[10:22] + b'\0\0' + part[22:26] )
+            self.disk.write(slots[i], raw)
+        raw = short + bytes([ ATTR_ARCHIVE ]) + bytes(ENTRY_SIZE - 12)
+        self.disk.write(slots[-1], raw)
+        return { 'offset': slots[-1] }
+
+    def short_name(self, directory, name):
+        """A unique 8.3 name for a new file"""
+        if '.' in name[1:]:
+            base, ext = name.rsplit('.', 1)
+        else:
+            base, ext = name, ''
+        def clean(text):
+            return ''.join(c for c in text.upper()
+                           if c.isalnum() or c in "$%'-_@~`!(){}^#&").encode('ascii', 'ignore')
+        base, ext = clean(base), clean(ext)[:3]
+        taken = set(entry['short'] for entry in self.listdir(directory))
+        short = base.ljust(8)[:8] + ext.ljust(3)
+        if len(base) <= 8 and short not in taken and base:
+            return short
+        for i in range(1, 1000000):
+            tail = '~{0}'.format(i).encode('ascii')
+            short = (base[:8 - len(tail)] + tail).ljust(8) + ext.ljust(3)
+            if short not in taken:
+                return short
+        raise FatError("No short name for '{0}'".format(name))
+
+    def free_slots(self, directory, count):
+        """Offsets of count free entries in a row in a directory"""
+        slots = self.slots(directory)
+        run = []
+        for offset in slots:
+            first = self.disk.read(offset, 1)[0]
+            if first == FREE_ENTRY or first == END_ENTRY:
+                run.append(offset)
+                if len(run) == count:
+                    return run
+            else:
+                run = []
+        if directory is None and not self.fat32:
+            raise FatError("Root directory is full")
+        # Add a cluster to the end of the directory
+        last = self.chain(directory or self.root_cluster)[-1]
+        n = self.allocate(1, after=last)[0]
+        self.disk.write(self.cluster_offset(n), bytes(self.cluster_size))
+        self.flush()
+        slots = run + [ self.cluster_offset(n) + i * ENTRY_SIZE
+                        for i in range(self.cluster_size // ENTRY_SIZE) ]
+        return slots[:count]
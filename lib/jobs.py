@@ -0,0 +1,387 @@
+#   Copyright 2014 Joseph Haig
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# Writes running in the background, and batches of cards to write without
+# anyone pressing buttons. A job says to write an image to the next so many
+# cards that are inserted, and the Scheduler starts writing each card as
+# soon as it is seen.
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import lib.utils as utils
+
+# File in the image source directory that holds the jobs
+JOBS_FILE = '.bakery-jobs.json'
+
+# Number of cards in a batch started from the display
+BATCH_SIZE = 20
+
+# Number of writes that can run at the same time
+MAX_WRITES = 5
+
+# Number of cards of a job that can fail before the job is given up
+MAX_FAILURES = 5
+
+class JobQueue:
+    """Jobs waiting to be done, kept in a file so that they survive restarts
+
+    Each job is a dictionary with:
+
+        'id':     Number of the job
+        'image':  Path of the image file
+        'count':  Number of cards to write
+        'done':   Number of cards written
+        'failed': Number of cards that could not be written
+
+    Cards being written are counted in running, which is not saved. A job
+    is given up once MAX_FAILURES of its cards could not be written.
+
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.data = { 'next_id': 1, 'jobs': [] }
+        self.running = {}
+        if path is not None:
+            try:
+                with open(path) as fl:
+                    data = json.load(fl)
+                if 'next_id' in data and 'jobs' in data:
+                    self.data = data
+            except (OSError, ValueError):
+                pass
+
+    def add(self, image, count=BATCH_SIZE):
+        """Add a job to write an image to a number of cards"""
+        with self.lock:
+            job = { 'id': self.data['next_id'],
+                    'image': str(image),
+                    'count': count,
+                    'done': 0,
+                    'failed': 0 }
+            self.data['next_id'] += 1
+            self.data['jobs'].append(job)
+            self.save()
+            return job
+
+    def current(self):
+        """The first job that still has cards to write, or None"""
+        with self.lock:
+            for job in self.data['jobs']:
+                if job['done'] < job['count'] and not self.given_up(job):
+                    return job
+            return None
+
+    def start(self):
+        """Take the next card of the current job, returning the job or None"""
+        with self.lock:
+            for job in self.data['jobs']:
+                if self.given_up(job):
+                    continue
+                if job['done'] + self.running.get(job['id'], 0) < job['count']:
+                    self.running[job['id']] = self.running.get(job['id'], 0) + 1
+                    return job
+            return None
+
+    def finish(self, job, ok):
+        """Record whether a card taken with start was written"""
+        with self.lock:
+            self.running[job['id']] -= 1
+            if ok:
+                job['done'] += 1
+            else:
+                job['failed'] += 1
+            if not self.running[job['id']]:
+                if job['done'] >= job['count']:
+                    self.remove(job)
+                elif self.given_up(job):
+                    print("Giving up writing", job['image'], "after",
+                          job['failed'], "failures")
+                    self.remove(job)
+            self.save()
+
+    def given_up(self, job):
+        return job['failed'] >= MAX_FAILURES
+
+    def remove(self, job):
+        with self.lock:
+            if job in self.data['jobs']:
+                self.data['jobs'].remove(job)
+            self.running.pop(job['id'], None)
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            try:
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as fl:
+                    json.dump(self.data, fl)
+                os.rename(tmp, self.path)
+            except OSError as e:
+                print("Cannot save jobs", self.path, "-", e)
+
+def load_image(path):
+    """The DiskImage for an image file, or None if it has gone"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        return None
+    for image in utils.image_index(os.path.dirname(directory)).images(directory):
+        if str(image) == path:
+            return image
+    return None
+
+class WriteHandle:
+    """A write running, or waiting to run, in a WritePool
+
+    The handle stands in for the display while the image is written. The
+    progress and any messages are kept so that the display can show them
+    when it wants to, rather than the write taking over the LCD. Questions
+    about variables are passed on to display, or if there is none, as for
+    jobs, the default values are used.
+
+    """
+    def __init__(self, write_function, devices, image, display=None,
+                 callback=None):
+        self.write_function = write_function
+        self.devices = devices
+        self.image = image
+        self.display = display
+        self.callback = callback
+        self.cancelled = threading.Event()
+        self.write_queue = self
+        self.title = None
+        self.percent = 0
+        self.rate = None
+        # Percentage written of each card, when there are several
+        self.device_percents = {}
+        self.status = 'Waiting'
+        self.results = None
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        self.future = None
+
+    def run(self):
+        self.start_time = time.time()
+        self.status = 'Writing'
+        try:
+            if not self.cancelled.is_set():
+                self.results = self.write_function(self.devices, self.image, self,
+                                                   cancel = self.cancelled)
+        except Exception as e:
+            print("Write of", str(self.image), "failed:", e)
+            self.error = e
+        if self.results is None:
+            self.results = dict( (device, False) for device in self.devices )
+        self.end_time = time.time()
+        self.status = self.summary()
+        if self.callback is not None:
+            self.callback(self)
+        return self.results
+
+    def cancel(self):
+        """Stop the write, or stop it from starting"""
+        self.cancelled.set()
+        if self.future is not None and self.future.cancel():
+            # It never started, so it will not finish either
+            self.results = dict( (device, False) for device in self.devices )
+            self.end_time = time.time()
+            self.status = 'Cancelled'
+            if self.callback is not None:
+                self.callback(self)
+
+    def done(self):
+        return self.end_time is not None
+
+    def seconds(self):
+        if self.start_time is None:
+            return 0
+        return (self.end_time or time.time()) - self.start_time
+
+    def summary(self):
+        """A short description of how the write went"""
+        n_ok = len([ d for d in self.results if self.results[d] ])
+        if self.cancelled.is_set():
+            return 'Cancelled'
+        elif n_ok == len(self.results):
+            return 'FINISHED {0}s'.format(int(self.seconds()))
+        elif n_ok > 0:
+            return '{0}/{1} written'.format(n_ok, len(self.results))
+        else:
+            return 'Write failed'
+
+    # The display interface used by utils.write_image
+
+    def put(self, message):
+        if message.get('action') == 'write' and message.get('text'):
+            self.status = str(message['text'])
+
+    def question(self, label, fmt):
+        if self.display is not None:
+            return self.display.question(label, fmt)
+        if ':' in fmt:
+            # The first of a list of values
+            return fmt.split(':', 1)[1].split(',')[0]
+        return fmt
+
+    def progress_title(self, title='Complete:'):
+        self.title = title
+        self.percent = 0
+        self.rate = None
+        self.device_percents = {}
+
+    def progress(self, percent, rate=None, devices=None):
+        self.percent = percent
+        self.rate = rate
+        if devices is not None:
+            self.device_percents = dict(devices)
+
+class WritePool:
+    """Run writes in the background
+
+    Each write is started with start, which returns a WriteHandle straight
+    away, so that the display carries on working while cards are written
+    and other writes can be started, inspected or cancelled.
+
+    """
+    def __init__(self, write_function, workers=MAX_WRITES):
+        self.write_function = write_function
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.handles = []
+
+    def start(self, devices, image, display=None, callback=None):
+        handle = WriteHandle(self.write_function, devices, image, display, callback)
+        with self.lock:
+            # Forget about old writes that have finished
+            self.handles = [ h for h in self.handles if not h.done() ] + [ handle ]
+            handle.future = self.executor.submit(handle.run)
+        return handle
+
+    def active(self):
+        """Handles of the writes that have not finished"""
+        with self.lock:
+            return [ h for h in self.handles if not h.done() ]
+
+    def recent(self):
+        """Handles of the writes, including those that have just finished"""
+        with self.lock:
+            return list(self.handles)
+
+    def busy_devices(self):
+        return [ d for h in self.active() for d in h.devices ]
+
+    def free(self):
+        """Number of writes that could start straight away"""
+        return max(self.workers - len(self.active()), 0)
+
+class Scheduler:
+    """Write the cards for the jobs in a JobQueue as they are inserted
+
+    Each card is written in its own WriteHandle so that cards in different
+    readers are written at the same time. A card is only written once, and
+    only cards inserted while there is a job are written, so cards that are
+    already in the readers when Bakery starts are left alone.
+
+    A card whose write was interrupted only carries on with it, as
+    write_image does from the journal, when it is inserted for a job that
+    writes the same image.
+
+    Cards that cannot start at once, because every worker of the pool is
+    busy or the job has all the cards it needs for now, wait. When there is
+    room, the waiting cards in the fastest readers are started first.
+
+    """
+    def __init__(self, queue, disks, pool):
+        self.queue = queue
+        self.disks = disks
+        self.pool = pool
+        self.lock = threading.Lock()
+        # Handles of the cards being written, by device path
+        self.busy = {}
+        # Cards that have been written but not yet removed
+        self.finished = set()
+        # Cards that failed or were cancelled but not yet removed
+        self.failed = set()
+        # Cards inserted for a job but not yet started
+        self.waiting = set()
+        disks.register('add_disk', self.card_inserted)
+        disks.register('remove_disk', self.card_removed)
+        disks.register('remove_device', self.card_removed)
+
+    def card_inserted(self, event):
+        device = event.device
+        if self.disks.find(device, event.id_path) is None:
+            # Only cards in the readers are written, never the system's
+            # own disks
+            return
+        with self.lock:
+            if ( device in self.busy or device in self.finished
+                 or device in self.failed or device in self.pool.busy_devices() ):
+                return
+            if self.queue.current() is None:
+                return
+            self.waiting.add(device)
+            self.start_waiting()
+
+    def start_waiting(self):
+        """Start as many of the waiting cards as there is room for"""
+        if self.queue.current() is None:
+            # Only cards inserted while there is a job are written
+            self.waiting.clear()
+            return
+        for device in utils.throughput.fastest_first(sorted(self.waiting),
+                                                     utils.device_identity):
+            if not self.pool.free():
+                return
+            job = self.queue.start()
+            if job is None:
+                return
+            image = load_image(job['image'])
+            if image is None:
+                print("Image", job['image'], "has gone")
+                self.queue.remove(job)
+                self.start_waiting()
+                return
+            self.waiting.discard(device)
+            self.busy[device] = self.pool.start([ device ], image,
+                                    callback = lambda handle, job=job, device=device:
+                                                   self.written(job, device, handle))
+
+    def card_removed(self, event):
+        with self.lock:
+            self.finished.discard(event.device)
+            self.failed.discard(event.device)
+            self.waiting.discard(event.device)
+
+    def written(self, job, device, handle):
+        ok = handle.results.get(device, False)
+        self.queue.finish(job, ok)
+        with self.lock:
+            self.busy.pop(device, None)
+            if ok:
+                self.finished.add(device)
+            else:
+                self.failed.add(device)
+            self.start_waiting()
+
+    def progress(self):
+        """Percentage written of each card being written, by device path"""
+        with self.lock:
+            return dict( (device, self.busy[device].percent) for device in self.busy )
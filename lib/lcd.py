@@ -0,0 +1,325 @@
+#   Copyright 2014 Joseph Haig
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# Keeps what should be on the LCD and sends only the characters that have
+# changed, so that a flood of updates never backs up behind a slow LCD.
+import re
+import threading
+import time
+
+LINES = 2
+# Characters in each line of the LCD's memory. Only 16 are shown at once,
+# but longer text can be scrolled into view.
+LINE_WIDTH = 40
+
+# Most updates sent to the LCD each second
+FRAME_RATE = 20
+
+# Characters visible at once, and so the longest answer to a question that
+# is typed in
+WIDTH = 16
+
+# Characters that can be chosen for each place in the answer to a question
+LETTERS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+DIGITS = '0123456789'
+HEX_DIGITS = '0123456789abcdef'
+TEXT = ' ' + LETTERS + DIGITS + '-_.'
+
+class LcdRenderer:
+    """Draw on the LCD from a copy of the screen in memory
+
+    Messages are passed to put as dictionaries, the same as were passed to
+    the old queue, and are applied to the copy straight away. A thread
+    compares the copy with what is on the LCD and writes the differences,
+    no more than FRAME_RATE times a second. Text that is overwritten before
+    it is shown is never sent, and a burst of scrolling is sent as the total
+    number of places moved.
+
+    Messages contain:
+
+        'action': 'clear'         - Clear the screen
+
+        'action': 'write'         - Write message
+        'pos': [ <int>, <int> ]   - Position to start text
+        'text': <string>          - Message to write
+        'blank': 0/1              - 1 = Clear to end of line (optional)
+
+        'action': 'store'         - Store bitmap
+        'bitmap': <int>           - Bitmap id
+        'lines': [ <int> * 8 ]    - Array of lines to make up bitmap
+
+        'action': 'bitmap'        - Write a bitmap
+        'pos': [ <int>, <int> ]   - Position to print bitmap
+        'bitmap': <int>           - Bitmap id
+
+        'action': 'scroll'        - Scroll the display
+        'step': <int>             - Places to scroll
+
+        'action': 'cursor'        - Show a blinking cursor
+        'pos': [ <int>, <int> ]   - Position of the cursor, or None to
+                                    hide it
+
+        'action': 'finish'        - End
+
+        'action': 'clear queue'   - Nothing, as there is no queue to clear
+
+        'action': 'pause'         - Stop writing to the LCD, so that
+                                    something else can use it
+
+        'action': 'resume'        - Start writing to the LCD again, all of
+                                    it as it may have been changed
+
+    """
+    def __init__(self, cad, frame_rate=FRAME_RATE):
+        self.cad = cad
+        self.frame_interval = 1.0 / frame_rate
+        self.condition = threading.Condition()
+        # Held while writing to the LCD
+        self.lcd_lock = threading.Lock()
+        # What should be on the screen. Each cell is a character, or an
+        # int for a bitmap.
+        self.screen = [ [ ' ' ] * LINE_WIDTH for i in range(LINES) ]
+        self.shift = 0
+        self.bitmaps = {}
+        self.cursor = None
+        # What is on the LCD, or None if it is not known
+        self.shown = None
+        self.shown_shift = 0
+        self.shown_bitmaps = {}
+        self.shown_cursor = None
+        self.paused = False
+        self.finished = False
+        self.thread = None
+
+    def start(self):
+        self.cad.lcd.backlight_on()
+        self.cad.lcd.cursor_off()
+        self.cad.lcd.blink_off()
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, message):
+        action = message['action']
+        if action == 'pause':
+            # Wait for any update that is being written to finish
+            with self.lcd_lock:
+                with self.condition:
+                    self.paused = True
+            return
+        with self.condition:
+            if action == 'resume':
+                self.paused = False
+                self.shown = None
+            elif action == 'finish':
+                self.finished = True
+            elif action == 'clear':
+                self.screen = [ [ ' ' ] * LINE_WIDTH for i in range(LINES) ]
+                self.shift = 0
+            elif action == 'write':
+                col, row = message['pos']
+                text = str(message['text'])
+                if message.get('blank'):
+                    text = text.ljust(LINE_WIDTH - col)
+                self.set_cells(col, row, list(text))
+            elif action == 'bitmap':
+                col, row = message['pos']
+                self.set_cells(col, row, [ message['bitmap'] ])
+            elif action == 'store':
+                self.bitmaps[message['bitmap']] = list(message['lines'])
+            elif action == 'scroll':
+                self.shift = (self.shift + message['step']) % LINE_WIDTH
+            elif action == 'cursor':
+                self.cursor = message['pos'] and list(message['pos'])
+            self.condition.notify()
+
+    def set_cells(self, col, row, cells):
+        if not 0 <= row < LINES:
+            return
+        cells = cells[:max(LINE_WIDTH - col, 0)]
+        self.screen[row][col:col + len(cells)] = cells
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.finished and (self.paused or not self.changed()):
+                    self.condition.wait()
+                if self.finished:
+                    return
+                screen = [ list(line) for line in self.screen ]
+                shift = self.shift
+                bitmaps = dict(self.bitmaps)
+                cursor = self.cursor
+            with self.lcd_lock:
+                if not self.paused:
+                    self.draw(screen, shift, bitmaps, cursor)
+            # Let more changes build up before the next update
+            time.sleep(self.frame_interval)
+
+    def changed(self):
+        return ( self.shown is None or self.shown != self.screen
+                 or self.shown_shift != self.shift
+                 or self.shown_bitmaps != self.bitmaps
+                 or self.shown_cursor != self.cursor )
+
+    def draw(self, screen, shift, bitmaps, cursor=None):
+        """Write the differences between the screen and the LCD"""
+        lcd = self.cad.lcd
+        for n in bitmaps:
+            if self.shown_bitmaps.get(n) != bitmaps[n]:
+                lcd.store_custom_bitmap(n, bitmaps[n])
+        self.shown_bitmaps = bitmaps
+        if self.shown is None:
+            lcd.clear()
+            self.shown = [ [ ' ' ] * LINE_WIDTH for i in range(LINES) ]
+            self.shown_shift = 0
+        written = False
+        for row in range(LINES):
+            col = 0
+            while col < LINE_WIDTH:
+                if screen[row][col] == self.shown[row][col]:
+                    col += 1
+                    continue
+                # Write the run of changed cells
+                written = True
+                lcd.set_cursor(col, row)
+                while col < LINE_WIDTH and screen[row][col] != self.shown[row][col]:
+                    if isinstance(screen[row][col], int):
+                        lcd.write_custom_bitmap(screen[row][col])
+                        col += 1
+                    else:
+                        end = col
+                        while ( end < LINE_WIDTH and not isinstance(screen[row][end], int)
+                                and screen[row][end] != self.shown[row][end] ):
+                            end += 1
+                        lcd.write(''.join(screen[row][col:end]))
+                        col = end
+            self.shown[row] = screen[row]
+        # Scroll the shortest way round
+        steps = (shift - self.shown_shift) % LINE_WIDTH
+        if steps > LINE_WIDTH // 2:
+            for i in range(LINE_WIDTH - steps):
+                lcd.move_right()
+        else:
+            for i in range(steps):
+                lcd.move_left()
+        self.shown_shift = shift
+        # Writing moves the cursor, so it is put back after any change
+        if cursor is not None and (written or cursor != self.shown_cursor):
+            lcd.set_cursor(*cursor)
+            if self.shown_cursor is None:
+                lcd.cursor_on()
+                lcd.blink_on()
+        elif cursor is None and self.shown_cursor is not None:
+            lcd.cursor_off()
+            lcd.blink_off()
+        self.shown_cursor = cursor
+
+    def finish(self):
+        self.put( { 'action': 'finish' } )
+        if self.thread is not None:
+            self.thread.join()
+
+class Question:
+    """The answer to a question being put together with the buttons
+
+    The answer is made of places, each of which is changed through a list
+    of choices, and text that cannot be changed. The default value of the
+    variable says what they are:
+
+        '<format>:<value>,<value>'  - One of the values, the first to start
+                                      with. Each %m in the format is one of
+                                      the values; if there is none, the
+                                      format is not used.
+
+        '<format>'                  - With a %, as for LCDScanf: %Nc is N
+                                      letters, %Ni or %Nd N digits, %Nx N
+                                      hex digits, %. a full stop, %% a %
+                                      and any other text is kept. The %r
+                                      for enter is not needed, as there is
+                                      a button for it.
+
+        '<text>'                    - The default value, which can be
+                                      changed a character at a time, up to
+                                      WIDTH characters.
+
+    """
+    def __init__(self, fmt):
+        # Each cell is text, or a list of a place's choices and the one chosen
+        self.cells = []
+        self.text_answer = False
+        values = None
+        if ':' in fmt:
+            fmt, values = fmt.split(':', 1)
+            values = values.split(',')
+            if '%m' not in fmt:
+                fmt = '%m'
+        if '%' in fmt:
+            self.parse(fmt, values)
+        else:
+            self.text_answer = True
+            for c in fmt[:WIDTH].ljust(WIDTH):
+                choices = TEXT if c in TEXT else c + TEXT
+                self.cells.append([ choices, choices.index(c) ])
+        self.places = [ n for n in range(len(self.cells))
+                        if not isinstance(self.cells[n], str) ]
+        self.place = 0
+
+    def parse(self, fmt, values):
+        for match in re.finditer(r'%(\d*)([cidxm.%r])|%|[^%]+', fmt):
+            kind = match.group(2)
+            n = int(match.group(1) or 1)
+            if kind is None:
+                self.cells.append(match.group(0))
+            elif kind == 'c':
+                self.cells.extend([ LETTERS, 0 ] for i in range(n))
+            elif kind == 'i' or kind == 'd':
+                self.cells.extend([ DIGITS, 0 ] for i in range(n))
+            elif kind == 'x':
+                self.cells.extend([ HEX_DIGITS, 0 ] for i in range(n))
+            elif kind == 'm':
+                self.cells.append([ values or [ '' ], 0 ])
+            elif kind == '.' or kind == '%':
+                self.cells.append(kind)
+
+    def change(self, step):
+        """Move the place at the cursor through its choices"""
+        if self.places:
+            cell = self.cells[self.places[self.place]]
+            cell[1] = (cell[1] + step) % len(cell[0])
+
+    def move(self):
+        """Move the cursor to the next place, or back to the first"""
+        if self.places:
+            self.place = (self.place + 1) % len(self.places)
+
+    def shown(self, cell):
+        if isinstance(cell, str):
+            return cell
+        return cell[0][cell[1]]
+
+    def text(self):
+        return ''.join(self.shown(cell) for cell in self.cells)
+
+    def column(self):
+        """Where the cursor is in the text"""
+        if not self.places:
+            return len(self.text())
+        return len(''.join(self.shown(cell)
+                           for cell in self.cells[:self.places[self.place]]))
+
+    def answer(self):
+        if self.text_answer:
+            return self.text().rstrip()
+        return self.text()
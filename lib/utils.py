@@ -13,17 +13,135 @@
 #   limitations under the License.
 import os
 import subprocess
-import signal
 import re
 import struct
-import queue
 import threading
 import time
 import pyudev
 import tempfile
+import mmap
+import zlib
+import concurrent.futures
+import fcntl
+import stat
+import json
+import uuid
+import bisect
+import select
+import errno
+import queue
+import lib.bmap as bmap
+import lib.compression as compression
+import lib.customise as customise
+import lib.inotify as inotify
+
+# Size of the buffer used to copy an image to a card. It is allocated with
+# mmap so that it is always page aligned.
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# Number of buffers between reading the image and writing it to the cards
+BUFFER_DEPTH = 4
+
+# Minimum number of seconds between progress updates on the display
+PROGRESS_INTERVAL = 1
+
+# Size of the blocks that are checked for zeros when writing sparsely
+SPARSE_BLOCK_SIZE = 64 * 1024
+ZERO_BLOCK = bytes(SPARSE_BLOCK_SIZE)
+
+# ioctls to discard a range of a block device, and to have the kernel fill
+# one with zeros in the quickest way that the device allows, from linux/fs.h
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+
+# Most bytes written and discarded to find out whether a device reads
+# discarded blocks as zeros
+DISCARD_PROBE_SIZE = 1024 * 1024
+
+# Discards and zeroing by the kernel must start and end on a sector
+SECTOR_SIZE = 512
+
+# Writes that bypass the page cache must start and end on this boundary, and
+# come from memory aligned to it
+DIRECT_ALIGNMENT = 4096
+
+# Number of bytes written to a card between waiting for them to reach it
+SYNC_INTERVAL = 32 * 1024 * 1024
+
+# Fewest MB written to a card between waiting for them to reach it when the
+# sync option is set, so that the progress still moves on if it is 0
+MIN_SYNC = 1
+
+# Approximate size of the parts of a card that are checked separately when
+# verifying what has been written
+EXTENT_SIZE = 16 * 1024 * 1024
+
+# Default settings for writing images. These can be changed in the [write]
+# section of the configuration file.
+WRITE_OPTIONS = {
+                  # Skip blocks of zeros instead of writing them
+                  'sparse': False,
+                  # Discard the skipped blocks so that they read as zeros
+                  'discard': False,
+                  # Only write the blocks listed in the image's block map,
+                  # making one the first time that the image is written
+                  'bmap': True,
+                  # Read the cards back after writing to check them
+                  'verify': False,
+                  # Number of buffers of decompressed data kept ready
+                  'buffers': BUFFER_DEPTH,
+                  # Write straight to the cards, bypassing the page cache
+                  'direct': True,
+                  # MB written between making sure the data is on the card
+                  'sync': SYNC_INTERVAL // (1024 * 1024),
+                  # Keep a journal of what is on each card so that a write
+                  # that was interrupted can carry on where it stopped
+                  'resume': True,
+                }
+
+# File in each image source directory that holds the metadata of the images
+INDEX_FILE = '.bakery-index.json'
+
+# File in the image source directory that holds the write speed of each USB
+# port and model of card reader
+THROUGHPUT_FILE = '.bakery-throughput.json'
+
+# Weight given to the latest write when updating an average speed
+THROUGHPUT_WEIGHT = 0.3
+
+# File in the image source directory that holds how far each card has been
+# written
+JOURNAL_FILE = '.bakery-journal.json'
+
+# Seconds to wait for something to write before checking for a cancel
+CANCEL_POLL = 0.2
+
+# Writes smaller than this say little about the speed so are not recorded
+THROUGHPUT_MIN_SIZE = 16 * 1024 * 1024
+
+# A port is slow if it is slower than this fraction of the fastest one
+SLOW_FRACTION = 0.5
+
+SECTOR_SIZE = 512
+# The partition table is in the first 34 sectors, for GPT
+PARTITION_TABLE_SIZE = 34 * SECTOR_SIZE
+
+# Seconds to let an image directory settle after a change before reading it
+RESCAN_DELAY = 0.5
+
+# ioctl to make the kernel read the partition table of a disk again, from
+# linux/fs.h
+BLKRRPART = 0x125f
+
+# Seconds to wait for the partitions of a card to appear after writing it
+PARTITION_WAIT = 10
+
+# Tries at rereading the partition table while the disk is still busy
+REREAD_TRIES = 5
 
 class DiskImage:
-    def __init__(self, filepath, file_format, post, variables):
+    def __init__(self, filepath, file_format, post, variables, bmap=False,
+                 metadata=None, custom=False):
         self.name = os.path.basename(filepath)
         self.directory = os.path.dirname(filepath)
         self.file_format = file_format
@@ -31,6 +149,16 @@ class DiskImage:
                                 self.directory + '/' + self.name + '.post.' + x,
                                 sorted(post) ) )
         self.variables = variables
+        # Block map, if there is one
+        self.bmap = None
+        if bmap:
+            self.bmap = self.bmap_path()
+        # Changes to make to each card as it is written, if there are any
+        self.custom = None
+        if custom:
+            self.custom = self.directory + '/' + self.name + '.custom'
+        # Size, checksum and partitions from the ImageIndex
+        self.metadata = metadata or {}
 
     def __lt__(self, other):
         """Sorting rule
@@ -50,6 +178,9 @@ class DiskImage:
     def get_post_scripts(self):
         return self.post
 
+    def bmap_path(self):
+        return self.directory + '/' + self.name + '.bmap'
+
     def info(self, key):
         if key == 'name':
             return self.name
@@ -57,13 +188,22 @@ class DiskImage:
             return "{0} post scripts".format(len(self.post))
         elif key == 'n_variables':
             return "{0} variables".format(len(self.variables))
+        elif key == 'size':
+            if self.metadata.get('size') is None:
+                return "Unknown size"
+            return format_size(self.metadata['size'])
+        elif key == 'partitions':
+            return partition_summary(self.metadata.get('partitions'))
         else:
             return "Unknown key"
 
 class Drive:
-    def __init__(self, path, model):
+    def __init__(self, path, model, id_path=None):
         self.path = path
         self.model = model
+        # Where the device is plugged in, which stays the same when the
+        # kernel gives it another path
+        self.id_path = id_path or path
         self.present = False
 
     def __str__(self):
@@ -77,6 +217,11 @@ class Drive:
             return self.model
         elif key == 'node_path':
             return self.path
+        elif key == 'speed':
+            rate = throughput.rate(self)
+            if rate is None:
+                return "Speed unknown"
+            return "{0:.1f} MB/s".format(rate)
         else:
             return "Unknown key"
 
@@ -96,6 +241,7 @@ class SelectList(list):
         self.pointer = 0
         self.selected = None
         self.updated = False
+        self.lock = threading.RLock()
 
     def next(self):
         if len(self) > 0:
@@ -139,178 +285,1689 @@ class SelectList(list):
         self.updated = True
         super().remove(item)
 
+    def replace(self, old, new):
+        """Remove some items and add others in sorted order
+
+        The pointer and the selection stay on the same items, or on new items
+        that look the same, if they are still in the list.
+
+        """
+        if not old and not new:
+            return
+        with self.lock:
+            current = self.current()
+            selected = None
+            if self.selected is not None and self.selected < len(self):
+                selected = self[self.selected]
+            for item in old:
+                super().remove(item)
+            for item in new:
+                bisect.insort(self, item)
+            self.pointer = self.find_same(current)
+            if self.pointer is None:
+                self.pointer = max(0, min(len(self) - 1, self.pointer_before(current)))
+            self.selected = self.find_same(selected)
+            self.updated = True
+
+    def find_same(self, item):
+        if item is None:
+            return None
+        for i in range(len(self)):
+            if self[i] is item or str(self[i]) == str(item):
+                return i
+        return None
+
+    def pointer_before(self, item):
+        """Where an item that has gone would have been in the list"""
+        if item is None:
+            return 0
+        return bisect.bisect_left(self, item)
+
+def read_vars(path):
+    """Read the variables to collect for an image"""
+    variables = {}
+    with open(path) as vs:
+        for line in vs:
+            parts = line.rstrip().split(':',1)
+            if len(parts) > 1:
+                variables[parts[0]] = parts[1]
+    return variables
+
+def read_image_directory(pth):
+    """Group the files in an image directory by the image they belong to
+
+    Returns a dictionary keyed by the path of each image without its
+    extension.
+
+    """
+    file_groups = {}
+
+    def group(key):
+        if key not in file_groups:
+            file_groups[key] = {
+                                 'post': [],
+                                 'file_format': None,
+                                 'variables': {},
+                                 'vars_mtime': None,
+                                 'bmap': False,
+                                 'custom': False,
+                               }
+        return file_groups[key]
+
+    for fl in os.listdir(pth):
+        # Reverse before split to get cut into only 3 parts from the
+        # right. The things to match are therefore then all reversed.
+        spl = fl[::-1].split('.',2)
+        file_format = compression.image_format(fl)
+        if len(spl) == 3 and spl[1] == 'tsop':
+            # Post install script
+            group(pth + '/' + spl[-1][::-1])['post'].append(spl[0][::-1])
+        elif file_format is not None:
+            # Image, in any of the formats in the codec registry
+            key = pth + '/' + fl[:-len(file_format) - 1]
+            group(key)['file_format'] = file_format
+        elif len(spl) >= 2:
+            key = pth + '/' + fl[::-1].split('.',1)[-1][::-1]
+            if spl[0] == 'pamb':
+                # Block map
+                group(key)['bmap'] = True
+            elif spl[0] == 'motsuc':
+                # Changes to make to each card
+                group(key)['custom'] = True
+            elif spl[0] == 'srav':
+                # Variables file
+                group(key)['variables'] = read_vars(pth + '/' + fl)
+                group(key)['vars_mtime'] = os.path.getmtime(pth + '/' + fl)
+    return file_groups
+
 def disk_image_list(*sources):
     images = SelectList()
-    file_groups = {}
     for dr in sources:
+        index = image_index(dr)
         for sdr in os.listdir(dr):
             pth = dr + '/' + sdr
-            files = os.listdir(pth)
-            for fl in files:
-                # Reverse before split to get cut into only 3 parts from the
-                # right. The things to match are therefore then all reversed.
-                spl = fl[::-1].split('.',2)
-                key = pth + '/' + spl[-1][::-1]
-                if key not in file_groups:
-                    file_groups[key] = {
-                                         'post': [],
-                                         'file_format': None,
-                                         'variables': {},
-                                       }
-                if len(spl) == 3:
-                    if spl[1] == 'tsop':
-                        # Post install script
-                        file_groups[key]['post'].append(spl[0][::-1])
-                    elif spl[1] == 'gmi' and spl[0] == 'zg':
-                        # Zipped image
-                        file_groups[key]['file_format'] = 'img.gz'
-                elif len(spl) == 2:
-                    if spl[0] == 'gmi':
-                        # Uncompressed image
-                        file_groups[key]['file_format'] = 'img'
-                    elif spl[0] == 'srav':
-                        # Variables file
-                        vs = open(pth + '/' + fl)
-                        for line in vs:
-                            parts = line.rstrip().split(':',1)
-                            if len(parts) > 1:
-                                file_groups[key]['variables'][parts[0]] = parts[1]
-    for key in file_groups:
-        if file_groups[key]['file_format'] != None:
-            images.append( DiskImage( key, file_groups[key]['file_format'], file_groups[key]['post'], file_groups[key]['variables'] ) )
+            if os.path.isdir(pth):
+                for image in index.images(pth):
+                    images.append(image)
+        index.save()
     images.sort()
     return images
 
-def read_pipe(out, queue):
-    """Read from the pipes output of a subprocess """
+def format_size(size):
+    """Size in bytes in a short form for the display"""
+    for unit in [ 'B', 'K', 'M', 'G' ]:
+        if size < 1024 or unit == 'G':
+            break
+        size = size / 1024.0
+    if unit == 'B':
+        return "{0} bytes".format(size)
+    return "{0:.1f}{1}".format(size, unit)
 
-    for line in iter(out.readline, b''):
-        queue.put(str(line))
-    out.close()
+def read_partition_table(data):
+    """Read the partition table from the start of a disk or an image
 
-def write_image(device, image, display):
-    """Write the image to the card """
-    # Uncompressed size of a gzip file is stored in the last 4 bytes
-    print("Image:", str(image))
-    print("File format:", image.file_format)
+    data should hold the first PARTITION_TABLE_SIZE bytes. MBR and GPT
+    partition tables are understood but not logical partitions.
+
+    Returns a dictionary with the 'scheme' ('mbr' or 'gpt'), the
+    'partitions' as a list of dictionaries with the 'number', 'type',
+    'start' and 'size' in bytes, and 'disk_size', the smallest size that the
+    disk can be to hold it all. Returns None if there is no partition table.
+
+    """
+    if len(data) < SECTOR_SIZE or data[510:512] != b'\x55\xaa':
+        return None
+    table = { 'scheme': 'mbr', 'partitions': [], 'disk_size': 0 }
+    for i in range(4):
+        entry = data[446 + 16*i:446 + 16*(i+1)]
+        ptype = entry[4]
+        start, sectors = struct.unpack('<II', entry[8:16])
+        if ptype == 0 or sectors == 0:
+            continue
+        if ptype == 0xee:
+            return read_gpt(data) or table
+        table['partitions'].append( { 'number': i + 1,
+                                      'type': '{0:x}'.format(ptype),
+                                      'start': start * SECTOR_SIZE,
+                                      'size': sectors * SECTOR_SIZE } )
+        table['disk_size'] = max(table['disk_size'], (start + sectors) * SECTOR_SIZE)
+    return table
+
+def read_gpt(data):
+    """Read a GUID partition table for read_partition_table"""
+    header = data[SECTOR_SIZE:2*SECTOR_SIZE]
+    if header[0:8] != b'EFI PART':
+        return None
+    backup_lba, = struct.unpack('<Q', header[32:40])
+    entries_lba, n_entries, entry_size = struct.unpack('<QII', header[72:88])
+    table = { 'scheme': 'gpt', 'partitions': [],
+              # The backup header is in the last sector of the disk
+              'disk_size': (backup_lba + 1) * SECTOR_SIZE }
+    for i in range(n_entries):
+        pos = entries_lba * SECTOR_SIZE + i * entry_size
+        entry = data[pos:pos + entry_size]
+        if len(entry) < 48:
+            break
+        if entry[0:16] == bytes(16):
+            continue
+        first, last = struct.unpack('<QQ', entry[32:48])
+        table['partitions'].append( { 'number': i + 1,
+                                      'type': str(uuid.UUID(bytes_le=bytes(entry[0:16]))),
+                                      'start': first * SECTOR_SIZE,
+                                      'size': (last - first + 1) * SECTOR_SIZE } )
+    return table
 
-    unzip = None
-    dd = None
-    size = None
-    if image.file_format == 'img.gz':
-        fl = open(str(image), 'rb')
-        fl.seek(-4, 2)
-        r = fl.read()
-        fl.close()
-        size = struct.unpack('<I', r)[0]
-
-        # Unzip process
-        unzip = subprocess.Popen(['zcat', str(image)], stdout=subprocess.PIPE)
-
-        # Make sure it starts
-        while unzip.poll() is not None:
-            print("Waiting for unzip to start")
-            sleep(0.1)
-
-        print("unzip PID:", unzip.pid)
-        dd = subprocess.Popen(['dd', 'of=' + str(device), 'bs=1M'], bufsize=1, stdin=unzip.stdout, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-    elif image.file_format == 'img':
-        fl = open(str(image), 'rb')
-        fl.seek(0, 2)
-        size = fl.tell()
-        fl.close()
-        
-        dd = subprocess.Popen(['dd', 'of=' + str(device), 'if=' + str(image), 'bs=1M'], bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+def partition_summary(table):
+    """Partition table in a short form for the display"""
+    if not table:
+        return "No partitions"
+    elif table['scheme'] == 'gpt':
+        return "GPT {0} parts".format(len(table['partitions']))
     else:
-        return False
+        return "MBR " + ','.join(p['type'] for p in table['partitions'])
 
-    # DD process
-    # Output to a pipe to catch status updates
-    dd_queue = queue.Queue()
-    dd_thread = threading.Thread(target = read_pipe, args=(dd.stdout, dd_queue))
-    dd_thread.daemon = True
-    dd_thread.start()
+def image_metadata(image):
+    """Read the metadata of an image from the image file
 
-    # Gather required variables
-    environment = { 'IMGDIR': image.directory, 'DEVICE': str(device) }
-    for var in image.variables:
-        environment[var] = display.question(var, image.variables[var])
+    The size comes from the codec of the image format. For a gzipped image,
+    the size in the gzip trailer is only the real size modulo 4GiB. The real
+    size is worked out from this together with the size of disk that the
+    partition table needs, so 'exact' is False until the whole image has
+    been read. Some formats, such as bzip2, do not record the size at all.
 
-    display.progress_title()
+    """
+    st = os.stat(str(image))
+    metadata = { 'mtime': st.st_mtime,
+                 'file_size': st.st_size,
+                 'size': None,
+                 'exact': False,
+                 'crc32': None,
+                 'partitions': None }
+    try:
+        source = open_image(image)
+        if source is None:
+            return metadata
+        with source:
+            table = read_partition_table(source.read(PARTITION_TABLE_SIZE))
+        metadata['partitions'] = table
+        info = compression.get_codec(image.file_format).info(str(image))
+        size = info.get('size')
+        if size is not None and 'modulo' in info:
+            if table and table['disk_size'] > size:
+                wraps = (table['disk_size'] - size + info['modulo'] - 1) // info['modulo']
+                size += wraps * info['modulo']
+        metadata['size'] = size
+        metadata['exact'] = info.get('exact', False)
+        metadata['crc32'] = info.get('crc32')
+    except compression.DECOMPRESSION_ERRORS as e:
+        print("Cannot read", str(image), "-", e)
+    return metadata
+
+class ImageIndex:
+    """Metadata of the images in a source directory
 
-    print("dd PID   :", dd.pid)
-    probe_sleep = 3
-    next_probe = time.time()
-    while dd.poll() is None:
-        if time.time() > next_probe:
-            dd.send_signal(signal.SIGUSR1)
-            next_probe = next_probe + probe_sleep
+    The metadata is kept in INDEX_FILE in the directory so that it only has
+    to be worked out again when the files change, which is noticed by their
+    modification times.
 
+    """
+    def __init__(self, source):
+        self.path = source + '/' + INDEX_FILE
+        self.lock = threading.Lock()
+        self.changed = False
+        self.data = { 'directories': {}, 'images': {} }
         try:
-            line = dd_queue.get(timeout = 0.1)
-            m = re.search(r"(\d+) bytes", str(line))
-            if m != None:
-                percent = 100*int(m.group(1))/size
-                display.progress(percent)
-                print("Completed: " + str(percent) + "%")
-                # In case it has hung and recovered
-                while time.time() > next_probe:
-                    next_probe = next_probe + probe_sleep
-        except:
+            with open(self.path) as fl:
+                data = json.load(fl)
+            if 'directories' in data and 'images' in data:
+                self.data = data
+        except (OSError, ValueError):
             pass
 
-    if dd.returncode != 0:
+    def images(self, pth):
+        """The DiskImages in an image directory"""
+        with self.lock:
+            groups = self.file_groups(pth)
+            images = []
+            for key in groups:
+                if groups[key]['file_format'] != None:
+                    image = DiskImage( key, groups[key]['file_format'],
+                                       groups[key]['post'],
+                                       groups[key]['variables'],
+                                       groups[key]['bmap'],
+                                       custom = groups[key]['custom'] )
+                    image.metadata = self.metadata(image)
+                    images.append(image)
+            return images
+
+    def file_groups(self, pth):
+        mtime = os.path.getmtime(pth)
+        cached = self.data['directories'].get(pth)
+        if cached is None or cached['mtime'] != mtime:
+            cached = { 'mtime': mtime, 'groups': read_image_directory(pth) }
+            self.data['directories'][pth] = cached
+            self.changed = True
+        else:
+            # A variables file may have been edited in place
+            for key in cached['groups']:
+                group = cached['groups'][key]
+                if group['vars_mtime'] is not None:
+                    vars_file = key + '.vars'
+                    vars_mtime = os.path.getmtime(vars_file)
+                    if vars_mtime != group['vars_mtime']:
+                        group['variables'] = read_vars(vars_file)
+                        group['vars_mtime'] = vars_mtime
+                        self.changed = True
+        return cached['groups']
+
+    def metadata(self, image):
+        st = os.stat(str(image))
+        metadata = self.data['images'].get(str(image))
+        if ( metadata is None or metadata['mtime'] != st.st_mtime
+             or metadata['file_size'] != st.st_size ):
+            metadata = image_metadata(image)
+            self.data['images'][str(image)] = metadata
+            self.changed = True
+        return metadata
+
+    def set_size(self, image, size):
+        """Record the real size of an image once it has all been read"""
+        with self.lock:
+            metadata = self.data['images'].get(str(image))
+            if metadata is None or (metadata['size'] == size and metadata['exact']):
+                return
+            metadata['size'] = size
+            metadata['exact'] = True
+            self.changed = True
+        self.save()
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            # Forget about anything that has gone
+            for key in [ k for k in self.data['directories'] if not os.path.isdir(k) ]:
+                del self.data['directories'][key]
+            for key in [ k for k in self.data['images'] if not os.path.exists(k) ]:
+                del self.data['images'][key]
+            try:
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as fl:
+                    json.dump(self.data, fl)
+                os.rename(tmp, self.path)
+                self.changed = False
+            except OSError as e:
+                print("Cannot save image index", self.path, "-", e)
+
+# One ImageIndex for each source directory
+indexes = {}
+
+def image_index(source):
+    if source not in indexes:
+        indexes[source] = ImageIndex(source)
+    return indexes[source]
+
+class ThroughputStore:
+    """Write speeds of USB ports and models of card reader
+
+    The average speed in MB/s of each port (by udev's ID_PATH) and of each
+    model is updated after every write and kept in a file. A port that has
+    not been used yet is assumed to be as fast as its reader model.
+
+    """
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.data = { 'ports': {}, 'models': {} }
+        self.load(path)
+
+    def load(self, path):
+        self.path = path
+        if path is None:
+            return
+        try:
+            with open(path) as fl:
+                data = json.load(fl)
+            if 'ports' in data and 'models' in data:
+                self.data = data
+        except (OSError, ValueError):
+            pass
+
+    def record(self, id_path, model, size, seconds):
+        """Add a write of size bytes that took a number of seconds"""
+        if size < THROUGHPUT_MIN_SIZE or seconds <= 0:
+            return
+        rate = size / seconds / (1024 * 1024)
+        with self.lock:
+            for table, key in (('ports', id_path), ('models', model)):
+                if key is None:
+                    continue
+                entry = self.data[table].get(key)
+                if entry is None:
+                    entry = { 'rate': rate, 'jobs': 0 }
+                    self.data[table][key] = entry
+                entry['rate'] += (rate - entry['rate']) * THROUGHPUT_WEIGHT
+                entry['jobs'] += 1
+        self.save()
+
+    def rate(self, drive):
+        """Measured speed of a Drive in MB/s, or None if it is not known"""
+        return self.port_rate(drive.id_path, drive.model)
+
+    def port_rate(self, id_path, model):
+        with self.lock:
+            for table, key in (('ports', id_path), ('models', model)):
+                entry = self.data[table].get(key)
+                if entry is not None:
+                    return entry['rate']
+        return None
+
+    def fastest_first(self, drives, identity=None):
+        """Sort drives by speed, with any not yet measured first
+
+        identity, if given, returns the ID_PATH and model of each one, as
+        device_identity does for device paths.
+
+        """
+        def key(drive):
+            if identity is None:
+                rate = self.rate(drive)
+            else:
+                rate = self.port_rate(*identity(drive))
+            if rate is None:
+                return -float('inf')
+            return -rate
+        return sorted(drives, key=key)
+
+    def is_slow(self, drive):
+        rate = self.rate(drive)
+        with self.lock:
+            rates = [ e['rate'] for e in self.data['ports'].values() ]
+        return rate is not None and bool(rates) and rate < SLOW_FRACTION * max(rates)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            try:
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as fl:
+                    json.dump(self.data, fl)
+                os.rename(tmp, self.path)
+            except OSError as e:
+                print("Cannot save write speeds", self.path, "-", e)
+
+# Write speeds, loaded from THROUGHPUT_FILE in the image source directory by
+# load_throughput
+throughput = ThroughputStore()
+
+def load_throughput(source):
+    throughput.load(source + '/' + THROUGHPUT_FILE)
+
+def device_identity(path):
+    """The ID_PATH and model of a device, or None for either if not known"""
+    try:
+        device = pyudev.Devices.from_device_file(pyudev.Context(), path)
+        return device.get('ID_PATH'), device.get('ID_MODEL')
+    except (pyudev.DeviceNotFoundError, ValueError, OSError):
+        return None, None
+
+def card_key(path):
+    """A key that identifies the card in a device, or None
+
+    Cards are told apart by the CID register that each SD card has, which
+    the kernel shows in sysfs for cards in an MMC reader. Most USB readers
+    do not pass it on, so their cards are told apart by the reader's serial
+    number and the size of the card. Cards of the same size in the same
+    reader then share a key, which is why the journal reads back the last
+    extent written before carrying on. A regular file is identified by its
+    own path.
+
+    """
+    try:
+        if stat.S_ISREG(os.stat(path).st_mode):
+            return os.path.realpath(path)
+        device = pyudev.Devices.from_device_file(pyudev.Context(), path)
+        try:
+            with open(os.path.join(device.sys_path, 'device', 'cid')) as fl:
+                cid = fl.read().strip()
+            if cid:
+                return 'cid:' + cid
+        except OSError:
+            pass
+        serial = device.get('ID_SERIAL_SHORT') or device.get('ID_SERIAL')
+        if serial is None:
+            return None
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.lseek(fd, 0, os.SEEK_END)
+        finally:
+            os.close(fd)
+        return '{0}:{1}'.format(serial, size)
+    except (pyudev.DeviceNotFoundError, ValueError, OSError):
+        return None
+
+class WriteJournal:
+    """How far each card has been written, kept in a file
+
+    While an image is written, each card's entry is updated every time the
+    data is known to have reached it, with the extents written so far and
+    their checksums. If the write stops, because the card was taken out,
+    the write was cancelled or Bakery stopped, writing the same image to
+    the same card again starts from there. The last extent is read back
+    first to make sure that the card has not been changed in the meantime.
+
+    """
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.data = { 'cards': {} }
+        self.load(path)
+
+    def load(self, path):
+        self.path = path
+        if path is None:
+            return
+        try:
+            with open(path) as fl:
+                data = json.load(fl)
+            if 'cards' in data:
+                self.data = data
+        except (OSError, ValueError):
+            pass
+
+    def image_state(self, image):
+        try:
+            st = os.stat(str(image))
+        except OSError:
+            return None
+        return [ st.st_size, st.st_mtime ]
+
+    def checkpoint(self, key, image, offset, extents):
+        """Record that the first offset bytes of image are on a card"""
+        if key is None:
+            return
+        with self.lock:
+            self.data['cards'][key] = { 'image': str(image),
+                                        'state': self.image_state(image),
+                                        'offset': offset,
+                                        'extents': extents }
+        self.save()
+
+    def entry(self, key):
+        with self.lock:
+            return self.data['cards'].get(key)
+
+    def resume_offset(self, key, image, path):
+        """Where to carry on writing image to the card in path, or 0"""
+        entry = self.entry(key)
+        if ( entry is None or entry['image'] != str(image)
+             or entry['state'] != self.image_state(image) or not entry['extents'] ):
+            return 0
+        if not verify_device(path, entry['extents'][-1:]):
+            print("Card in", path, "has changed since it was written")
+            self.remove(key)
+            return 0
+        return entry['offset']
+
+    def remove(self, key):
+        with self.lock:
+            if self.data['cards'].pop(key, None) is None:
+                return
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            try:
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as fl:
+                    json.dump(self.data, fl)
+                os.rename(tmp, self.path)
+            except OSError as e:
+                print("Cannot save write journal", self.path, "-", e)
+
+# How far the cards have been written, loaded from JOURNAL_FILE in the image
+# source directory by load_journal
+journal = WriteJournal()
+
+def load_journal(source):
+    journal.load(source + '/' + JOURNAL_FILE)
+
+class ImageStoreWatcher:
+    """Keep a list of images up to date with the image directories
+
+    Changes are noticed with inotify and only the image directory that
+    changed is read again, with the differences applied to the list. If
+    inotify is not available, rescan can still be called after making a
+    change. callback, if given, is called from the watching thread after
+    the list has been changed.
+
+    """
+    SOURCE_EVENTS = ( inotify.IN_CREATE | inotify.IN_DELETE
+                      | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO )
+    DIRECTORY_EVENTS = ( inotify.IN_CLOSE_WRITE | inotify.IN_DELETE
+                         | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO )
+
+    def __init__(self, images, *sources, callback=None):
+        self.images = images
+        self.sources = sources
+        self.callback = callback
+        self.inotify = None
+        # Watched directory for each watch descriptor
+        self.watches = {}
+
+    def start(self):
+        try:
+            self.inotify = inotify.Inotify()
+            for dr in self.sources:
+                self.watch(dr, self.SOURCE_EVENTS)
+                for sdr in os.listdir(dr):
+                    if os.path.isdir(dr + '/' + sdr):
+                        self.watch(dr + '/' + sdr, self.DIRECTORY_EVENTS)
+        except OSError as e:
+            print("Cannot watch the image directories -", e)
+            return
+        watcher = threading.Thread(target = self.run)
+        watcher.daemon = True
+        watcher.start()
+
+    def watch(self, path, mask):
+        try:
+            self.watches[self.inotify.add_watch(path, mask)] = path
+        except OSError as e:
+            print("Cannot watch", path, "-", e)
+
+    def run(self):
+        # Image directories waiting to be read again
+        changed = set()
+        while True:
+            timeout = RESCAN_DELAY if changed else None
+            ready = select.select([ self.inotify ], [], [], timeout)[0]
+            if not ready:
+                for pth in sorted(changed):
+                    self.rescan(pth)
+                changed = set()
+                if self.images.updated and self.callback is not None:
+                    self.callback()
+                continue
+            for wd, mask, cookie, name in self.inotify.read():
+                if mask & inotify.IN_Q_OVERFLOW:
+                    # Events have been lost so check everything
+                    changed.update(self.image_directories())
+                    continue
+                path = self.watches.get(wd)
+                if path is None:
+                    continue
+                if mask & inotify.IN_IGNORED:
+                    del self.watches[wd]
+                elif path in self.sources:
+                    if mask & inotify.IN_ISDIR and not name.startswith('.'):
+                        pth = path + '/' + name
+                        if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                            self.watch(pth, self.DIRECTORY_EVENTS)
+                        changed.add(pth)
+                else:
+                    changed.add(path)
+
+    def image_directories(self):
+        directories = set(image.directory for image in self.images)
+        for dr in self.sources:
+            for sdr in os.listdir(dr):
+                if os.path.isdir(dr + '/' + sdr):
+                    directories.add(dr + '/' + sdr)
+        return directories
+
+    def rescan(self, pth):
+        """Bring the images from one image directory up to date"""
+        found = []
+        if os.path.isdir(pth):
+            index = image_index(os.path.dirname(pth))
+            try:
+                found = index.images(pth)
+            except OSError as e:
+                # Probably removed while it was being read
+                print("Cannot read", pth, "-", e)
+            index.save()
+
+        def state(image):
+            return ( str(image), image.post, image.variables, image.bmap,
+                     image.custom, image.metadata.get('mtime') )
+
+        with self.images.lock:
+            old = [ image for image in self.images if image.directory == pth ]
+            old_states = [ state(image) for image in old ]
+            new_states = [ state(image) for image in found ]
+            self.images.replace(
+                [ image for image in old if state(image) not in new_states ],
+                [ image for image in found if state(image) not in old_states ] )
+
+def image_size(image):
+    """Uncompressed size of an image in bytes"""
+    if image.metadata.get('size') is not None:
+        return image.metadata['size']
+    codec = compression.get_codec(image.file_format)
+    if codec is None:
+        return None
+    return codec.info(str(image)).get('size')
+
+def open_image(image):
+    """Open a stream of the uncompressed image data
+
+    Returns None if the file format is not recognised.
+
+    """
+    return compression.open_image(str(image), image.file_format)
+
+class WriteCancelled(Exception):
+    pass
+
+class DeviceWriter:
+    """Write buffers of image data to one device
+
+    Any error is kept rather than raised so that a failing card does not
+    stop the same image being written to any other cards.
+
+    When discard is set, runs of zeros that are skipped are discarded on the
+    device so that they read back as zeros. If the device cannot discard
+    them, or does not read discarded blocks as zeros, they are zeroed as
+    for zero_skipped below.
+
+    With direct set, the data is written with O_DIRECT so that it does not
+    fill the memory with dirty pages. The data must then be in page aligned
+    buffers, such as those of a BufferRing. Any part that is not aligned,
+    such as the end of the image, is written through the page cache as
+    normal, as is everything if the device does not support O_DIRECT.
+
+    Every sync_interval bytes the writer waits for the data to reach the
+    device. synced is the number of bytes that are known to be on it.
+
+    The first resume bytes are already on the device, from a write that was
+    interrupted, so buffers that end before then are passed over. Setting
+    cancel, a threading.Event, makes the writer fail with WriteCancelled
+    before it writes anything else.
+
+    overlay is a list of (offset, data) that is written over the image, to
+    make the changes from customise for this card.
+
+    With zero_skipped set, the skipped runs must read as zeros whatever was
+    on the card before, as the unmapped blocks of a block map must. They are
+    discarded if the card reads discarded blocks back as zeros, which is
+    found out once with a small probe, or else the kernel is asked to zero
+    them with BLKZEROOUT, and only if that fails are zeros written here.
+
+    """
+    def __init__(self, path, discard=False, direct=False,
+                 sync_interval=SYNC_INTERVAL, resume=0, cancel=None,
+                 overlay=None, zero_skipped=False):
+        self.path = path
+        self.overlay = overlay or []
+        self.discard = discard or zero_skipped
+        self.zero_skipped = zero_skipped
+        # Whether skipped runs must read as zeros, which stays set when it
+        # turns out that they cannot be discarded
+        self.fill_skipped = self.discard
+        self.direct = direct
+        self.sync_interval = sync_interval
+        self.resume = resume
+        self.cancel = cancel
+        self.written = 0
+        self.synced = 0
+        self.skipped = 0
+        self.error = None
+        self.start_time = time.time()
+        self.end_time = None
+        # Seconds spent waiting for the device itself, which unlike the
+        # elapsed time does not include waiting for the other devices
+        self.busy = 0.0
+        self.fd = None
+        # Descriptor for writing through the page cache when direct is set
+        self.buffered_fd = None
+        self.zeros = ZERO_BLOCK
+        # Range of skipped zeros that is still to be discarded
+        self.hole = None
+        # Whether discarded blocks read as zeros, or None until probed
+        self.discard_zeroes = None
+        # Whether the kernel can zero ranges of the device
+        self.zero_out = True
+        try:
+            if direct:
+                try:
+                    self.fd = os.open(path, os.O_WRONLY | os.O_DIRECT)
+                    # Zeros have to be aligned as well
+                    self.zeros = mmap.mmap(-1, SPARSE_BLOCK_SIZE)
+                except OSError as e:
+                    if e.errno != errno.EINVAL:
+                        raise
+                    print("Cannot write directly to", path)
+                    self.direct = False
+            if self.fd is None:
+                self.fd = os.open(path, os.O_WRONLY)
+            # A regular file reads zeros in the gaps anyway, past its old end
+            st = os.fstat(self.fd)
+            self.regular = stat.S_ISREG(st.st_mode)
+            self.old_size = st.st_size if self.regular else 0
+        except OSError as e:
+            self.fail(e)
+
+    def __str__(self):
+        return self.path
+
+    def write(self, data, runs=None):
+        """Write the next buffer of the image
+
+        runs, if given, is a list of (start, end, zero) tuples splitting the
+        buffer up as returned by data_runs. The runs of zeros are skipped.
+
+        """
+        if self.error is not None:
+            return
+        if self.written + len(data) <= self.resume:
+            try:
+                if self.write_overlay(self.written, self.written + len(data)):
+                    self.sync()
+            except OSError as e:
+                self.fail(e)
+            self.written += len(data)
+            self.synced = self.written
+            return
+        try:
+            self.check_cancel()
+            if runs is None:
+                self.write_at(self.written, data)
+            else:
+                for start, end, zero in runs:
+                    if zero:
+                        self.skip(self.written + start, end - start)
+                    else:
+                        self.write_at(self.written + start, data[start:end])
+            self.write_overlay(self.written, self.written + len(data))
+            self.written += len(data)
+            if self.sync_interval and self.written - self.synced >= self.sync_interval:
+                self.check_cancel()
+                self.sync()
+        except (OSError, WriteCancelled) as e:
+            self.fail(e)
+
+    def write_overlay(self, start, end):
+        """Write the parts of the overlay between start and end"""
+        written = False
+        for offset, data in self.overlay:
+            if offset < end and offset + len(data) > start:
+                first = max(offset, start)
+                last = min(offset + len(data), end)
+                self.write_at(first, data[first - offset:last - offset])
+                written = True
+        return written
+
+    def check_cancel(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise WriteCancelled("Cancelled")
+
+    def write_at(self, offset, data):
+        if self.hole is not None:
+            self.fill_hole()
+        if self.direct and offset % DIRECT_ALIGNMENT == 0:
+            # Write as much as possible directly
+            aligned = len(data) - len(data) % DIRECT_ALIGNMENT
+            self.pwrite(self.fd, data[:aligned], offset)
+            offset += aligned
+            data = data[aligned:]
+        if self.direct:
+            self.pwrite(self.buffered(), data, offset)
+        else:
+            self.pwrite(self.fd, data, offset)
+
+    def pwrite(self, fd, data, offset):
+        done = 0
+        while done < len(data):
+            self.check_cancel()
+            try:
+                done += self.timed(os.pwrite, fd, data[done:], offset + done)
+            except OSError as e:
+                if fd != self.fd or not self.direct or e.errno != errno.EINVAL:
+                    raise
+                # The memory is not aligned
+                fd = self.buffered()
+
+    def buffered(self):
+        if self.buffered_fd is None:
+            self.buffered_fd = os.open(self.path, os.O_WRONLY)
+        return self.buffered_fd
+
+    def sync(self):
+        """Wait for everything written so far to reach the device"""
+        if self.hole is not None:
+            self.fill_hole()
+        self.timed(os.fdatasync, self.fd)
+        if self.buffered_fd is not None:
+            self.timed(os.fdatasync, self.buffered_fd)
+        self.synced = self.written
+
+    def timed(self, function, *args):
+        """Call a function that waits for the device, timing it"""
+        started = time.time()
+        try:
+            return function(*args)
+        finally:
+            self.busy += time.time() - started
+
+    def skip(self, offset, length):
+        self.skipped += length
+        if self.regular and (not self.zero_skipped or offset >= self.old_size):
+            return
+        if not self.fill_skipped:
+            return
+        if self.hole is not None and self.hole[1] == offset:
+            self.hole[1] = offset + length
+        else:
+            if self.hole is not None:
+                self.fill_hole()
+            self.hole = [offset, offset + length]
+
+    def fill_hole(self):
+        """Make sure that the skipped range reads as zeros"""
+        start, end = self.hole
+        self.hole = None
+        if ( not self.regular and self.discard
+             and start % SECTOR_SIZE == 0 and end % SECTOR_SIZE == 0 ):
+            try:
+                if self.discard_zeroes is None:
+                    self.discard_zeroes = self.probe_discard(start, end)
+                    if not self.discard_zeroes:
+                        print("Discarded blocks on", self.path, "do not read as zeros")
+                        self.discard = False
+                if self.discard_zeroes:
+                    self.timed(fcntl.ioctl, self.fd, BLKDISCARD,
+                               struct.pack('QQ', start, end - start))
+                    return
+            except OSError as e:
+                print("Cannot discard on", self.path, "-", e)
+                self.discard = False
+        if ( not self.regular and self.zero_out
+             and start % SECTOR_SIZE == 0 and end % SECTOR_SIZE == 0 ):
+            try:
+                self.timed(fcntl.ioctl, self.fd, BLKZEROOUT,
+                           struct.pack('QQ', start, end - start))
+                return
+            except OSError as e:
+                print("Cannot zero out on", self.path, "-", e)
+                self.zero_out = False
+        with memoryview(self.zeros) as zeros:
+            while start < end:
+                n = min(end - start, len(zeros))
+                self.write_at(start, zeros[:n])
+                start += n
+
+    def probe_discard(self, start, end):
+        """Whether the device reads discarded blocks back as zeros
+
+        The start of a range that is about to be zeroed anyway is filled
+        with ones, discarded and read back. Some USB adapters accept the
+        discard but leave the old data there.
+
+        """
+        end = min(end, start + DISCARD_PROBE_SIZE)
+        self.pwrite(self.buffered(), b'\xff' * (end - start), start)
+        self.timed(os.fdatasync, self.buffered())
+        self.timed(fcntl.ioctl, self.fd, BLKDISCARD, struct.pack('QQ', start, end - start))
+        return self.reads_zeros(start, end)
+
+    def reads_zeros(self, start, end):
+        """Whether a range of the device reads back as zeros"""
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            while start < end:
+                data = os.pread(fd, min(end - start, SPARSE_BLOCK_SIZE), start)
+                if not data:
+                    return False
+                if data.count(0) != len(data):
+                    return False
+                start += len(data)
+            return True
+        finally:
+            os.close(fd)
+
+    def close(self):
+        if self.error is not None:
+            return
+        try:
+            if self.hole is not None:
+                self.fill_hole()
+            if self.regular and os.fstat(self.fd).st_size < self.written:
+                # Trailing zeros were skipped
+                os.ftruncate(self.fd, self.written)
+            if self.buffered_fd is not None:
+                self.timed(os.fsync, self.buffered_fd)
+            self.timed(os.fsync, self.fd)
+            self.synced = self.written
+            self.close_files()
+        except OSError as e:
+            self.fail(e)
+        self.end_time = time.time()
+
+    def close_files(self):
+        for fd in (self.fd, self.buffered_fd):
+            if fd is not None:
+                os.close(fd)
+        self.fd = None
+        self.buffered_fd = None
+        if self.direct:
+            self.zeros.close()
+            self.direct = False
+
+    def fail(self, error):
+        print("Write to", self.path, "failed:", error)
+        self.error = error
+        self.end_time = time.time()
+        try:
+            self.close_files()
+        except OSError:
+            pass
+
+    def seconds(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def bytes_written(self):
+        """Bytes actually written to the device by this writer"""
+        return self.written - self.skipped - min(self.resume, self.written)
+
+def data_runs(buf, length, block_size=SPARSE_BLOCK_SIZE):
+    """Split the start of a buffer into runs of data and runs of zeros
+
+    The buffer is checked a block at a time and adjacent blocks of the same
+    kind are joined together. Returns a list of (start, end, zero) tuples.
+
+    """
+    runs = []
+    for start in range(0, length, block_size):
+        end = min(start + block_size, length)
+        zero = buf.find(ZERO_BLOCK[:end - start], start, end) == start
+        if runs and runs[-1][2] == zero:
+            runs[-1] = (runs[-1][0], end, zero)
+        else:
+            runs.append((start, end, zero))
+    return runs
+
+class ExtentChecksums:
+    """Checksums of the parts of an image that have been written
+
+    Data has to be passed to update in order, along with the runs of data
+    that were skipped, if any. Adjacent data is collected into extents of
+    about EXTENT_SIZE, each with a CRC32 checksum, so that only the parts
+    of a card that were actually written need to be read back.
+
+    exclude is a list of (offset, data), such as the overlays of the cards,
+    whose ranges are left out because they differ from the image.
+
+    """
+    def __init__(self, extent_size=EXTENT_SIZE, exclude=None):
+        self.extent_size = extent_size
+        self.exclude = sorted((offset, offset + len(data)) for offset, data in exclude or [])
+        # List of [start, end, crc32]
+        self.extents = []
+
+    def included(self, start, end):
+        """Split a range into the parts that are not excluded"""
+        parts = []
+        for first, last in self.exclude:
+            if first >= end:
+                break
+            if last <= start:
+                continue
+            if first > start:
+                parts.append((start, first))
+            start = max(start, last)
+        if start < end:
+            parts.append((start, end))
+        return parts
+
+    def update(self, offset, data, runs=None):
+        if runs is None:
+            runs = [ (0, len(data), False) ]
+        if self.exclude:
+            runs = [ (first - offset, last - offset, False)
+                     for start, end, skipped in runs if not skipped
+                     for first, last in self.included(offset + start, offset + end) ]
+        for start, end, skipped in runs:
+            if skipped:
+                continue
+            last = self.extents[-1] if self.extents else None
+            if ( last is not None and last[1] == offset + start
+                 and last[1] - last[0] < self.extent_size ):
+                last[1] = offset + end
+                last[2] = zlib.crc32(data[start:end], last[2])
+            else:
+                self.extents.append([ offset + start, offset + end,
+                                      zlib.crc32(data[start:end]) ])
+
+    def size(self):
+        return sum(end - start for start, end, crc in self.extents)
+
+    def before(self, offset):
+        """Copies of the complete extents that end by offset"""
+        return [ list(e) for e in self.extents if e[1] <= offset ]
+
+def verify_device(path, extents, progress=None, buffer_size=BUFFER_SIZE,
+                  cancel=None):
+    """Read back the extents written to a device and check them
+
+    extents is a list of [start, end, crc32]. If given, progress is called
+    with the device path and the total number of bytes read so far. Setting
+    cancel, a threading.Event, stops the check.
+
+    Returns True if every extent matches.
+
+    """
+    buf = mmap.mmap(-1, buffer_size)
+    view = memoryview(buf)
+    fd = None
+    done = 0
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        # Make sure that the card is read rather than the page cache
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        for start, end, crc in extents:
+            pos = start
+            value = 0
+            while pos < end:
+                if cancel is not None and cancel.is_set():
+                    print("Verify", path, "cancelled")
+                    return False
+                n = os.preadv(fd, [ view[:min(buffer_size, end - pos)] ], pos)
+                if n == 0:
+                    print("Verify", path, "- card is too short at", pos)
+                    return False
+                value = zlib.crc32(view[:n], value)
+                pos += n
+                done += n
+                if progress is not None:
+                    progress(path, done)
+            if value != crc:
+                print("Verify", path, "- mismatch between", start, "and", end)
+                return False
+    except OSError as e:
+        print("Verify", path, "failed:", e)
         return False
+    finally:
+        if fd is not None:
+            os.close(fd)
+        view.release()
+        buf.close()
+    return True
+
+def verify_devices(devices, extents, progress=None, cancel=None):
+    """Verify several devices at the same time
+
+    Returns a dictionary with True or False for each device path.
+
+    """
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(devices)))
+    futures = dict( (device, pool.submit(verify_device, device, extents, progress,
+                                         cancel = cancel))
+                    for device in devices )
+    pool.shutdown()
+    return dict( (device, futures[device].result()) for device in futures )
+
+def load_bmap(image):
+    """The block map of an image, or None if there is no up to date one"""
+    if image.bmap is None:
+        return None
+    try:
+        if os.path.getmtime(image.bmap) < os.path.getmtime(str(image)):
+            print("Block map", image.bmap, "is older than the image")
+            return None
+        return bmap.Bmap.load(image.bmap)
+    except (OSError, ValueError) as e:
+        print("Ignoring block map", image.bmap, "-", e)
+        return None
+
+def save_bmap(image, block_map):
+    """Keep a block map next to the image"""
+    try:
+        block_map.save(image.bmap_path())
+        image.bmap = image.bmap_path()
+    except OSError as e:
+        print("Cannot save block map", image.bmap_path(), "-", e)
+
+class BufferRing:
+    """A fixed set of page aligned buffers passed from a reader to a writer
+
+    Free buffers are filled by the reader and queued for the writer, which
+    hands them back once they have been written. The buffers are reused so
+    that no memory is allocated while an image is written.
+
+    The level is the number of full buffers waiting to be written. If it
+    stays near the depth then the cards are holding things up, and if it
+    stays near zero then reading and decompressing the image is.
+
+    """
+    def __init__(self, depth=BUFFER_DEPTH, buffer_size=BUFFER_SIZE):
+        self.depth = max(depth, 2)
+        self.buffers = [ mmap.mmap(-1, buffer_size) for i in range(self.depth) ]
+        self.views = [ memoryview(buf) for buf in self.buffers ]
+        self.free = queue.Queue()
+        self.full = queue.Queue()
+        for i in range(self.depth):
+            self.free.put(i)
+        self.stopped = False
+        self.reader = None
+        self.levels = 0
+        self.samples = 0
+
+    def start(self, source):
+        """Start reading the source into the buffers in a new thread"""
+        self.reader = threading.Thread(target = self.read, args = (source,))
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read(self, source):
+        try:
+            while True:
+                i = self.free.get()
+                if self.stopped:
+                    break
+                # Fill the buffer so that only the last one is short and
+                # the data stays aligned for direct writes
+                length = 0
+                while length < len(self.views[i]):
+                    with self.views[i][length:] as view:
+                        n = source.readinto(view)
+                    if not n:
+                        break
+                    length += n
+                self.full.put((i, length, None))
+                if not length:
+                    break
+        except Exception as e:
+            self.full.put((None, 0, e))
+
+    def get(self, cancel=None):
+        """Wait for the next full buffer
+
+        Returns its index and the length of data in it, which is 0 at the
+        end of the source. Errors from reading the source are raised here.
+        If cancel, a threading.Event, is set while waiting, the index is
+        None.
+
+        """
+        self.levels += self.full.qsize()
+        self.samples += 1
+        while True:
+            try:
+                i, length, error = self.full.get(timeout=CANCEL_POLL)
+                break
+            except queue.Empty:
+                if cancel is not None and cancel.is_set():
+                    return None, 0
+        if error is not None:
+            raise error
+        return i, length
+
+    def put(self, i):
+        """Hand a buffer back to be filled again"""
+        self.free.put(i)
+
+    def level(self):
+        return self.full.qsize()
+
+    def mean_level(self):
+        """Average level seen by the writer, as a fraction of the depth"""
+        if not self.samples:
+            return 0
+        return self.levels / self.samples / self.depth
+
+    def close(self):
+        self.stopped = True
+        self.free.put(None)
+        if self.reader is not None:
+            self.reader.join()
+        for view in self.views:
+            view.release()
+        for buf in self.buffers:
+            buf.close()
+
+def stream_image(source, devices, progress=None, buffer_size=BUFFER_SIZE,
+                 sparse=False, discard=False, block_map=None, builder=None,
+                 checksums=None, buffers=BUFFER_DEPTH, buffer_level=None,
+                 direct=False, sync_interval=SYNC_INTERVAL, cancel=None,
+                 resume=None, checkpoint=None, overlays=None):
+    """Copy a stream of image data to one or more devices
+
+    The image is decompressed once, by a reader thread, into a BufferRing of
+    page aligned buffers. Each full buffer is written to every device at the
+    same time while the reader carries on filling the others, so no other
+    processes or pipes are involved and a short stall on either side does
+    not hold up the other. If given, progress is called with the device path
+    and the total number of bytes known to be on it after every buffer, and
+    buffer_level with the level and depth of the ring.
+
+    With sparse set, blocks of zeros are not written to the devices. See
+    DeviceWriter for discard, direct and sync_interval.
+
+    Setting cancel, a threading.Event, stops the writing within a fraction
+    of a second. The writers then fail with WriteCancelled.
+
+    resume is a dictionary of how many bytes are already on each device,
+    from an earlier write that was interrupted. If given, checkpoint is
+    called with the device path and the number of bytes known to be on it
+    each time that goes up. overlays is a dictionary of the changes to write
+    over the image on each device, as given by customise.card_overlay.
+
+    Given a block_map, only the mapped blocks are written, the rest being
+    discarded or zeroed, and the data is checked against the map's checksums
+    on the way, raising
+    bmap.ChecksumError if it does not match. Otherwise, a BmapBuilder can be
+    given to build a map of the image.
+
+    If given, checksums is an ExtentChecksums that is updated with the data
+    that is written so that the devices can be verified afterwards.
+
+    Returns a list of DeviceWriter, one per device.
+
+    """
+    if resume is None:
+        resume = {}
+    if overlays is None:
+        overlays = {}
+    # The blocks left out of a block map are zeros in the image, so they
+    # must be zeros on the card as well
+    writers = [ DeviceWriter(device, discard, direct, sync_interval,
+                             resume.get(device, 0), cancel, overlays.get(device),
+                             zero_skipped = block_map is not None)
+                for device in devices ]
+    checkpoints = dict( (w.path, w.resume) for w in writers )
+    ring = BufferRing(buffers, buffer_size)
+    # One more thread for checking or mapping the data
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(writers) + 1)
+    verifier = None
+    if block_map is not None:
+        verifier = bmap.BmapVerifier(block_map)
+
+    def check(offset, buf, data, runs):
+        if verifier is not None:
+            verifier.update(offset, data, runs)
+        if builder is not None:
+            builder.update(buf, len(data))
+        if checksums is not None:
+            # The unmapped blocks of a block map are zeroed, so are checked
+            checksums.update(offset, data, runs if block_map is None else None)
+    pending = []
+    data = None
+    try:
+        ring.start(source)
+        offset = 0
+        while True:
+            i, length = ring.get(cancel)
+            if cancel is not None and cancel.is_set():
+                for w in writers:
+                    if w.error is None:
+                        w.fail(WriteCancelled("Cancelled"))
+            if i is None or not length or all(w.error is not None for w in writers):
+                break
+            if buffer_level is not None:
+                buffer_level(ring.level(), ring.depth)
+            data = ring.views[i][:length]
+            runs = None
+            if block_map is not None:
+                runs = block_map.runs(offset, length)
+            elif sparse:
+                runs = data_runs(ring.buffers[i], length)
+            pending = [ pool.submit(w.write, data, runs)
+                        for w in writers if w.error is None ]
+            if verifier is not None or builder is not None or checksums is not None:
+                pending.append(pool.submit(check, offset, ring.buffers[i], data, runs))
+            # The buffer must be written out before it can be reused
+            concurrent.futures.wait(pending)
+            for future in pending:
+                # Raise any errors from checking the data
+                future.result()
+            pending = []
+            data.release()
+            data = None
+            ring.put(i)
+            if progress is not None:
+                for w in writers:
+                    if w.error is None:
+                        progress(w.path, w.synced)
+            if checkpoint is not None:
+                for w in writers:
+                    if w.error is None and w.synced > checkpoints[w.path]:
+                        checkpoints[w.path] = w.synced
+                        checkpoint(w.path, w.synced)
+            offset += length
+        if (block_map is not None and offset != block_map.image_size
+            and any(w.error is None for w in writers)):
+            raise bmap.ChecksumError("Image is {0} bytes but the block map is for {1}".format(
+                                                offset, block_map.image_size))
+    finally:
+        concurrent.futures.wait(pending)
+        if data is not None:
+            data.release()
+        pool.shutdown()
+        for w in writers:
+            w.close()
+        ring.close()
+        print("Buffers were {0:.0f}% full on average".format(100 * ring.mean_level()))
+    if progress is not None:
+        for w in writers:
+            if w.error is None:
+                progress(w.path, w.synced)
+    return writers
+
+def write_options(config):
+    """Settings for write_image from the [write] section of the config"""
+    options = dict(WRITE_OPTIONS)
+    if config.has_section('write'):
+        for key in options:
+            if config.has_option('write', key):
+                if isinstance(options[key], bool):
+                    options[key] = config.getboolean('write', key)
+                else:
+                    options[key] = config.getint('write', key)
+    return options
+
+def write_image(devices, image, display, options=WRITE_OPTIONS, cancel=None):
+    """Write the image to one or more cards
+
+    Returns a dictionary with True or False for each device path to say
+    whether it was written successfully. Setting cancel, a threading.Event,
+    stops the writing.
+
+    A card that has already had part of the image written to it, according
+    to the journal, is written from where that write stopped.
+
+    If the image has a .custom file, the changes in it are made to each card
+    as it is written.
+
+    """
+    print("Image:", str(image))
+    print("File format:", image.file_format)
+
+    results = dict( (device, False) for device in devices )
+
+    environment = { 'IMGDIR': image.directory }
+    overlays = {}
+    if image.custom is not None:
+        # The changes depend on the variables and have to be ready before
+        # the start of the image is written
+        for var in image.variables:
+            environment[var] = display.question(var, image.variables[var])
+        try:
+            for device in devices:
+                overlays[device] = customise.card_overlay(image.custom,
+                                        image.metadata.get('partitions'),
+                                        dict(environment, DEVICE = device),
+                                        lambda: open_image(image),
+                                        key = (str(image), image.metadata.get('mtime')))
+        except (customise.CustomiseError, OSError) as e:
+            print("Cannot customise", str(image), "-", e)
+            return results
+
+    source = open_image(image)
+    if source is None:
+        return results
+
+    block_map = None
+    builder = None
+    if options['bmap']:
+        block_map = load_bmap(image)
+        if block_map is None:
+            builder = bmap.BmapBuilder()
+
+    if block_map is not None:
+        size = block_map.image_size
+    else:
+        size = image_size(image)
+
+    checksums = None
+    if options['verify'] or options['resume']:
+        checksums = ExtentChecksums(exclude = [ extent for device in overlays
+                                                for extent in overlays[device] ])
+
+    keys = {}
+    resume = {}
+    if options['resume']:
+        for device in devices:
+            keys[device] = card_key(device)
+            if keys[device] is not None:
+                resume[device] = journal.resume_offset(keys[device], image, device)
+                if resume[device]:
+                    print(device, "carries on from", resume[device])
+
+    def checkpoint(device, synced):
+        journal.checkpoint(keys[device], image, synced, checksums.before(synced))
+
+    # The image is written in the background while any variables are
+    # collected
+    state = { 'written': {}, 'writers': [], 'error': None }
+
+    def progress(device, written):
+        state['written'][device] = written
+
+    def buffer_level(level, depth):
+        state['level'] = (level, depth)
+
+    def copy():
+        try:
+            state['writers'] = stream_image(source, devices, progress,
+                                            sparse = options['sparse'],
+                                            buffers = options['buffers'],
+                                            direct = options['direct'],
+                                            sync_interval = max(options['sync'], MIN_SYNC) * 1024 * 1024,
+                                            cancel = cancel,
+                                            resume = resume,
+                                            checkpoint = checkpoint if keys else None,
+                                            overlays = overlays,
+                                            buffer_level = buffer_level,
+                                            discard = options['discard'],
+                                            block_map = block_map,
+                                            builder = builder,
+                                            checksums = checksums)
+        except compression.DECOMPRESSION_ERRORS + (bmap.ChecksumError,) as e:
+            state['error'] = e
+        finally:
+            source.close()
+
+    writer = threading.Thread(target = copy)
+    writer.daemon = True
+    writer.start()
+
+    # Gather required variables, if they have not been already
+    if image.custom is None:
+        for var in image.variables:
+            environment[var] = display.question(var, image.variables[var])
+
+    display.progress_title()
+
+    while writer.is_alive():
+        writer.join(PROGRESS_INTERVAL)
+        if size and state['written']:
+            # Show the slowest card that is still being written, and each
+            # card on its own
+            percents = dict( (device, min(100*state['written'][device]/size, 100))
+                             for device in state['written'] )
+            display.progress(min(percents.values()), devices = percents)
+            for device in sorted(percents):
+                print(device, "completed: " + str(percents[device]) + "%")
+            if 'level' in state:
+                print("Buffers full: {0}/{1}".format(*state['level']))
+
+    if state['error'] is not None:
+        print("Write failed:", state['error'])
+        return results
+
+    if builder is not None and any(w.error is None for w in state['writers']):
+        # The whole image has been read so the map is complete
+        block_map = builder.finish()
+        save_bmap(image, block_map)
+        image_index(os.path.dirname(image.directory)).set_size(image, block_map.image_size)
+
+    for w in state['writers']:
+        if w.error is None:
+            results[w.path] = True
+            print(w.path, "written in", w.seconds(), "seconds")
+            id_path, model = device_identity(w.path)
+            throughput.record(id_path, model, w.bytes_written(), w.busy)
+            if keys.get(w.path) is not None:
+                journal.remove(keys[w.path])
+
+    if options['verify'] and any(results.values()):
+        verified = verify_with_progress([ d for d in results if results[d] ],
+                                        checksums, display, cancel)
+        results.update(verified)
+
+    for device in devices:
+        if cancel is not None and cancel.is_set():
+            break
+        if results[device]:
+            run_post_scripts(device, image, dict(environment), display)
+
+    print("And finished")
+    return results
+
+def verify_with_progress(devices, checksums, display, cancel=None):
+    """Verify written cards, showing the progress and read rate"""
+    size = checksums.size()
+    state = { 'read': {}, 'results': {} }
+
+    def progress(device, read):
+        state['read'][device] = read
+
+    def verify():
+        state['results'] = verify_devices(devices, checksums.extents, progress,
+                                          cancel)
+
+    verifier = threading.Thread(target = verify)
+    verifier.daemon = True
+    start_time = time.time()
+    verifier.start()
+
+    display.progress_title('V')
+
+    while verifier.is_alive():
+        verifier.join(PROGRESS_INTERVAL)
+        if size and state['read']:
+            read = min(state['read'].values())
+            rate = read / (time.time() - start_time) / (1024 * 1024)
+            display.progress(100*read/size, rate)
+            print("Verified: " + str(100*read/size) + "% at", rate, "MB/s")
+
+    return state['results']
+
+def run_post_scripts(device, image, environment, display):
+    """Run the post install scripts of an image against a written card"""
+    if len(image.get_post_scripts()) == 0:
+        return
+
+    environment['DEVICE'] = str(device)
 
     # Find partitions
-    if len(image.get_post_scripts()) > 0:
-        display.write_queue.put( { 'action': 'write',
-                                'pos': [0, 0],
-                                'text': 'Post script:',
-                                'blank': 1 } )
+    display.write_queue.put( { 'action': 'write',
+                            'pos': [0, 0],
+                            'text': 'Post script:',
+                            'blank': 1 } )
 
-        # TODO Do this without an external script
+    display.write_queue.put( { 'action': 'write',
+                            'pos': [0, 1],
+                            'text': 'Refresh device',
+                            'blank': 1 } )
+    partitions = card_partitions(device)
+    for number in partitions:
+        environment["PARTITION{}".format(number)] = partitions[number]
+
+    for script in image.get_post_scripts():
+        script_handle = open( script, 'r' )
+        # Default title - just the file name
+        title = os.path.basename(script)
+        for line in script_handle:
+            m = re.search(r"#TITLE# (.+)", line)
+            if m != None:
+                title = m.group(1)
+                break
         display.write_queue.put( { 'action': 'write',
                                 'pos': [0, 1],
-                                'text': 'Refresh device',
+                                'text': title,
                                 'blank': 1 } )
-        subprocess.call(['/home/pi/Bakery/freshen.sh', device])
-        #environment = { 'IMGDIR': image.directory }
-        pn = 1
-        for partition in pyudev.Context().list_devices(subsystem='block', DEVTYPE='partition'):
-            node = partition.device_node
-            if re.search(r"{}".format(device), node):
-                environment["PARTITION{}".format(pn)] = node
-                pn = pn + 1
-
-        for script in image.get_post_scripts():
-            script_handle = open( script, 'r' )
-            # Default title - just the file name
-            title = os.path.basename(script)
-            for line in script_handle:
-                m = re.search(r"#TITLE# (.+)", line)
-                if m != None:
-                    title = m.group(1)
-                    break
-            display.write_queue.put( { 'action': 'write',
-                                    'pos': [0, 1],
-                                    'text': title,
-                                    'blank': 1 } )
-            script_handle.close()
-            subprocess.call([ script ], env = environment)
+        script_handle.close()
+        subprocess.call([ script ], env = environment)
 
-    print("And finished")
-    return True
+def reread_partitions(device):
+    """Make the kernel read the partition table of a disk again"""
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        for i in range(REREAD_TRIES):
+            try:
+                fcntl.ioctl(fd, BLKRRPART)
+                return True
+            except OSError as e:
+                if e.errno != errno.EBUSY or i == REREAD_TRIES - 1:
+                    print("Cannot reread partitions of", device, "-", e)
+                    return False
+                # Still being closed after writing
+                time.sleep(RESCAN_DELAY)
+    finally:
+        os.close(fd)
 
-def get_device_partitions(device):
-    partitions = []
-    for partition in pyudev.Context().list_devices(subsystem='block', DEVTYPE='partition'):
-        node = partition.device_node
-        if re.search(r"{}".format(str(device)), node):
-            partitions.append(node)
+def disk_partitions(context, device):
+    """Partition nodes of a disk that udev has set up, by number"""
+    partitions = {}
+    try:
+        disk = pyudev.Devices.from_device_file(context, device)
+    except (pyudev.DeviceNotFoundError, ValueError, OSError):
+        return partitions
+    for child in disk.children:
+        if child.device_type != 'partition' or child.device_node is None:
+            continue
+        try:
+            number = child.attributes.asint('partition')
+        except (KeyError, ValueError):
+            continue
+        if child.is_initialized and os.path.exists(child.device_node):
+            partitions[number] = child.device_node
     return partitions
 
+def card_partitions(device, timeout=PARTITION_WAIT):
+    """Reload the partition table of a card and find its partitions
+
+    The partition table that has just been written is read from the card
+    and the kernel is asked to reread it. Then the partition nodes of this
+    disk, and no other, are waited for with udev.
+
+    Returns a dictionary of the partition paths by number.
+
+    """
+    try:
+        with open(device, 'rb') as fl:
+            table = read_partition_table(fl.read(PARTITION_TABLE_SIZE))
+    except OSError as e:
+        print("Cannot read partition table of", device, "-", e)
+        return {}
+    if not table:
+        return {}
+    expected = set(p['number'] for p in table['partitions'])
+
+    context = pyudev.Context()
+    # Start listening before the partitions are reread so that no events
+    # are missed
+    monitor = pyudev.Monitor.from_netlink(context)
+    monitor.filter_by('block', device_type='partition')
+    monitor.start()
+    reread_partitions(device)
+
+    end_time = time.time() + timeout
+    partitions = disk_partitions(context, device)
+    while not expected <= set(partitions) and time.time() < end_time:
+        monitor.poll(timeout=max(end_time - time.time(), 0))
+        partitions = disk_partitions(context, device)
+    if not expected <= set(partitions):
+        print("Partitions of", device, "missing:", sorted(expected - set(partitions)))
+    return dict( (n, partitions[n]) for n in partitions if n in expected )
+
+def get_device_partitions(device):
+    """Paths of the partitions of a disk that are there already"""
+    partitions = disk_partitions(pyudev.Context(), str(device))
+    return [ partitions[n] for n in sorted(partitions) ]
+
 def mount(path):
     directory = tempfile.mkdtemp()
     try:
@@ -327,12 +1984,38 @@ def umount(directory):
     except CalledProcessError:
         return False
 
+def compress_images(pth):
+    """Recompress the gzipped images in a directory as blocked gzip files
+
+    Blocked gzip files can be decompressed on all the cores at once when
+    they are written. Images that are already blocked, or in other formats,
+    are left as they are, as is any image that cannot be recompressed.
+
+    """
+    for fl in os.listdir(pth):
+        path = pth + '/' + fl
+        if compression.image_format(fl) != 'img.gz':
+            continue
+        try:
+            if compression.is_blocked_gzip(path):
+                continue
+            with compression.open_image(path, 'img.gz') as source:
+                compression.compress_blocked_gzip(source, path + '.blocked')
+            os.rename(path + '.blocked', path)
+        except compression.DECOMPRESSION_ERRORS as e:
+            # Corrupt, or no space for the copy
+            print("Cannot recompress", path, "-", e)
+            try:
+                os.remove(path + '.blocked')
+            except OSError:
+                pass
+
 def scan(path):
     images = {}
     for root, dirs, files in os.walk(path, topdown=False):
         for name in files:
-            m = re.search(r"^(.+).img.gz$", str(name))
-            if m != None:
-                images[root] = m.group(1)
+            file_format = compression.image_format(str(name))
+            if file_format != None:
+                images[root] = str(name)[:-len(file_format) - 1]
 
     return images
@@ -1,5 +1,7 @@
+import collections
+import errno
+import os
 import threading
-import multiprocessing
 import select
 import time
 from .core import get_bit_num
@@ -90,13 +92,65 @@ class PinFunctionMap(FunctionMap):
                         direction=self.direction)
 
 
+class PinFunctionTable(object):
+    """Function maps indexed by pin number and direction.
+
+    The maps and their index are kept together in a tuple that is replaced
+    rather than changed, so events are looked up without taking a lock and
+    a whole set of maps made in advance can be swapped in at once with
+    :meth:`use`.
+    """
+    def __init__(self, function_maps=()):
+        self.lock = threading.Lock()
+        self.bindings = _index_pin_function_maps(function_maps)
+
+    def __iter__(self):
+        return iter(self.bindings[0])
+
+    def __len__(self):
+        return len(self.bindings[0])
+
+    def register(self, pin_num, direction, callback,
+                 settle_time=DEFAULT_SETTLE_TIME):
+        """Adds a map from a pin number and direction to a function."""
+        self.append(PinFunctionMap(pin_num, direction, callback, settle_time))
+
+    def append(self, pin_function_map):
+        with self.lock:
+            self.bindings = _index_pin_function_maps(
+                self.bindings[0] + (pin_function_map,))
+
+    def remove(self, pin_num=None, direction=None):
+        """Removes the maps for a pin and direction, a pin, or every pin."""
+        with self.lock:
+            self.bindings = _index_pin_function_maps(
+                fm for fm in self.bindings[0]
+                if not (pin_num is None or (
+                    fm.pin_num == pin_num and (
+                        direction is None or fm.direction == direction))))
+
+    def use(self, other):
+        """Replaces every map with those of another table."""
+        with self.lock:
+            self.bindings = other.bindings
+
+    def matching(self, event):
+        """Returns the maps that match an event."""
+        return self.bindings[1].get((event.pin_num, event.direction), ())
+
+
 class EventQueue(object):
-    """Stores events in a queue."""
+    """Stores events in a queue.
+
+    Events are passed between threads of one process, so nothing is pickled
+    and the queue sees the same function maps as the listener that owns it.
+    """
     def __init__(self, pin_function_maps):
         super(EventQueue, self).__init__()
         self.last_event_time = [0]*8  # last event time on each pin
         self.pin_function_maps = pin_function_maps
-        self.queue = multiprocessing.Queue()
+        self.queue = collections.deque()
+        self.ready = threading.Condition(threading.Lock())
 
     def add_event(self, event):
         """Adds events to the queue. Will ignore events that occur before the
@@ -106,11 +160,8 @@ class EventQueue(object):
         # print("Trying to add event:")
         # print(event)
         # find out the pin settle time
-        for pin_function_map in self.pin_function_maps:
+        for pin_function_map in _candidate_maps(self.pin_function_maps, event):
             if _event_matches_pin_function_map(event, pin_function_map):
-            # if pin_function_map.pin_num == event.pin_num and (
-            #         pin_function_map.direction == event.direction or
-            #         pin_function_map.direction == IODIR_BOTH):
                 pin_settle_time = pin_function_map.settle_time
                 # print("EventQueue: Found event in map.")
                 break
@@ -127,10 +178,15 @@ class EventQueue(object):
             self.last_event_time[event.pin_num] = event.timestamp
 
     def put(self, thing):
-        self.queue.put(thing)
+        with self.ready:
+            self.queue.append(thing)
+            self.ready.notify()
 
     def get(self):
-        return self.queue.get()
+        with self.ready:
+            while not self.queue:
+                self.ready.wait()
+            return self.queue.popleft()
 
 
 class PortEventListener(object):
@@ -150,16 +206,23 @@ class PortEventListener(object):
     def __init__(self, port, chip, return_after_kbdint=True):
         self.port = port
         self.chip = chip
-        self.pin_function_maps = list()
+        self.pin_function_maps = PinFunctionTable()
         self.event_queue = EventQueue(self.pin_function_maps)
-        self.detector = multiprocessing.Process(
+        # written to when deactivated to wake up the detector
+        self.stop_read, self.stop_write = os.pipe()
+        # The detector is a thread rather than a process so that it shares
+        # the function maps, and events reach the dispatcher without being
+        # pickled.
+        self.detector = threading.Thread(
             target=watch_port_events,
             args=(
                 self.port,
                 self.chip,
                 self.pin_function_maps,
                 self.event_queue,
-                return_after_kbdint))
+                return_after_kbdint,
+                self.stop_read))
+        self.detector.daemon = True
         self.dispatcher = threading.Thread(
             target=handle_events,
             args=(
@@ -167,6 +230,7 @@ class PortEventListener(object):
                 self.event_queue,
                 _event_matches_pin_function_map,
                 PortEventListener.TERMINATE_SIGNAL))
+        self.dispatcher.daemon = True
 
     def register(self, pin_num, direction, callback,
                  settle_time=DEFAULT_SETTLE_TIME):
@@ -194,15 +258,15 @@ class PortEventListener(object):
                           given pin are de-registered
         :type direction:int
         """
-        to_delete = []
-        for i, function_map in enumerate(self.pin_function_maps):
-            if ( pin_num == None
-                 or ( function_map.pin_num == pin_num
-                      and ( direction == None
-                            or function_map.direction == direction ) ) ):
-                to_delete.append(i)
-        for i in reversed(to_delete):
-            del self.pin_function_maps[i]
+        self.pin_function_maps.remove(pin_num, direction)
+
+    def bind(self, pin_function_table):
+        """Replaces every registered function with those in a table at once.
+
+        :param pin_function_table: The functions to use from now on.
+        :type pin_function_table: :class:`PinFunctionTable`
+        """
+        self.pin_function_maps.use(pin_function_table)
 
     def activate(self):
         """When activated the :class:`PortEventListener` will run callbacks
@@ -215,10 +279,12 @@ class PortEventListener(object):
         """When deactivated the :class:`PortEventListener` will not run
         anything.
         """
+        os.write(self.stop_write, b'x')
+        self.detector.join()
         self.event_queue.put(self.TERMINATE_SIGNAL)
         self.dispatcher.join()
-        self.detector.terminate()
-        self.detector.join()
+        os.close(self.stop_read)
+        os.close(self.stop_write)
 
 
 class GPIOInterruptDevice(object):
@@ -249,8 +315,32 @@ def _event_matches_pin_function_map(event, pin_function_map):
     return pin_match and direction_match
 
 
+def _index_pin_function_maps(function_maps):
+    """Returns the maps as a tuple and a dictionary of tuples of them by pin
+    number and direction.
+    """
+    function_maps = tuple(function_maps)
+    index = dict()
+    for fm in function_maps:
+        if fm.direction is None:
+            directions = (IODIR_FALLING_EDGE, IODIR_RISING_EDGE)
+        else:
+            directions = (fm.direction,)
+        for direction in directions:
+            key = (fm.pin_num, direction)
+            index[key] = index.get(key, ()) + (fm,)
+    return function_maps, index
+
+
+def _candidate_maps(function_maps, event):
+    """Returns the maps that an event might match."""
+    if isinstance(function_maps, PinFunctionTable):
+        return function_maps.matching(event)
+    return function_maps
+
+
 def watch_port_events(port, chip, pin_function_maps, event_queue,
-                      return_after_kbdint=False):
+                      return_after_kbdint=False, stop_fd=None):
     """Waits for a port event. When a port event occurs it is placed onto the
     event queue.
 
@@ -262,12 +352,17 @@ def watch_port_events(port, chip, pin_function_maps, event_queue,
         :class:`FunctionMap`\ s describing what to do with events.
     :type pin_function_maps: list
     :param event_queue: A queue to put events on.
-    :type event_queue: :py:class:`multiprocessing.Queue`
+    :type event_queue: :class:`EventQueue`
+    :param stop_fd: A file descriptor which, when readable, causes this
+        function to return.
+    :type stop_fd: int
     """
     # set up epoll
     gpio25 = open(GPIO_INTERRUPT_DEVICE_VALUE, 'r')  # change to use 'with'?
     epoll = select.epoll()
     epoll.register(gpio25, select.EPOLLIN | select.EPOLLET)
+    if stop_fd is not None:
+        epoll.register(stop_fd, select.EPOLLIN)
 
     while True:
         # wait here until input
@@ -275,7 +370,7 @@ def watch_port_events(port, chip, pin_function_maps, event_queue,
             events = epoll.poll()
         except KeyboardInterrupt as e:
             if return_after_kbdint:
-                return
+                break
             else:
                 raise e
         except IOError as e:
@@ -283,6 +378,10 @@ def watch_port_events(port, chip, pin_function_maps, event_queue,
             # I don't really like this solution. Ignoring problems is bad!
             if e.errno != errno.EINTR:
                 raise
+            continue
+
+        if stop_fd is not None and any(fd == stop_fd for fd, mask in events):
+            break
 
         # find out where the interrupt came from and put it on the event queue
         if port == pifacecommon.mcp23s17.GPIOA:
@@ -301,6 +400,7 @@ def watch_port_events(port, chip, pin_function_maps, event_queue,
                 interrupt_flag, interrupt_capture, chip, time.time()))
 
     epoll.close()
+    gpio25.close()
 
 
 def handle_events(
@@ -312,7 +412,7 @@ def handle_events(
         :class:`FunctionMap`\ s describing what to do with events.
     :type function_maps: list
     :param event_queue: A queue to put events on.
-    :type event_queue: :py:class:`multiprocessing.Queue`
+    :type event_queue: :class:`EventQueue`
     :param event_matches_function_map: A function that determines if the given
         event and :class:`FunctionMap` match.
     :type event_matches_function_map: function
@@ -325,13 +425,10 @@ def handle_events(
         # print("HANDLE: It's an event!")
         if event == terminate_signal:
             return
-        # if matching get the callback function, else function is None
-        functions = map(
-            lambda fm: fm.callback
-            if event_matches_function_map(event, fm) else None,
-            function_maps)
-        # reduce to just the callback functions (remove None)
-        functions = [f for f in functions if f is not None ]
+        # only the maps for the event's pin and direction are looked at
+        functions = [fm.callback
+                     for fm in _candidate_maps(function_maps, event)
+                     if event_matches_function_map(event, fm)]
 
         for function in functions:
             function(event)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import unittest
+from lib.bmap import *
+
+class BmapTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dr = '/tmp/bakery_tests_bmap'
+        self.tearDown()
+        os.makedirs(self.dr)
+        # Blocks 0-1 and 5 hold data, with a partial block at the end
+        self.data = ( os.urandom(2 * BLOCK_SIZE) + bytes(3 * BLOCK_SIZE)
+                      + os.urandom(BLOCK_SIZE) + bytes(BLOCK_SIZE) + b'tail' )
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dr)
+        except OSError as e:
+            pass
+
+    def build(self, chunk):
+        builder = BmapBuilder()
+        for i in range(0, len(self.data), chunk):
+            buf = self.data[i:i + chunk]
+            builder.update(buf, len(buf))
+        return builder.finish()
+
+    def test_build(self):
+        bm = self.build(len(self.data))
+        self.assertEqual(bm.image_size, len(self.data))
+        self.assertEqual([ r[:2] for r in bm.ranges ], [ [0, 1], [5, 5], [7, 7] ])
+        self.assertEqual(bm.ranges[0][2],
+                         hashlib.sha256(self.data[:2 * BLOCK_SIZE]).hexdigest())
+        self.assertEqual(bm.ranges[2][2], hashlib.sha256(b'tail').hexdigest())
+
+    def test_build_in_uneven_chunks(self):
+        self.assertEqual(self.build(1000).ranges, self.build(len(self.data)).ranges)
+
+    def test_save_and_load(self):
+        bm = self.build(len(self.data))
+        bm.save(self.dr + '/image.bmap')
+        loaded = Bmap.load(self.dr + '/image.bmap')
+        self.assertEqual(loaded.image_size, bm.image_size)
+        self.assertEqual(loaded.block_size, bm.block_size)
+        self.assertEqual(loaded.ranges, bm.ranges)
+
+    def test_load_corrupted(self):
+        self.build(len(self.data)).save(self.dr + '/image.bmap')
+        with open(self.dr + '/image.bmap') as fl:
+            text = fl.read()
+        with open(self.dr + '/image.bmap', 'w') as fl:
+            fl.write(text.replace('> 5 <', '> 6 <'))
+        self.assertRaises(ValueError, Bmap.load, self.dr + '/image.bmap')
+
+    def test_runs(self):
+        bm = self.build(len(self.data))
+        self.assertEqual(bm.runs(0, 3 * BLOCK_SIZE),
+                         [ (0, 2 * BLOCK_SIZE, False), (2 * BLOCK_SIZE, 3 * BLOCK_SIZE, True) ])
+        self.assertEqual(bm.runs(5 * BLOCK_SIZE + 10, 10), [ (0, 10, False) ])
+
+    def test_verify(self):
+        bm = self.build(len(self.data))
+        verifier = BmapVerifier(bm)
+        verifier.update(0, self.data, bm.runs(0, len(self.data)))
+
+    def test_verify_bad_data(self):
+        bm = self.build(len(self.data))
+        bad = bytearray(self.data)
+        bad[5 * BLOCK_SIZE] ^= 1
+        verifier = BmapVerifier(bm)
+        self.assertRaises(ChecksumError, verifier.update, 0, bad, bm.runs(0, len(bad)))
@@ -0,0 +1,162 @@
+import bz2
+import gzip
+import lzma
+import os
+import shutil
+import unittest
+import zipfile
+import zlib
+from lib.compression import *
+from lib.utils import compress_images, disk_image_list, open_image as open_disk_image
+
+class CompressionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dr = '/tmp/bakery_tests_compression'
+        self.tearDown()
+        os.makedirs(self.dr + '/image')
+        self.data = os.urandom(100 * 1024) + bytes(100 * 1024)
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dr)
+        except OSError as e:
+            pass
+
+    def read(self, path, file_format):
+        with open_image(path, file_format) as source:
+            return source.read()
+
+    def test_image_format(self):
+        self.assertEqual(image_format('image.img'), 'img')
+        self.assertEqual(image_format('image.img.gz'), 'img.gz')
+        self.assertEqual(image_format('2014-06-20-wheezy.zip'), 'zip')
+        self.assertEqual(image_format('image.post.1'), None)
+        self.assertEqual(image_format('image.gz'), None)
+        self.assertEqual(image_format('.img'), None)
+
+    def test_gzip(self):
+        path = self.dr + '/image.img.gz'
+        with gzip.open(path, 'wb') as fl:
+            fl.write(self.data)
+        self.assertEqual(self.read(path, 'img.gz'), self.data)
+        info = get_codec('img.gz').info(path)
+        self.assertEqual(info['size'], len(self.data))
+        self.assertEqual(info['crc32'], zlib.crc32(self.data))
+        self.assertFalse(info['exact'])
+
+    def test_xz(self):
+        path = self.dr + '/image.img.xz'
+        with lzma.open(path, 'wb') as fl:
+            fl.write(self.data)
+        self.assertEqual(self.read(path, 'img.xz'), self.data)
+        self.assertEqual(get_codec('img.xz').info(path),
+                         { 'size': len(self.data), 'exact': True })
+
+    def test_xz_streams(self):
+        path = self.dr + '/image.img.xz'
+        with open(path, 'wb') as fl:
+            fl.write(lzma.compress(self.data[:1000]))
+            fl.write(lzma.compress(self.data[1000:]))
+        self.assertEqual(self.read(path, 'img.xz'), self.data)
+        self.assertEqual(get_codec('img.xz').info(path),
+                         { 'size': len(self.data), 'exact': True })
+
+    def test_bzip2(self):
+        path = self.dr + '/image.img.bz2'
+        with bz2.open(path, 'wb') as fl:
+            fl.write(self.data)
+        self.assertEqual(self.read(path, 'img.bz2'), self.data)
+        self.assertEqual(get_codec('img.bz2').info(path), {})
+
+    def test_zip(self):
+        path = self.dr + '/image.zip'
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('README', b'Not the image')
+            zf.writestr('2014-06-20-wheezy-raspbian.img', self.data)
+        self.assertEqual(self.read(path, 'zip'), self.data)
+        info = get_codec('zip').info(path)
+        self.assertEqual(info['size'], len(self.data))
+        self.assertEqual(info['crc32'], zlib.crc32(self.data))
+
+    def test_zip_of_directories(self):
+        path = self.dr + '/image.zip'
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr('image/', b'')
+        with self.assertRaises(DECOMPRESSION_ERRORS):
+            get_codec('zip').info(path)
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        path = self.dr + '/image.img.zst'
+        with open(path, 'wb') as fl:
+            fl.write(zstandard.ZstdCompressor().compress(self.data))
+        self.assertEqual(self.read(path, 'img.zst'), self.data)
+        self.assertEqual(get_codec('img.zst').info(path)['size'], len(self.data))
+
+    def test_image_list(self):
+        with lzma.open(self.dr + '/image/image.img.xz', 'wb') as fl:
+            fl.write(self.data)
+        open(self.dr + '/image/image.post.1', 'w').close()
+        image = disk_image_list(self.dr)[0]
+        self.assertEqual(image.file_format, 'img.xz')
+        self.assertEqual(image.post, [ self.dr + '/image/image.post.1' ])
+        self.assertEqual(image.metadata['size'], len(self.data))
+        with open_disk_image(image) as source:
+            self.assertEqual(source.read(), self.data)
+
+    def test_blocked_gzip(self):
+        data = os.urandom(GZIP_BLOCK_SIZE) + bytes(GZIP_BLOCK_SIZE) + b'end'
+        path = self.dr + '/image.img.gz'
+        with open(self.dr + '/image.img', 'wb') as fl:
+            fl.write(data)
+        with open(self.dr + '/image.img', 'rb') as source:
+            compress_blocked_gzip(source, path, threads=2)
+        self.assertTrue(is_blocked_gzip(path))
+        self.assertEqual(get_codec('img.gz').info(path),
+                         { 'size': len(data), 'exact': True, 'crc32': zlib.crc32(data) })
+        # It is still an ordinary gzip file
+        with gzip.open(path, 'rb') as fl:
+            self.assertEqual(fl.read(), data)
+        with open_image(path, 'img.gz') as source:
+            self.assertIsInstance(source, ParallelGzipReader)
+            buf = bytearray(1000 * 1000)
+            read = b''
+            while True:
+                n = source.readinto(buf)
+                if not n:
+                    break
+                read += buf[:n]
+        self.assertEqual(read, data)
+
+    def test_bgzf_size_is_unknown(self):
+        path = self.dr + '/image.img.gz'
+        with open(path, 'wb') as fl:
+            fl.write(BGZF_EOF)
+        self.assertTrue(is_blocked_gzip(path))
+        self.assertEqual(get_codec('img.gz').info(path), {})
+
+    def test_compress_images(self):
+        path = self.dr + '/image/image.img.gz'
+        with gzip.open(path, 'wb') as fl:
+            fl.write(self.data)
+        self.assertFalse(is_blocked_gzip(path))
+        compress_images(self.dr + '/image')
+        self.assertTrue(is_blocked_gzip(path))
+        self.assertEqual(self.read(path, 'img.gz'), self.data)
+
+    def test_compress_truncated_image(self):
+        truncated = self.dr + '/image/a.img.gz'
+        with gzip.open(truncated, 'wb') as fl:
+            fl.write(self.data)
+        with open(truncated, 'r+b') as fl:
+            fl.truncate(os.path.getsize(truncated) // 2)
+        path = self.dr + '/image/b.img.gz'
+        with gzip.open(path, 'wb') as fl:
+            fl.write(self.data)
+        compress_images(self.dr + '/image')
+        # The truncated image is left alone with nothing next to it
+        self.assertEqual(sorted(os.listdir(self.dr + '/image')), [ 'a.img.gz', 'b.img.gz' ])
+        self.assertFalse(is_blocked_gzip(truncated))
+        self.assertTrue(is_blocked_gzip(path))
+        self.assertEqual(self.read(path, 'img.gz'), self.data)
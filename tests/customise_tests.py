@@ -0,0 +1,201 @@
+import os
+import shutil
+import struct
+import unittest
+from lib.customise import *
+from lib.fat import Fat, FatError
+import lib.utils as utils
+
+class Disk:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, offset, length):
+        return bytes(self.data[offset:offset + length])
+
+    def write(self, offset, data):
+        self.data[offset:offset + len(data)] = data
+
+def make_fat(sectors, fat32=False):
+    """An empty FAT16 or FAT32 filesystem"""
+    data = bytearray(sectors * 512)
+    cluster_sectors = 1 if fat32 else 4
+    reserved = 32 if fat32 else 1
+    root_entries = 0 if fat32 else 512
+    entry_bytes = 4 if fat32 else 2
+    root_sectors = root_entries * 32 // 512
+    fat_sectors = 1
+    while True:
+        clusters = (sectors - reserved - 2 * fat_sectors - root_sectors) // cluster_sectors
+        needed = ((clusters + 2) * entry_bytes + 511) // 512
+        if needed <= fat_sectors:
+            break
+        fat_sectors = needed
+    data[0:3] = b'\xeb\x3c\x90'
+    struct.pack_into('<HBHBHHBH', data, 11, 512, cluster_sectors, reserved, 2,
+                     root_entries, 0 if fat32 else sectors, 0xf8, 0 if fat32 else fat_sectors)
+    struct.pack_into('<I', data, 32, sectors)
+    if fat32:
+        struct.pack_into('<IHHIHH', data, 36, fat_sectors, 0, 0, 2, 1, 6)
+    data[510:512] = b'\x55\xaa'
+    for i in range(2):
+        fat = (reserved + i * fat_sectors) * 512
+        if fat32:
+            struct.pack_into('<III', data, fat, 0x0ffffff8, 0x0fffffff, 0x0fffffff)
+        else:
+            struct.pack_into('<HH', data, fat, 0xfff8, 0xffff)
+    return data
+
+class FatTests(unittest.TestCase):
+
+    def setUp(self):
+        self.disk = Disk(make_fat(32768))
+        self.fs = Fat(self.disk)
+
+    def test_fat16(self):
+        self.assertFalse(self.fs.fat32)
+        self.assertEqual(self.fs.listdir(), [])
+
+    def test_new_file(self):
+        self.fs.write_file('ssh', b'')
+        self.fs.write_file('CONFIG.TXT', b'gpu_mem=16\n')
+        fs = Fat(self.disk)
+        self.assertEqual([ e['name'] for e in fs.listdir() ], [ 'ssh', 'CONFIG.TXT' ])
+        self.assertEqual(fs.read_file('ssh'), b'')
+        self.assertEqual(fs.read_file('config.txt'), b'gpu_mem=16\n')
+        self.assertIsNone(fs.read_file('missing'))
+
+    def test_long_name(self):
+        data = os.urandom(5000)
+        self.fs.write_file('wpa_supplicant.conf', data)
+        fs = Fat(self.disk)
+        entry = fs.listdir()[0]
+        self.assertEqual(entry['name'], 'wpa_supplicant.conf')
+        self.assertEqual(entry['short'], b'WPA_SU~1CON')
+        self.assertEqual(len(fs.chain(entry['cluster'])), 3)
+        self.assertEqual(fs.read_file('wpa_supplicant.conf'), data)
+
+    def test_replace_file(self):
+        self.fs.write_file('cmdline.txt', os.urandom(10000))
+        self.fs.write_file('cmdline.txt', b'console=tty1')
+        fs = Fat(self.disk)
+        self.assertEqual(fs.read_file('cmdline.txt'), b'console=tty1')
+        self.assertEqual(len(fs.listdir()), 1)
+        # The clusters of the old file are free again
+        used = [ n for n in range(2, fs.n_clusters + 2) if fs.entry(n) ]
+        self.assertEqual(len(used), 1)
+
+    def test_fat32_directory_grows(self):
+        self.disk = Disk(make_fat(80000, fat32=True))
+        fs = Fat(self.disk)
+        self.assertTrue(fs.fat32)
+        for i in range(20):
+            fs.write_file('long file name {0}.txt'.format(i), str(i).encode('ascii'))
+        fs = Fat(self.disk)
+        # Three entries for each file and sixteen in each cluster
+        self.assertEqual(len(fs.chain(fs.root_cluster)), 4)
+        self.assertEqual(fs.read_file('long file name 19.txt'), b'19')
+
+    def test_no_filesystem(self):
+        self.assertRaises(FatError, Fat, Disk(bytearray(4096)))
+
+class CustomiseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dr = '/tmp/bakery_tests_customise'
+        self.tearDown()
+        os.makedirs(self.dr + '/store/image')
+        # An MBR with a FAT16 partition 1MB in
+        mbr = bytearray(512)
+        mbr[446 + 4] = 0x0e
+        struct.pack_into('<II', mbr, 446 + 8, 2048, 32768)
+        mbr[510:512] = b'\x55\xaa'
+        fs = Disk(make_fat(32768))
+        Fat(fs).write_file('config.txt', b'# Settings\ngpu_mem=64\n')
+        self.data = bytes(mbr) + bytes(2048 * 512 - 512) + bytes(fs.data) + os.urandom(4096)
+        self.path = self.dr + '/store/image/image.img'
+        with open(self.path, 'wb') as fl:
+            fl.write(self.data)
+        with open(self.dr + '/store/image/image.vars', 'w') as fl:
+            fl.write('HOST:pi\n')
+        with open(self.dr + '/store/image/wifi.conf', 'w') as fl:
+            fl.write('network={}\n')
+        with open(self.dr + '/store/image/image.custom', 'w') as fl:
+            fl.write('# Set up the card\n'
+                     'write ssh\n'
+                     'write hostname $HOST\n'
+                     'copy wifi.conf wpa_supplicant.conf\n'
+                     'set config.txt gpu_mem=16\n')
+        self.table = utils.read_partition_table(self.data[:utils.PARTITION_TABLE_SIZE])
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dr)
+        except OSError as e:
+            pass
+        utils.indexes.clear()
+
+    def apply(self, extents):
+        data = bytearray(self.data)
+        for offset, change in extents:
+            data[offset:offset + len(change)] = change
+        return Fat(Disk(data), 2048 * 512)
+
+    def test_read_custom(self):
+        self.assertEqual(read_custom(self.dr + '/store/image/image.custom', { 'HOST': 'pi7' }),
+                         (None, [ ('write', 'ssh', None),
+                                  ('write', 'hostname', 'pi7'),
+                                  ('copy', self.dr + '/store/image/wifi.conf', 'wpa_supplicant.conf'),
+                                  ('set', 'config.txt', 'gpu_mem=16') ]))
+
+    def test_bad_line(self):
+        with open(self.dr + '/store/image/image.custom', 'w') as fl:
+            fl.write('mount /dev/sda2\n')
+        self.assertRaises(CustomiseError, read_custom,
+                          self.dr + '/store/image/image.custom', {})
+
+    def test_set_key(self):
+        self.assertEqual(set_key('a=1\nb=2', 'b=3'), 'a=1\nb=3\n')
+        self.assertEqual(set_key('a=1\n', 'c=3'), 'a=1\nc=3\n')
+
+    def test_card_overlay(self):
+        extents = card_overlay(self.dr + '/store/image/image.custom', self.table,
+                               { 'HOST': 'pi7' }, lambda: open(self.path, 'rb'))
+        # Only a few blocks of the boot partition change
+        self.assertLess(sum(len(data) for offset, data in extents), 64 * 1024)
+        self.assertTrue(all(offset >= 2048 * 512 for offset, data in extents))
+        fs = self.apply(extents)
+        self.assertEqual(fs.read_file('hostname'), b'pi7\n')
+        self.assertEqual(fs.read_file('ssh'), b'')
+        self.assertEqual(fs.read_file('wpa_supplicant.conf'), b'network={}\n')
+        self.assertEqual(fs.read_file('config.txt'), b'# Settings\ngpu_mem=16\n')
+
+    def test_no_fat_partition(self):
+        table = { 'scheme': 'mbr', 'disk_size': 0,
+                  'partitions': [ { 'number': 1, 'type': '83', 'start': 0, 'size': 0 } ] }
+        self.assertRaises(CustomiseError, card_overlay, self.dr + '/store/image/image.custom',
+                          table, {}, lambda: open(self.path, 'rb'))
+
+    def test_write_image(self):
+        class Display:
+            write_queue = None
+            def question(self, label, fmt):
+                return 'pi9'
+            def progress_title(self, title='Complete:'):
+                pass
+            def progress(self, percent, rate=None, devices=None):
+                pass
+        devices = [ self.dr + '/device1', self.dr + '/device2' ]
+        for device in devices:
+            open(device, 'wb').close()
+        image = utils.disk_image_list(self.dr + '/store')[0]
+        self.assertEqual(image.custom, self.dr + '/store/image/image.custom')
+        options = dict(utils.WRITE_OPTIONS, verify=True, resume=False, bmap=False)
+        results = utils.write_image(devices, image, Display(), options)
+        self.assertEqual(results, dict( (device, True) for device in devices ))
+        for device in devices:
+            with open(device, 'rb') as fl:
+                data = fl.read()
+            fs = Fat(Disk(bytearray(data)), 2048 * 512)
+            self.assertEqual(fs.read_file('hostname'), b'pi9\n')
+            self.assertEqual(data[-4096:], self.data[-4096:])
@@ -1,3 +1,5 @@
+import os
+import shutil
 import unittest
 from lib.diskdetector import *
 
@@ -72,3 +74,143 @@ class DiskEventListenerTests(unittest.TestCase):
         self.dl.remove_disk(event_remove_disk)
         self.assertFalse(self.dl.device_present(0))
 
+
+class DeviceIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dl = DiskEventListener()
+        # Only the test devices
+        for d in list(self.dl):
+            self.dl.remove(d)
+
+    def test_find_by_port(self):
+        self.dl.add_device(DeviceEvent('add_device', '/dev/sdx', 'Reader', 'usb-port-1'))
+        self.assertIs(self.dl.find('/dev/sdy', 'usb-port-1'), self.dl[0])
+        self.assertIs(self.dl.find('/dev/sdx'), self.dl[0])
+
+    def test_path_reused(self):
+        self.dl.add_device(DeviceEvent('add_device', '/dev/sdx', 'Reader 1', 'usb-port-1'))
+        # The remove event was missed and the path has gone to another reader
+        self.dl.add_device(DeviceEvent('add_device', '/dev/sdx', 'Reader 2', 'usb-port-2'))
+        self.assertEqual([ d.model for d in self.dl ], [ 'Reader 2' ])
+        self.assertIsNone(self.dl.find('/dev/sdz', 'usb-port-1'))
+
+    def test_replugged_at_new_path(self):
+        self.dl.add_device(DeviceEvent('add_device', '/dev/sdx', 'Reader', 'usb-port-1'))
+        drive = self.dl[0]
+        self.dl.add_device(DeviceEvent('add_device', '/dev/sdy', 'Reader', 'usb-port-1'))
+        self.assertEqual(list(self.dl), [ drive ])
+        self.assertEqual(drive.path, '/dev/sdy')
+        self.assertIsNone(self.dl.find('/dev/sdx'))
+
+    def test_remove_unknown_device(self):
+        self.dl.remove_device(DeviceEvent('remove_device', '/dev/sdx', None, 'usb-port-1'))
+        self.assertEqual(len(self.dl), 0)
+
+    def test_disk_follows_port(self):
+        self.dl.add_device(DeviceEvent('add_device', '/dev/sdx', 'Reader', 'usb-port-1'))
+        self.dl.add_disk(DeviceEvent('add_disk', '/dev/sdx', id_path = 'usb-port-1'))
+        self.assertTrue(self.dl.device_present(0))
+        self.dl.remove_device(DeviceEvent('remove_device', '/dev/sdx', None, 'usb-port-1'))
+        self.assertEqual(self.dl.paths, {})
+        self.assertEqual(self.dl.ids, {})
+
+    def test_dispatch_by_action(self):
+        seen = []
+        self.dl.register('add_disk', lambda event: seen.append(('first', event.device)))
+        self.dl.register('add_disk', lambda event: seen.append(('second', event.device)))
+        self.dl.dispatch(DeviceEvent('add_device', '/dev/sdx', 'Reader', 'usb-port-1'))
+        self.dl.dispatch(DeviceEvent('add_disk', '/dev/sdx', id_path = 'usb-port-1'))
+        self.assertEqual(seen, [ ('first', '/dev/sdx'), ('second', '/dev/sdx') ])
+        # The listener's own callbacks ran first
+        self.assertTrue(self.dl.device_present(0))
+
+    def test_only_insertions_dispatched(self):
+        seen = []
+        self.dl.register('add_disk', lambda event: seen.append(event.action))
+        self.dl.register('remove_disk', lambda event: seen.append(event.action))
+        self.dl.dispatch(DeviceEvent('add_device', '/dev/sdx', 'Reader', 'usb-port-1'))
+        self.dl.dispatch(DeviceEvent('add_disk', '/dev/sdx', id_path = 'usb-port-1'))
+        # A change event for the card that is still there
+        self.dl.dispatch(DeviceEvent('add_disk', '/dev/sdx', id_path = 'usb-port-1'))
+        self.dl.dispatch(DeviceEvent('remove_disk', '/dev/sdx', id_path = 'usb-port-1'))
+        self.dl.dispatch(DeviceEvent('remove_disk', '/dev/sdx', id_path = 'usb-port-1'))
+        self.dl.dispatch(DeviceEvent('add_disk', '/dev/sdx', id_path = 'usb-port-1'))
+        self.assertEqual(seen, [ 'add_disk', 'remove_disk', 'add_disk' ])
+
+    def test_unknown_disk_not_dispatched(self):
+        seen = []
+        self.dl.register('add_disk', lambda event: seen.append(event.device))
+        self.dl.dispatch(DeviceEvent('add_disk', '/dev/mmcblk0'))
+        self.assertEqual(seen, [])
+
+class DiskPresentTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dr = '/tmp/bakery_tests_disks'
+        self.tearDown()
+        os.makedirs(self.dr)
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dr)
+        except OSError as e:
+            pass
+
+    def test_missing_device_not_present(self):
+        self.assertFalse(disk_present(self.dr + '/sdz'))
+
+    def test_file_not_present(self):
+        # Only block devices have a size that can be read with the ioctl
+        with open(self.dr + '/sdz', 'wb') as fl:
+            fl.write(bytes(4096))
+        self.assertFalse(disk_present(self.dr + '/sdz'))
+
+    def test_enable_media_polling(self):
+        with open(self.dr + '/events_poll_msecs', 'w') as fl:
+            fl.write('-1\n')
+        enable_media_polling(FakeDevice(self.dr))
+        with open(self.dr + '/events_poll_msecs') as fl:
+            self.assertEqual(fl.read(), str(EVENTS_POLL_MSECS))
+
+    def test_media_polling_already_set(self):
+        with open(self.dr + '/events_poll_msecs', 'w') as fl:
+            fl.write('2000\n')
+        enable_media_polling(FakeDevice(self.dr))
+        with open(self.dr + '/events_poll_msecs') as fl:
+            self.assertEqual(fl.read(), '2000\n')
+
+    def test_change_event_without_card(self):
+        device = FakeDevice(self.dr, 'change', self.dr + '/sdz', { 'MAJOR': '8' })
+        events = device_events(device)
+        self.assertEqual([ (e.action, e.device) for e in events ],
+                         [ ('remove_disk', self.dr + '/sdz') ])
+
+    def test_add_event_without_card(self):
+        device = FakeDevice(self.dr, 'add', self.dr + '/sdz', { 'ID_MODEL': 'Reader', 'MAJOR': '8' })
+        events = device_events(device)
+        self.assertEqual([ (e.action, e.device, e.model) for e in events ],
+                         [ ('add_device', self.dr + '/sdz', 'Reader') ])
+
+    def test_other_disks_ignored(self):
+        with open(self.dr + '/events_poll_msecs', 'w') as fl:
+            fl.write('-1\n')
+        device = FakeDevice(self.dr, 'add', self.dr + '/mmcblk0', { 'MAJOR': '179' })
+        self.assertEqual(device_events(device), [])
+        with open(self.dr + '/events_poll_msecs') as fl:
+            self.assertEqual(fl.read(), '-1\n')
+
+class DiskWatchTests(unittest.TestCase):
+
+    def test_deactivate(self):
+        dl = DiskEventListener()
+        dl.activate()
+        dl.deactivate()
+        self.assertFalse(dl.watcher.is_alive())
+
+class FakeDevice(dict):
+    def __init__(self, sys_path, action=None, device_node=None, properties={}):
+        dict.__init__(self, properties)
+        self.sys_path = sys_path
+        self.action = action
+        self.device_node = device_node
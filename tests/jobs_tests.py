@@ -0,0 +1,304 @@
+import os
+import shutil
+import threading
+import time
+import unittest
+from lib.jobs import *
+from lib.diskdetector import DeviceEvent
+
+class FakeDisks:
+    def __init__(self):
+        self.actions = {}
+        # Devices that are not card readers
+        self.others = set()
+
+    def register(self, action, callback):
+        self.actions[action] = callback
+
+    def find(self, dev, id_path=None):
+        if dev in self.others:
+            return None
+        return utils.Drive(dev, 'Reader')
+
+    def event(self, action, device):
+        self.actions[action](DeviceEvent(action, device))
+
+class JobQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dr = '/tmp/bakery_tests_jobs'
+        self.tearDown()
+        os.makedirs(self.dr)
+        self.queue = JobQueue(self.dr + '/' + JOBS_FILE)
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dr)
+        except OSError as e:
+            pass
+
+    def test_no_jobs(self):
+        self.assertIsNone(self.queue.current())
+        self.assertIsNone(self.queue.start())
+
+    def test_job_done(self):
+        job = self.queue.add('/images/a/a.img', 2)
+        self.assertIs(self.queue.start(), job)
+        self.assertIs(self.queue.start(), job)
+        # Both cards are being written
+        self.assertIsNone(self.queue.start())
+        self.queue.finish(job, True)
+        self.queue.finish(job, True)
+        self.assertIsNone(self.queue.current())
+
+    def test_failed_card_is_tried_again(self):
+        job = self.queue.add('/images/a/a.img', 1)
+        self.queue.finish(self.queue.start(), False)
+        self.assertIs(self.queue.start(), job)
+        self.assertEqual(job['failed'], 1)
+
+    def test_job_given_up(self):
+        job = self.queue.add('/images/a/a.img', 20)
+        for i in range(MAX_FAILURES):
+            self.queue.finish(self.queue.start(), False)
+        self.assertIsNone(self.queue.current())
+        self.assertIsNone(self.queue.start())
+        self.assertEqual(self.queue.data['jobs'], [])
+
+    def test_jobs_are_saved(self):
+        job = self.queue.add('/images/a/a.img', 3)
+        self.queue.finish(self.queue.start(), True)
+        queue = JobQueue(self.dr + '/' + JOBS_FILE)
+        self.assertEqual(queue.current(), { 'id': job['id'],
+                                            'image': '/images/a/a.img',
+                                            'count': 3,
+                                            'done': 1,
+                                            'failed': 0 })
+
+class SchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dr = '/tmp/bakery_tests_scheduler'
+        self.tearDown()
+        os.makedirs(self.dr + '/image')
+        with open(self.dr + '/image/image.img', 'wb') as fl:
+            fl.write(bytes(4096))
+        with open(self.dr + '/image/image.vars', 'w') as fl:
+            fl.write('HOST=pi\n')
+        self.image = self.dr + '/image/image.img'
+        self.disks = FakeDisks()
+        self.written = []
+        self.release = threading.Event()
+        self.queue = JobQueue()
+        self.scheduler = Scheduler(self.queue, self.disks, WritePool(self.write))
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dr)
+        except OSError as e:
+            pass
+        utils.indexes.clear()
+
+    def write(self, devices, image, display, cancel=None):
+        self.release.wait(5)
+        self.written.append((devices, str(image), display.question('HOST', 'pi')))
+        return dict( (d, True) for d in devices )
+
+    def wait(self):
+        for i in range(50):
+            if not self.scheduler.progress():
+                return
+            time.sleep(0.1)
+
+    def test_card_written_when_inserted(self):
+        self.queue.add(self.image, 2)
+        self.disks.event('add_disk', '/dev/sdx')
+        self.assertIn('/dev/sdx', self.scheduler.progress())
+        self.release.set()
+        self.wait()
+        self.assertEqual(self.written, [ ([ '/dev/sdx' ], self.image, 'pi') ])
+        self.assertEqual(self.queue.current()['done'], 1)
+
+    def test_no_job(self):
+        self.disks.event('add_disk', '/dev/sdx')
+        self.assertEqual(self.scheduler.progress(), {})
+
+    def test_only_readers_written(self):
+        self.queue.add(self.image, 2)
+        self.disks.others.add('/dev/mmcblk0')
+        self.disks.event('add_disk', '/dev/mmcblk0')
+        self.assertEqual(self.scheduler.progress(), {})
+
+    def test_card_only_written_once(self):
+        self.queue.add(self.image, 2)
+        self.release.set()
+        self.disks.event('add_disk', '/dev/sdx')
+        self.wait()
+        self.disks.event('add_disk', '/dev/sdx')
+        self.wait()
+        self.assertEqual(len(self.written), 1)
+        # Until it is taken out and another put in
+        self.disks.event('remove_disk', '/dev/sdx')
+        self.disks.event('add_disk', '/dev/sdx')
+        self.wait()
+        self.assertEqual(len(self.written), 2)
+        self.assertIsNone(self.queue.current())
+
+    def test_failed_card_not_tried_again(self):
+        self.scheduler = Scheduler(self.queue, self.disks, WritePool(self.fail))
+        self.queue.add(self.image, 2)
+        self.disks.event('add_disk', '/dev/sdx')
+        self.wait()
+        self.disks.event('add_disk', '/dev/sdx')
+        self.wait()
+        self.assertEqual(self.queue.current()['failed'], 1)
+        # Until it is taken out and put back
+        self.disks.event('remove_disk', '/dev/sdx')
+        self.disks.event('add_disk', '/dev/sdx')
+        self.wait()
+        self.assertEqual(self.queue.current()['failed'], 2)
+
+    def fail(self, devices, image, display, cancel=None):
+        return dict( (d, False) for d in devices )
+
+    def test_several_readers(self):
+        self.queue.add(self.image, 2)
+        self.disks.event('add_disk', '/dev/sdx')
+        self.disks.event('add_disk', '/dev/sdy')
+        self.disks.event('add_disk', '/dev/sdz')
+        self.assertEqual(sorted(self.scheduler.progress()), [ '/dev/sdx', '/dev/sdy' ])
+        self.release.set()
+        self.wait()
+
+    def test_image_gone(self):
+        self.queue.add(self.dr + '/gone/gone.img', 2)
+        self.disks.event('add_disk', '/dev/sdx')
+        self.wait()
+        self.assertEqual(self.written, [])
+        self.assertIsNone(self.queue.current())
+
+    def test_interrupted_card_waits_for_job(self):
+        device = self.dr + '/device'
+        open(device, 'wb').close()
+        key = utils.card_key(device)
+        utils.journal.checkpoint(key, self.image, 4096, [ [ 0, 4096, 0 ] ])
+        try:
+            self.release.set()
+            # Nobody has asked for it to be written
+            self.disks.event('add_disk', device)
+            self.wait()
+            self.assertEqual(self.written, [])
+            self.disks.event('remove_disk', device)
+            self.queue.add(self.image, 1)
+            self.disks.event('add_disk', device)
+            self.wait()
+        finally:
+            utils.journal.remove(key)
+        self.assertEqual(self.written, [ ([ device ], self.image, 'pi') ])
+
+    def test_fastest_waiting_card_first(self):
+        self.scheduler = Scheduler(self.queue, self.disks, WritePool(self.write, workers=1))
+        rates = { '/dev/sdx': 5, '/dev/sdy': 10, '/dev/sdz': 20 }
+        identity = utils.device_identity
+        utils.device_identity = lambda path: ('port-' + path, None)
+        for device in rates:
+            utils.throughput.data['ports']['port-' + device] = { 'rate': rates[device], 'jobs': 1 }
+        try:
+            self.queue.add(self.image, 3)
+            for device in rates:
+                self.disks.event('add_disk', device)
+            self.assertEqual(list(self.scheduler.progress()), [ '/dev/sdx' ])
+            self.release.set()
+            for i in range(50):
+                if len(self.written) == 3:
+                    break
+                time.sleep(0.1)
+        finally:
+            utils.device_identity = identity
+            for device in rates:
+                del utils.throughput.data['ports']['port-' + device]
+        self.assertEqual([ w[0] for w in self.written ],
+                         [ [ '/dev/sdx' ], [ '/dev/sdz' ], [ '/dev/sdy' ] ])
+
+class WritePoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.pool = WritePool(self.write, workers=2)
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.executor.shutdown()
+
+    def write(self, devices, image, display, cancel=None):
+        display.progress_title('Writing')
+        display.progress(50, 10.0)
+        while not self.release.wait(0.05):
+            if cancel.is_set():
+                return dict( (d, False) for d in devices )
+        display.put({ 'action': 'write', 'text': 'Ignored' })
+        return dict( (d, True) for d in devices )
+
+    def wait(self, handle):
+        for i in range(50):
+            if handle.done():
+                return
+            time.sleep(0.1)
+
+    def test_start_returns_straight_away(self):
+        handle = self.pool.start([ '/dev/sdx' ], 'image')
+        self.assertFalse(handle.done())
+        self.assertEqual(self.pool.busy_devices(), [ '/dev/sdx' ])
+        self.release.set()
+        self.wait(handle)
+        self.assertEqual(handle.results, { '/dev/sdx': True })
+        self.assertTrue(handle.status.startswith('FINISHED'))
+        self.assertEqual(self.pool.busy_devices(), [])
+
+    def test_progress(self):
+        handle = self.pool.start([ '/dev/sdx' ], 'image')
+        for i in range(50):
+            if handle.percent:
+                break
+            time.sleep(0.1)
+        self.assertEqual((handle.title, handle.percent, handle.rate),
+                         ('Writing', 50, 10.0))
+
+    def test_progress_of_each_card(self):
+        handle = WriteHandle(self.write, [ '/dev/sdx', '/dev/sdy' ], 'image')
+        handle.progress_title()
+        handle.progress(20, devices = { '/dev/sdx': 20, '/dev/sdy': 70 })
+        self.assertEqual(handle.percent, 20)
+        self.assertEqual(handle.device_percents, { '/dev/sdx': 20, '/dev/sdy': 70 })
+        handle.progress_title('V')
+        self.assertEqual(handle.device_percents, {})
+
+    def test_cancel(self):
+        handle = self.pool.start([ '/dev/sdx' ], 'image')
+        handle.cancel()
+        self.wait(handle)
+        self.assertEqual(handle.results, { '/dev/sdx': False })
+        self.assertEqual(handle.status, 'Cancelled')
+
+    def test_cancel_waiting_write(self):
+        running = [ self.pool.start([ d ], 'image') for d in ('/dev/sdx', '/dev/sdy') ]
+        waiting = self.pool.start([ '/dev/sdz' ], 'image')
+        self.assertEqual(waiting.status, 'Waiting')
+        waiting.cancel()
+        self.release.set()
+        for handle in running:
+            self.wait(handle)
+        self.assertIsNone(waiting.start_time)
+        self.assertEqual(waiting.status, 'Cancelled')
+        self.assertEqual(self.pool.active(), [])
+
+    def test_callback(self):
+        finished = []
+        handle = self.pool.start([ '/dev/sdx' ], 'image', callback=finished.append)
+        self.release.set()
+        self.wait(handle)
+        self.assertEqual(finished, [ handle ])
+
+    def test_questions_use_defaults(self):
+        handle = self.pool.start([ '/dev/sdx' ], 'image')
+        self.assertEqual(handle.question('HOST', 'c:pi,pi2'), 'pi')
@@ -0,0 +1,160 @@
+import time
+import unittest
+from lib.lcd import *
+
+class FakeLcd:
+    def __init__(self):
+        self.calls = []
+        self.text = {}
+        self.cursor = None
+
+    def __getattr__(self, name):
+        # backlight_on, move_left and so on
+        return lambda *args: self.calls.append((name,) + args)
+
+    def clear(self):
+        self.calls.append(('clear',))
+        self.text = {}
+
+    def set_cursor(self, col, row):
+        self.calls.append(('set_cursor', col, row))
+        self.cursor = [col, row]
+
+    def write(self, text):
+        self.calls.append(('write', text))
+        for c in text:
+            self.text[tuple(self.cursor)] = c
+            self.cursor[0] += 1
+
+    def write_custom_bitmap(self, n):
+        self.calls.append(('write_custom_bitmap', n))
+        self.text[tuple(self.cursor)] = n
+        self.cursor[0] += 1
+
+class FakeCad:
+    def __init__(self):
+        self.lcd = FakeLcd()
+
+class LcdRendererTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cad = FakeCad()
+        self.renderer = LcdRenderer(self.cad)
+
+    def calls(self, name):
+        return [ c for c in self.cad.lcd.calls if c[0] == name ]
+
+    def draw(self):
+        with self.renderer.condition:
+            screen = [ list(line) for line in self.renderer.screen ]
+            shift = self.renderer.shift
+            bitmaps = dict(self.renderer.bitmaps)
+            cursor = self.renderer.cursor
+        self.renderer.draw(screen, shift, bitmaps, cursor)
+
+    def test_only_last_write_is_sent(self):
+        for percent in range(100):
+            self.renderer.put( { 'action': 'write', 'pos': [10, 0],
+                                 'text': '{0:5.2f}'.format(percent) } )
+        self.draw()
+        self.assertEqual(self.calls('write'), [ ('write', '99.00') ])
+
+    def test_only_changes_are_sent(self):
+        self.renderer.put( { 'action': 'write', 'pos': [0, 0], 'text': 'Complete: 10.00%' } )
+        self.draw()
+        self.cad.lcd.calls = []
+        self.renderer.put( { 'action': 'write', 'pos': [10, 0], 'text': '11.00' } )
+        self.draw()
+        self.assertEqual(self.cad.lcd.calls, [ ('set_cursor', 11, 0), ('write', '1') ])
+
+    def test_blank(self):
+        self.renderer.put( { 'action': 'write', 'pos': [0, 1], 'text': 'Long device name' } )
+        self.draw()
+        self.renderer.put( { 'action': 'write', 'pos': [0, 1], 'text': 'Short', 'blank': 1 } )
+        self.draw()
+        self.assertEqual(''.join(self.cad.lcd.text.get((i, 1), ' ') for i in range(16)),
+                         'Short           ')
+
+    def test_bitmaps(self):
+        self.renderer.put( { 'action': 'store', 'bitmap': 7, 'lines': [ 1 ] * 8 } )
+        self.renderer.put( { 'action': 'bitmap', 'pos': [0, 0], 'bitmap': 7 } )
+        self.renderer.put( { 'action': 'write', 'pos': [1, 0], 'text': 'Image' } )
+        self.draw()
+        self.assertEqual(self.calls('store_custom_bitmap'), [ ('store_custom_bitmap', 7, [ 1 ] * 8) ])
+        self.assertEqual(self.cad.lcd.text[(0, 0)], 7)
+        self.assertEqual(self.cad.lcd.text[(1, 0)], 'I')
+        self.cad.lcd.calls = []
+        self.draw()
+        self.assertEqual(self.cad.lcd.calls, [])
+
+    def test_scroll_burst(self):
+        self.draw()
+        for i in range(45):
+            self.renderer.put( { 'action': 'scroll', 'step': 1 } )
+        self.draw()
+        self.assertEqual(len(self.calls('move_left')), 5)
+        self.renderer.put( { 'action': 'clear' } )
+        self.draw()
+        self.assertEqual(len(self.calls('move_right')), 5)
+
+    def test_resume_redraws(self):
+        self.renderer.put( { 'action': 'write', 'pos': [0, 0], 'text': 'Image' } )
+        self.draw()
+        self.renderer.put( { 'action': 'pause' } )
+        self.renderer.put( { 'action': 'resume' } )
+        self.cad.lcd.calls = []
+        self.draw()
+        self.assertEqual(self.cad.lcd.calls[0], ('clear',))
+        self.assertIn(('write', 'Image'), self.cad.lcd.calls)
+
+    def test_cursor(self):
+        self.renderer.put( { 'action': 'cursor', 'pos': [3, 1] } )
+        self.renderer.put( { 'action': 'write', 'pos': [0, 1], 'text': 'abcd' } )
+        self.draw()
+        self.assertEqual(self.cad.lcd.calls[-3:],
+                         [ ('set_cursor', 3, 1), ('cursor_on',), ('blink_on',) ])
+        self.renderer.put( { 'action': 'cursor', 'pos': None } )
+        self.draw()
+        self.assertEqual(self.cad.lcd.calls[-2:], [ ('cursor_off',), ('blink_off',) ])
+
+    def test_thread(self):
+        self.renderer.start()
+        self.renderer.put( { 'action': 'write', 'pos': [0, 0], 'text': 'Hello' } )
+        for i in range(50):
+            if self.calls('write'):
+                break
+            time.sleep(0.01)
+        self.renderer.finish()
+        self.assertEqual(self.calls('write'), [ ('write', 'Hello') ])
+
+class QuestionTests(unittest.TestCase):
+
+    def test_text(self):
+        question = Question('pi')
+        question.move()
+        question.change(1)
+        question.move()
+        question.change(-1)
+        self.assertEqual(question.column(), 2)
+        self.assertEqual(question.answer(), 'pj.')
+
+    def test_values(self):
+        question = Question('%m:pi,pi2')
+        self.assertEqual(question.answer(), 'pi')
+        question.change(1)
+        self.assertEqual(question.answer(), 'pi2')
+        question.change(1)
+        self.assertEqual(question.answer(), 'pi')
+
+    def test_values_without_format(self):
+        self.assertEqual(Question('c:pi,pi2').answer(), 'pi')
+
+    def test_format(self):
+        question = Question('%2i.%c%r')
+        self.assertEqual(question.text(), '00.a')
+        question.change(-1)
+        question.move()
+        question.move()
+        self.assertEqual(question.column(), 3)
+        question.change(2)
+        self.assertEqual(question.answer(), '90.c')
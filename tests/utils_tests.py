@@ -1,5 +1,12 @@
+import gzip
+import io
+import struct
+import uuid
+import zlib
 import os
 import shutil
+import time
+import threading
 import unittest
 from lib.utils import *
 
@@ -172,3 +179,535 @@ class SelectListTests(unittest.TestCase):
         self.assertEqual(str(sdi.get_current()), '/tmp/bakery_tests_2/03-image3/03-image3.img.gz')
         sdi.prev()
         self.assertEqual(str(sdi.get_current()), '/tmp/bakery_tests_2/02-image2/02-image2.img.gz')
+
+class WriteImageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dr = '/tmp/bakery_tests_write'
+        self.tearDown()
+        os.makedirs(self.dr + '/store/image')
+        self.data = os.urandom(3 * 1024 * 1024) + bytes(2 * 1024 * 1024) + b'end'
+        with gzip.open(self.dr + '/store/image/image.img.gz', 'wb') as fl:
+            fl.write(self.data)
+        self.device = self.dr + '/device'
+        open(self.device, 'wb').close()
+        self.image = disk_image_list(self.dr + '/store')[0]
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dr)
+        except OSError as e:
+            pass
+
+    def read_device(self):
+        with open(self.device, 'rb') as fl:
+            return fl.read()
+
+    def test_image_size(self):
+        self.assertEqual(image_size(self.image), len(self.data))
+
+    def test_stream_image(self):
+        with open_image(self.image) as source:
+            writers = stream_image(source, [self.device], buffer_size=1024*1024)
+        self.assertEqual(writers[0].written, len(self.data))
+        self.assertIsNone(writers[0].error)
+        self.assertEqual(self.read_device(), self.data)
+
+    def test_stream_image_progress(self):
+        counts = []
+        with open_image(self.image) as source:
+            stream_image(source, [self.device],
+                         lambda device, written: counts.append(written),
+                         buffer_size=1024*1024)
+        self.assertEqual(counts, sorted(counts))
+        self.assertEqual(counts[-1], len(self.data))
+
+    def test_stream_image_to_several_devices(self):
+        second = self.dr + '/device2'
+        open(second, 'wb').close()
+        with open_image(self.image) as source:
+            writers = stream_image(source, [self.device, second], buffer_size=1024*1024)
+        self.assertEqual([ w.error for w in writers ], [ None, None ])
+        self.assertEqual(self.read_device(), self.data)
+        with open(second, 'rb') as fl:
+            self.assertEqual(fl.read(), self.data)
+
+    def test_stream_image_failed_device(self):
+        missing = self.dr + '/missing/device'
+        with open_image(self.image) as source:
+            writers = stream_image(source, [missing, self.device], buffer_size=1024*1024)
+        self.assertIsInstance(writers[0].error, OSError)
+        self.assertIsNone(writers[1].error)
+        self.assertEqual(self.read_device(), self.data)
+
+    def test_stream_image_cancelled(self):
+        cancel = threading.Event()
+        cancel.set()
+        with open_image(self.image) as source:
+            writers = stream_image(source, [self.device], buffer_size=1024*1024,
+                                   cancel=cancel)
+        self.assertIsInstance(writers[0].error, WriteCancelled)
+        self.assertLess(writers[0].written, len(self.data))
+
+    def test_stream_image_resume(self):
+        start = 2 * 1024 * 1024
+        with open(self.device, 'wb') as fl:
+            fl.write(b'q' * start)
+        checkpoints = []
+        with open_image(self.image) as source:
+            writers = stream_image(source, [self.device], buffer_size=1024*1024,
+                                   sync_interval=2*1024*1024,
+                                   resume={ self.device: start },
+                                   checkpoint=lambda device, synced: checkpoints.append(synced))
+        self.assertIsNone(writers[0].error)
+        # The start was not written again
+        self.assertEqual(self.read_device(), b'q' * start + self.data[start:])
+        self.assertEqual(writers[0].bytes_written(), len(self.data) - start)
+        self.assertEqual(checkpoints, [ 4*1024*1024 ])
+
+    def test_stream_image_buffer_level(self):
+        levels = []
+        with open_image(self.image) as source:
+            writers = stream_image(source, [self.device], buffer_size=1024*1024,
+                                   buffers=3,
+                                   buffer_level=lambda level, depth: levels.append((level, depth)))
+        self.assertEqual(self.read_device(), self.data)
+        self.assertEqual(len(levels), 6)
+        self.assertTrue(all(0 <= level <= 3 and depth == 3 for level, depth in levels))
+
+    def test_stream_image_read_error(self):
+        with open(str(self.image), 'r+b') as fl:
+            fl.seek(-100, 2)
+            fl.write(bytes(100))
+        with open_image(self.image) as source:
+            self.assertRaises(EOFError, stream_image, source, [self.device],
+                              buffer_size=1024*1024)
+
+    def test_stream_image_direct(self):
+        counts = []
+        with open_image(self.image) as source:
+            writers = stream_image(source, [self.device],
+                                   lambda device, synced: counts.append(synced),
+                                   buffer_size=1024*1024, sparse=True,
+                                   direct=True, sync_interval=2*1024*1024)
+        self.assertIsNone(writers[0].error)
+        self.assertEqual(writers[0].synced, len(self.data))
+        self.assertEqual(self.read_device(), self.data)
+        # Progress only moves on when the data has been synced
+        self.assertEqual(counts, [ 0, 2*1024*1024, 2*1024*1024, 4*1024*1024,
+                                   4*1024*1024, 4*1024*1024, len(self.data) ])
+
+    def test_busy_time(self):
+        writer = DeviceWriter(self.device)
+        writer.write(b'x' * 5000)
+        time.sleep(0.2)
+        writer.close()
+        self.assertGreater(writer.busy, 0)
+        # Time spent waiting between buffers is not counted
+        self.assertLess(writer.busy, 0.1)
+        self.assertGreaterEqual(writer.seconds(), 0.2)
+
+    def test_zeros_written_when_device_cannot_zero(self):
+        with open(self.device, 'wb') as fl:
+            fl.write(b'x' * 3 * SPARSE_BLOCK_SIZE)
+        writer = DeviceWriter(self.device, zero_skipped=True)
+        # As a block device, which a regular file cannot discard or zero
+        writer.regular = False
+        writer.write(bytes(2 * SPARSE_BLOCK_SIZE), [ (0, 2 * SPARSE_BLOCK_SIZE, True) ])
+        writer.close()
+        self.assertIsNone(writer.error)
+        self.assertFalse(writer.discard)
+        self.assertFalse(writer.zero_out)
+        self.assertEqual(self.read_device(),
+                         bytes(2 * SPARSE_BLOCK_SIZE) + b'x' * SPARSE_BLOCK_SIZE)
+
+    def test_discard_falls_back_to_zeros(self):
+        with open(self.device, 'wb') as fl:
+            fl.write(b'x' * 3 * SPARSE_BLOCK_SIZE)
+        writer = DeviceWriter(self.device, discard=True)
+        writer.regular = False
+        for i in range(3):
+            writer.write(bytes(SPARSE_BLOCK_SIZE), [ (0, SPARSE_BLOCK_SIZE, True) ])
+            writer.write(b'y' * 10)
+        writer.close()
+        self.assertIsNone(writer.error)
+        self.assertEqual(self.read_device(),
+                         (bytes(SPARSE_BLOCK_SIZE) + b'y' * 10) * 3)
+
+    def test_direct_write_unaligned(self):
+        writer = DeviceWriter(self.device, direct=True)
+        writer.write(b'x' * 5000)
+        writer.write(b'y' * 100)
+        writer.close()
+        self.assertIsNone(writer.error)
+        self.assertEqual(self.read_device(), b'x' * 5000 + b'y' * 100)
+
+    def test_buffer_ring(self):
+        ring = BufferRing(2, 4096)
+        ring.start(io.BytesIO(b'x' * 5000))
+        i, length = ring.get()
+        self.assertEqual(length, 4096)
+        ring.put(i)
+        i, length = ring.get()
+        self.assertEqual(ring.views[i][:length], b'x' * 904)
+        ring.put(i)
+        self.assertEqual(ring.get()[1], 0)
+        ring.close()
+
+    def test_data_runs(self):
+        buf = bytes(100) + b'x' + bytes(300)
+        self.assertEqual(data_runs(buf, len(buf), 100),
+                         [ (0, 100, True), (100, 200, False), (200, 401, True) ])
+
+    def test_stream_image_sparse(self):
+        with open_image(self.image) as source:
+            writers = stream_image(source, [self.device], buffer_size=1024*1024,
+                                   sparse=True)
+        self.assertEqual(writers[0].skipped, 2 * 1024 * 1024)
+        self.assertEqual(self.read_device(), self.data)
+
+    def test_stream_image_sparse_leaves_old_data(self):
+        with open(self.device, 'wb') as fl:
+            fl.write(b'\xff' * len(self.data))
+        with open_image(self.image) as source:
+            stream_image(source, [self.device], buffer_size=1024*1024,
+                         sparse=True)
+        card = self.read_device()
+        self.assertEqual(card[:3 * 1024 * 1024], self.data[:3 * 1024 * 1024])
+        self.assertEqual(card[3 * 1024 * 1024:-3], b'\xff' * 2 * 1024 * 1024)
+        self.assertEqual(card[-3:], b'end')
+
+    def test_stream_image_builds_bmap(self):
+        builder = bmap.BmapBuilder()
+        with open_image(self.image) as source:
+            stream_image(source, [self.device], buffer_size=1024*1024,
+                         builder=builder)
+        block_map = builder.finish()
+        self.assertEqual(block_map.image_size, len(self.data))
+        self.assertEqual(block_map.mapped_size(), 3 * 1024 * 1024 + 3)
+
+    def test_stream_image_with_bmap(self):
+        builder = bmap.BmapBuilder()
+        builder.update(self.data, len(self.data))
+        save_bmap(self.image, builder.finish())
+        block_map = load_bmap(self.image)
+        with open(self.device, 'wb') as fl:
+            fl.write(b'\xff' * len(self.data))
+        with open_image(self.image) as source:
+            stream_image(source, [self.device], buffer_size=1024*1024,
+                         block_map=block_map)
+        # What was on the card before is zeroed where the map leaves it out
+        self.assertEqual(self.read_device(), self.data)
+
+    def test_stream_image_with_bmap_verifies_zeros(self):
+        builder = bmap.BmapBuilder()
+        builder.update(self.data, len(self.data))
+        block_map = builder.finish()
+        checksums = ExtentChecksums(1024*1024)
+        with open_image(self.image) as source:
+            writers = stream_image(source, [self.device], buffer_size=1024*1024,
+                                   block_map=block_map, checksums=checksums)
+        self.assertEqual(writers[0].skipped, 2 * 1024 * 1024)
+        # The unmapped blocks are checked too
+        self.assertEqual(checksums.size(), len(self.data))
+        self.assertTrue(verify_device(self.device, checksums.extents))
+        with open(self.device, 'r+b') as fl:
+            fl.seek(4 * 1024 * 1024)
+            fl.write(b'\xff')
+        self.assertFalse(verify_device(self.device, checksums.extents))
+
+    def test_stream_image_with_wrong_bmap(self):
+        builder = bmap.BmapBuilder()
+        builder.update(self.data[::-1], len(self.data))
+        with open_image(self.image) as source:
+            self.assertRaises(bmap.ChecksumError, stream_image, source,
+                              [self.device], buffer_size=1024*1024,
+                              block_map=builder.finish())
+
+    def test_verify_device(self):
+        checksums = ExtentChecksums(1024*1024)
+        with open_image(self.image) as source:
+            stream_image(source, [self.device], buffer_size=1024*1024,
+                         sparse=True, checksums=checksums)
+        self.assertEqual(checksums.size(), 3 * 1024 * 1024 + 3)
+        self.assertTrue(verify_device(self.device, checksums.extents))
+
+    def test_verify_device_mismatch(self):
+        checksums = ExtentChecksums()
+        with open_image(self.image) as source:
+            stream_image(source, [self.device], buffer_size=1024*1024,
+                         checksums=checksums)
+        with open(self.device, 'r+b') as fl:
+            fl.seek(1000)
+            fl.write(b'x')
+        self.assertFalse(verify_device(self.device, checksums.extents))
+
+class ImageIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dr = '/tmp/bakery_tests_index'
+        self.tearDown()
+        os.makedirs(self.dr + '/image')
+        self.path = self.dr + '/image/image.img.gz'
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dr)
+        except OSError as e:
+            pass
+        indexes.clear()
+
+    def mbr(self, *partitions):
+        sector = bytearray(SECTOR_SIZE)
+        for i, (ptype, start, sectors) in enumerate(partitions):
+            sector[446 + 16*i + 4] = ptype
+            sector[446 + 16*i + 8:446 + 16*i + 16] = struct.pack('<II', start, sectors)
+        sector[510:512] = b'\x55\xaa'
+        return bytes(sector)
+
+    def write_image(self, data):
+        with gzip.open(self.path, 'wb') as fl:
+            fl.write(data)
+
+    def test_read_mbr(self):
+        table = read_partition_table(self.mbr((0x0c, 8192, 8192), (0x83, 16384, 100)))
+        self.assertEqual(table['scheme'], 'mbr')
+        self.assertEqual([ p['type'] for p in table['partitions'] ], [ 'c', '83' ])
+        self.assertEqual(table['partitions'][1]['start'], 16384 * SECTOR_SIZE)
+        self.assertEqual(table['disk_size'], 16484 * SECTOR_SIZE)
+
+    def test_read_gpt(self):
+        data = bytearray(self.mbr((0xee, 1, 0xffffffff)) + bytes(33 * SECTOR_SIZE))
+        header = SECTOR_SIZE
+        data[header:header + 8] = b'EFI PART'
+        data[header + 32:header + 40] = struct.pack('<Q', 99999)
+        data[header + 72:header + 88] = struct.pack('<QII', 2, 128, 128)
+        entry = 2 * SECTOR_SIZE
+        data[entry:entry + 16] = uuid.UUID('0fc63daf-8483-4772-8e79-3d69d8477de4').bytes_le
+        data[entry + 32:entry + 48] = struct.pack('<QQ', 2048, 4095)
+        table = read_partition_table(bytes(data))
+        self.assertEqual(table['scheme'], 'gpt')
+        self.assertEqual(table['disk_size'], 100000 * SECTOR_SIZE)
+        self.assertEqual(table['partitions'], [ { 'number': 1,
+                                                  'type': '0fc63daf-8483-4772-8e79-3d69d8477de4',
+                                                  'start': 2048 * SECTOR_SIZE,
+                                                  'size': 2048 * SECTOR_SIZE } ])
+
+    def test_no_partition_table(self):
+        self.assertIsNone(read_partition_table(bytes(PARTITION_TABLE_SIZE)))
+
+    def test_card_without_partition_table(self):
+        with open(self.dr + '/card', 'wb') as fl:
+            fl.write(bytes(PARTITION_TABLE_SIZE))
+        self.assertEqual(card_partitions(self.dr + '/card'), {})
+
+    def test_size_over_4gb(self):
+        # The partition table says the image is bigger than the gzip trailer
+        sectors = (2**32 + 1024*1024) // SECTOR_SIZE
+        data = self.mbr((0x83, 1, sectors - 1)) + bytes(1024*1024 - SECTOR_SIZE)
+        self.write_image(data)
+        image = disk_image_list(self.dr)[0]
+        self.assertEqual(image.metadata['size'], 2**32 + 1024*1024)
+        self.assertFalse(image.metadata['exact'])
+        self.assertEqual(image.info('size'), '4.0G')
+
+    def test_metadata(self):
+        data = self.mbr((0x0c, 1, 10)) + bytes(10 * SECTOR_SIZE)
+        self.write_image(data)
+        image = disk_image_list(self.dr)[0]
+        self.assertEqual(image_size(image), len(data))
+        self.assertEqual(image.metadata['crc32'], zlib.crc32(data))
+        self.assertEqual(image.info('partitions'), 'MBR c')
+
+    def test_index_is_saved(self):
+        self.write_image(self.mbr((0x0c, 1, 10)))
+        disk_image_list(self.dr)
+        indexes.clear()
+        index = image_index(self.dr)
+        self.assertIn(self.path, index.data['images'])
+        self.assertIn(self.dr + '/image', index.data['directories'])
+
+    def test_index_notices_changes(self):
+        self.write_image(self.mbr((0x0c, 1, 10)))
+        disk_image_list(self.dr)
+        os.utime(self.path, (0, 0))
+        self.write_image(self.mbr((0x83, 1, 10)))
+        self.assertEqual(disk_image_list(self.dr)[0].info('partitions'), 'MBR 83')
+
+    def test_vars_edited(self):
+        self.write_image(self.mbr((0x0c, 1, 10)))
+        with open(self.dr + '/image/image.vars', 'w') as fl:
+            fl.write('HOSTNAME:%c\n')
+        disk_image_list(self.dr)
+        with open(self.dr + '/image/image.vars', 'w') as fl:
+            fl.write('HOSTNAME:%c\nUSER:%c\n')
+        os.utime(self.dr + '/image/image.vars', (1, 1))
+        self.assertEqual(len(disk_image_list(self.dr)[0].variables), 2)
+
+class ImageStoreWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dr = '/tmp/bakery_tests_watch'
+        self.tearDown()
+        for name in [ '01-image1', '03-image3' ]:
+            self.add_image(name)
+        self.images = disk_image_list(self.dr)
+        self.watcher = ImageStoreWatcher(self.images, self.dr)
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dr)
+        except OSError as e:
+            pass
+        indexes.clear()
+
+    def add_image(self, name):
+        os.makedirs(self.dr + '/' + name)
+        open(self.dr + '/' + name + '/' + name + '.img', 'w').close()
+
+    def names(self):
+        return [ image.name for image in self.images ]
+
+    def test_add_image(self):
+        self.images.next()
+        self.images.select()
+        self.add_image('02-image2')
+        self.watcher.rescan(self.dr + '/02-image2')
+        self.assertEqual(self.names(), [ '01-image1', '02-image2', '03-image3' ])
+        self.assertEqual(self.images.current().name, '03-image3')
+        self.assertTrue(self.images.current_is_selected())
+        self.assertTrue(self.images.updated)
+
+    def test_remove_image(self):
+        self.images.next()
+        shutil.rmtree(self.dr + '/03-image3')
+        self.watcher.rescan(self.dr + '/03-image3')
+        self.assertEqual(self.names(), [ '01-image1' ])
+        self.assertEqual(self.images.current().name, '01-image1')
+
+    def test_unchanged_images_are_kept(self):
+        first = self.images[0]
+        self.watcher.rescan(self.dr + '/01-image1')
+        self.assertIs(self.images[0], first)
+
+    def test_modified_image(self):
+        with open(self.dr + '/01-image1/01-image1.post.1', 'w') as fl:
+            fl.write('#!/bin/sh\n')
+        self.watcher.rescan(self.dr + '/01-image1')
+        self.assertEqual(len(self.images[0].get_post_scripts()), 1)
+
+    def test_watch(self):
+        changed = threading.Event()
+        self.images.updated = False
+        self.watcher.callback = changed.set
+        self.watcher.start()
+        self.add_image('02-image2')
+        self.assertTrue(changed.wait(5))
+        self.assertEqual(self.names(), [ '01-image1', '02-image2', '03-image3' ])
+
+class ThroughputStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dr = '/tmp/bakery_tests_throughput'
+        self.tearDown()
+        os.makedirs(self.dr)
+        self.store = ThroughputStore(self.dr + '/' + THROUGHPUT_FILE)
+        self.fast = Drive('/dev/sdx', 'Reader', 'usb-port-1')
+        self.slow = Drive('/dev/sdy', 'Reader', 'usb-port-2')
+        self.mb = 1024 * 1024
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dr)
+        except OSError as e:
+            pass
+
+    def test_unknown_speed(self):
+        self.assertIsNone(self.store.rate(self.fast))
+        self.assertFalse(self.store.is_slow(self.fast))
+
+    def test_record(self):
+        self.store.record('usb-port-1', 'Reader', 100 * self.mb, 10)
+        self.assertEqual(self.store.rate(self.fast), 10)
+        self.store.record('usb-port-1', 'Reader', 200 * self.mb, 10)
+        self.assertAlmostEqual(self.store.rate(self.fast), 13)
+
+    def test_small_writes_ignored(self):
+        self.store.record('usb-port-1', 'Reader', self.mb, 0.01)
+        self.assertIsNone(self.store.rate(self.fast))
+
+    def test_model_speed_for_new_port(self):
+        self.store.record('usb-port-1', 'Reader', 100 * self.mb, 10)
+        self.assertEqual(self.store.rate(Drive('/dev/sdz', 'Reader', 'usb-port-3')), 10)
+
+    def test_slow_port(self):
+        self.store.record('usb-port-1', 'Reader', 100 * self.mb, 10)
+        self.store.record('usb-port-2', None, 100 * self.mb, 50)
+        self.assertFalse(self.store.is_slow(self.fast))
+        self.assertTrue(self.store.is_slow(self.slow))
+        new = Drive('/dev/sdz', 'Other', 'usb-port-3')
+        self.assertEqual(self.store.fastest_first([ self.slow, self.fast, new ]),
+                         [ new, self.fast, self.slow ])
+
+    def test_saved(self):
+        self.store.record('usb-port-1', 'Reader', 100 * self.mb, 10)
+        store = ThroughputStore(self.dr + '/' + THROUGHPUT_FILE)
+        self.assertEqual(store.rate(self.fast), 10)
+
+    def test_drive_info(self):
+        self.assertEqual(self.fast.info('speed'), 'Speed unknown')
+        throughput.data['ports']['usb-port-1'] = { 'rate': 12.34, 'jobs': 1 }
+        try:
+            self.assertEqual(self.fast.info('speed'), '12.3 MB/s')
+        finally:
+            del throughput.data['ports']['usb-port-1']
+
+class WriteJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dr = '/tmp/bakery_tests_journal'
+        self.tearDown()
+        os.makedirs(self.dr + '/store/image')
+        self.data = os.urandom(5 * 1024 * 1024)
+        with gzip.open(self.dr + '/store/image/image.img.gz', 'wb') as fl:
+            fl.write(self.data)
+        self.image = disk_image_list(self.dr + '/store')[0]
+        self.device = self.dr + '/device'
+        with open(self.device, 'wb') as fl:
+            fl.write(self.data[:3 * 1024 * 1024])
+        self.key = card_key(self.device)
+        self.journal = WriteJournal(self.dr + '/' + JOURNAL_FILE)
+        checksums = ExtentChecksums(1024 * 1024)
+        checksums.update(0, self.data[:3 * 1024 * 1024])
+        self.journal.checkpoint(self.key, self.image, 3 * 1024 * 1024,
+                                checksums.before(3 * 1024 * 1024))
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dr)
+        except OSError as e:
+            pass
+        indexes.clear()
+
+    def test_card_key(self):
+        self.assertEqual(self.key, os.path.realpath(self.device))
+        self.assertIsNone(card_key(self.dr + '/missing'))
+
+    def test_resume(self):
+        journal = WriteJournal(self.dr + '/' + JOURNAL_FILE)
+        self.assertEqual(journal.resume_offset(self.key, self.image, self.device),
+                         3 * 1024 * 1024)
+
+    def test_card_changed(self):
+        with open(self.device, 'r+b') as fl:
+            fl.seek(2 * 1024 * 1024 + 10)
+            fl.write(b'changed')
+        self.assertEqual(self.journal.resume_offset(self.key, self.image, self.device), 0)
+        self.assertIsNone(self.journal.entry(self.key))
+
+    def test_image_changed(self):
+        os.utime(str(self.image), (0, 0))
+        self.assertEqual(self.journal.resume_offset(self.key, self.image, self.device), 0)
+
+    def test_other_image(self):
+        self.assertEqual(self.journal.resume_offset(self.key, 'other.img', self.device), 0)